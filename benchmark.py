@@ -0,0 +1,655 @@
+"""性能基准测试
+
+不连接Discord、不调用付费LLM：用模拟的消息对象驱动 on_message，LLM请求发给本地的
+OpenAI兼容桩服务器（延迟可调）。输出消息吞吐、回复延迟分位数、事件循环延迟、
+BotMemory 的内存增长和存档文件大小随时间的变化，作为性能改动的回归基线。
+
+用法:
+    python benchmark.py --rate 50 --duration 60 --channels 20 --users 200
+    python benchmark.py --llm-latency 0.8 --json bench.json
+    python benchmark.py --llm-latency 2 --backup-llm-latency 0.5 --llm-error-rate 0.1
+    python benchmark.py --profiles 10000
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="DiscordAIBot 性能基准测试")
+    parser.add_argument('--rate', type=float, default=20, help="每秒消息数")
+    parser.add_argument('--duration', type=float, default=30, help="发送消息的秒数")
+    parser.add_argument('--channels', type=int, default=10, help="频道数")
+    parser.add_argument('--guilds', type=int, default=3, help="群组数")
+    parser.add_argument('--users', type=int, default=100, help="用户数")
+    parser.add_argument('--skew',
+                        type=float,
+                        default=1.0,
+                        help="频道和用户活跃度的Zipf指数，0表示均匀分布")
+    parser.add_argument('--mention-ratio',
+                        type=float,
+                        default=0.1,
+                        help="@机器人的消息比例")
+    parser.add_argument('--question-ratio',
+                        type=float,
+                        default=0.2,
+                        help="问题消息的比例")
+    parser.add_argument('--llm-latency',
+                        type=float,
+                        default=0.5,
+                        help="桩LLM服务器的平均延迟（秒）")
+    parser.add_argument('--llm-jitter',
+                        type=float,
+                        default=0.2,
+                        help="桩LLM服务器延迟的随机波动（秒）")
+    parser.add_argument('--llm-error-rate',
+                        type=float,
+                        default=0,
+                        help="桩LLM服务器返回HTTP 500的比例")
+    parser.add_argument('--backup-llm-latency',
+                        type=float,
+                        help="再启动一个延迟不同的桩服务器，两者通过 LLM_ENDPOINTS 路由")
+    parser.add_argument('--sample-interval',
+                        type=float,
+                        default=5,
+                        help="采样内存和文件大小的间隔（秒）")
+    parser.add_argument('--drain',
+                        type=float,
+                        default=30,
+                        help="发送结束后等待未完成回复的最长秒数")
+    parser.add_argument('--profiles',
+                        type=int,
+                        help="只比较N个用户资料在旧版字典和 UserProfile 下的内存与JSON大小")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workdir', help="存档文件目录，默认使用临时目录")
+    parser.add_argument('--json', help="把结果写入JSON文件")
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def zipf_weights(n, skew):
+    return [1 / (i + 1)**skew for i in range(n)]
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+# 准备环境：必须在导入 main 之前完成，main 在导入时读取配置
+args = parse_args()
+random.seed(args.seed)
+if args.json:
+    args.json = os.path.abspath(args.json)
+workdir = args.workdir or tempfile.mkdtemp(prefix='bot-bench-')
+os.makedirs(workdir, exist_ok=True)
+LLM_PORT = free_port()
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{LLM_PORT}/v1'
+BACKUP_LLM_PORT = None
+if args.backup_llm_latency is not None:
+    BACKUP_LLM_PORT = free_port()
+    os.environ['LLM_ENDPOINTS'] = (f'http://127.0.0.1:{LLM_PORT}/v1,'
+                                   f'http://127.0.0.1:{BACKUP_LLM_PORT}/v1')
+os.environ['GOOGLE_API_KEY'] = ''
+os.environ['GOOGLE_CX'] = ''
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(workdir)
+
+import main  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+MAIN_FILE = os.path.abspath(main.__file__)
+
+
+# 桩LLM服务器
+class StubLLMServer:
+    """OpenAI兼容的 /v1/chat/completions，按设定的延迟返回固定格式的回复"""
+
+    def __init__(self, port, latency, jitter, error_rate=0):
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', self.port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def handle(self, request):
+        body = await request.json()
+        self.requests += 1
+        delay = max(0.0,
+                    self.latency + random.uniform(-self.jitter, self.jitter))
+        if random.random() < self.error_rate:
+            return web.json_response(
+                {'error': {
+                    'message': 'stub error',
+                    'type': 'server_error'
+                }},
+                status=500)
+        prompt = body['messages'][-1]['content']
+        reply = f"收到～关于「{prompt[:20]}」，我觉得挺有意思的。"
+
+        if body.get('stream'):
+            response = web.StreamResponse(
+                headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            chunks = [reply[i:i + 8] for i in range(0, len(reply), 8)]
+            for chunk in chunks:
+                await asyncio.sleep(delay / len(chunks))
+                data = {
+                    'id': 'bench',
+                    'object': 'chat.completion.chunk',
+                    'created': int(time.time()),
+                    'model': body.get('model'),
+                    'choices': [{
+                        'index': 0,
+                        'delta': {
+                            'content': chunk
+                        },
+                        'finish_reason': None
+                    }]
+                }
+                await response.write(
+                    f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode(
+                    ))
+            await response.write(b"data: [DONE]\n\n")
+            return response
+
+        await asyncio.sleep(delay)
+        prompt_tokens = sum(
+            len(message.get('content') or '') for message in body['messages'])
+        return web.json_response({
+            'id': 'bench',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model'),
+            'choices': [{
+                'index': 0,
+                'message': {
+                    'role': 'assistant',
+                    'content': reply
+                },
+                'finish_reason': 'stop'
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': len(reply),
+                'total_tokens': prompt_tokens + len(reply)
+            }
+        })
+
+
+# 模拟的Discord对象（只实现 on_message / process_message 用到的部分）
+class FakeUser:
+
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.name = name
+
+    def mentioned_in(self, message):
+        return message.mention_everyone or any(
+            user.id == self.id for user in message.mentions)
+
+
+class FakeGuild:
+
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+
+
+class FakeTyping:
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSentMessage:
+
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+
+
+class FakeChannel:
+
+    def __init__(self, channel_id, guild, recorder):
+        self.id = channel_id
+        self.name = f"channel-{channel_id}"
+        self.guild = guild
+        self.recorder = recorder
+
+    def typing(self):
+        return FakeTyping()
+
+    async def send(self, content=None, **kwargs):
+        self.recorder.reply_sent()
+        return FakeSentMessage(self, content)
+
+
+class FakeMessage:
+
+    _ids = itertools.count(1)
+
+    def __init__(self, author, channel, content, mentions=()):
+        self.id = next(self._ids)
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.mentions = list(mentions)
+        self.mention_everyone = False
+
+    async def reply(self, content=None, **kwargs):
+        self.channel.recorder.reply_sent()
+        return FakeSentMessage(self.channel, content)
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class ReplyRecorder:
+    """记录从消息到达到第一条回复发出的延迟
+
+    每条消息在自己的任务里处理，到达时间放在ContextVar中，回复时取出。
+    """
+
+    def __init__(self):
+        self.current = contextvars.ContextVar('bench_message', default=None)
+        self.latencies = []
+
+    def message_arrived(self):
+        self.current.set({'arrived': time.perf_counter(), 'replied': False})
+
+    def reply_sent(self):
+        message = self.current.get()
+        # 流式回复会发多条消息，只算第一条
+        if message is not None and not message['replied']:
+            message['replied'] = True
+            self.latencies.append(time.perf_counter() - message['arrived'])
+
+
+# 合成消息
+CHATTER = [
+    "今天的游戏更新大家玩了吗", "晚上一起开黑吧", "这个电影真的挺好看的", "最近在学python，感觉还不错",
+    "有没有人推荐点好听的音乐", "刚下班，累死了", "周末有什么安排", "这个bug我调了一下午",
+    "我觉得人工智能以后会改变很多行业，不过现在还有很多问题需要解决，比如数据隐私和模型的可解释性",
+    "hello everyone", "哈哈哈哈", "discord的新功能挺方便的"
+]
+QUESTIONS = [
+    "有人知道最新的python版本是多少吗？", "机器学习应该从哪里开始学？", "今天有什么新闻？",
+    "这个游戏怎么通关？", "大家觉得哪部电影最好看？", "编程入门推荐什么语言?"
+]
+
+
+class LoadGenerator:
+
+    def __init__(self, args, bot_user, recorder):
+        self.args = args
+        self.bot_user = bot_user
+        self.recorder = recorder
+        guilds = [FakeGuild(900000 + i) for i in range(args.guilds)]
+        self.channels = [
+            FakeChannel(100000 + i, guilds[i % len(guilds)], recorder)
+            for i in range(args.channels)
+        ]
+        self.users = [
+            FakeUser(200000 + i, f"user{i}") for i in range(args.users)
+        ]
+        self.channel_weights = zipf_weights(len(self.channels), args.skew)
+        self.user_weights = zipf_weights(len(self.users), args.skew)
+
+    def make_message(self):
+        channel = random.choices(self.channels, self.channel_weights)[0]
+        author = random.choices(self.users, self.user_weights)[0]
+        roll = random.random()
+        mentions = ()
+        if roll < self.args.mention_ratio:
+            content = f"<@{self.bot_user.id}> {random.choice(CHATTER)}"
+            mentions = (self.bot_user, )
+        elif roll < self.args.mention_ratio + self.args.question_ratio:
+            content = random.choice(QUESTIONS)
+        else:
+            content = random.choice(CHATTER)
+        # 加一点随机内容，避免全部命中缓存
+        content = f"{content} #{random.randrange(10**6)}"
+        return FakeMessage(author, channel, content, mentions)
+
+
+# 测量
+async def monitor_loop_lag(samples, interval=0.05):
+    """定期睡眠，记录实际醒来时间比预期晚了多少"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+def memory_allocated():
+    """开始跟踪后分配、仍然存活的内存（字节）；开销小，可以在运行中采样"""
+    return tracemalloc.get_traced_memory()[0]
+
+
+def memory_allocated_by_main():
+    """其中由 main.py 分配的部分，近似 BotMemory 等状态的占用；需要拍快照，较慢"""
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(True, MAIN_FILE)])
+    return sum(stat.size for stat in snapshot.statistics('filename'))
+
+
+def save_file_size():
+    return directory_size(workdir)
+
+
+async def run():
+    servers = [
+        StubLLMServer(LLM_PORT, args.llm_latency, args.llm_jitter,
+                      args.llm_error_rate)
+    ]
+    if BACKUP_LLM_PORT is not None:
+        servers.append(
+            StubLLMServer(BACKUP_LLM_PORT, args.backup_llm_latency,
+                          args.llm_jitter))
+    for server in servers:
+        await server.start()
+
+    bot_user = FakeUser(1, "benchbot")
+    main.bot._connection.user = bot_user
+    await main.bot.setup_hook()
+    main.response_generator.matcher.set_bot_user(bot_user.id)
+    main.flush_journal.start()
+    # 和 on_ready 一样先预热延迟初始化的组件，避免首条消息时的导入耗时混进结果
+    await main.warm_up()
+    # 组件加载完再开始跟踪内存，只统计运行期间的增长
+    tracemalloc.start()
+
+    recorder = ReplyRecorder()
+    generator = LoadGenerator(args, bot_user, recorder)
+    lag_samples = []
+    lag_task = asyncio.create_task(monitor_loop_lag(lag_samples))
+    baseline_memory = memory_allocated()
+
+    tasks = set()
+    timeline = []
+    handled = 0
+
+    async def handle(message):
+        nonlocal handled
+        recorder.message_arrived()
+        try:
+            await main.on_message(message)
+        finally:
+            handled += 1
+
+    def sample(elapsed):
+        row = {
+            'elapsed': round(elapsed, 1),
+            'sent': sent,
+            'handled': handled,
+            'ingested': main.memory.ingest.applied,
+            'replies': len(recorder.latencies),
+            'memory_kb': round((memory_allocated() - baseline_memory) / 1024,
+                               1),
+            'files_kb': round(save_file_size() / 1024, 1),
+        }
+        timeline.append(row)
+        print("  ".join(f"{key}={value}" for key, value in row.items()))
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    next_sample = start + args.sample_interval
+    sent = 0
+    interval = 1 / args.rate
+    # 开环发送：按计划时间发，不等待上一条处理完
+    while loop.time() - start < args.duration:
+        target = start + sent * interval
+        delay = target - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(handle(generator.make_message()))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        sent += 1
+        if loop.time() >= next_sample:
+            sample(loop.time() - start)
+            next_sample += args.sample_interval
+    send_elapsed = loop.time() - start
+    ingested_while_sending = main.memory.ingest.applied
+
+    # 等待未完成的回复
+    if tasks:
+        await asyncio.wait(list(tasks), timeout=args.drain)
+    await main.memory.ingest.join()
+    total_elapsed = loop.time() - start
+    await main.memory.flush()
+    await main.memory.compact()
+    sample(total_elapsed)
+    main_memory = memory_allocated_by_main()
+
+    lag_task.cancel()
+    main.flush_journal.cancel()
+    for task in list(tasks):
+        task.cancel()
+    for server in servers:
+        await server.stop()
+    await main.search_client.close()
+
+    latencies = recorder.latencies
+    lag = lag_samples or [0.0]
+    return {
+        'config': vars(args),
+        'workdir': workdir,
+        'sent': sent,
+        'send_rate': round(sent / send_elapsed, 2),
+        'handled': handled,
+        'ingested': main.memory.ingest.applied,
+        'ingest_dropped': main.memory.ingest.dropped,
+        'ingest_rate': round(ingested_while_sending / send_elapsed, 2),
+        'replies': len(latencies),
+        'llm_requests': sum(server.requests for server in servers),
+        'llm_requests_by_server': [server.requests for server in servers],
+        'reply_latency': {
+            'p50': round(percentile(latencies, 50), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'mean': round(statistics.mean(latencies), 3) if latencies else 0.0
+        },
+        'loop_lag': {
+            'p50': round(percentile(lag, 50) * 1000, 2),
+            'p99': round(percentile(lag, 99) * 1000, 2),
+            'max': round(max(lag) * 1000, 2)
+        },
+        'memory_growth_kb': timeline[-1]['memory_kb'],
+        'memory_main_kb': round(main_memory / 1024, 1),
+        'save_files_kb': timeline[-1]['files_kb'],
+        'timeline': timeline
+    }
+
+
+# 用户资料内存对比
+def fresh(text):
+    """生成新的字符串对象（和从Discord或分词器得到的一样，没有驻留）"""
+    return ''.join(list(text))
+
+
+def build_legacy_profiles(events):
+    """按旧版 JsonMemoryStore 的方式维护用户资料字典"""
+    user_data = {}
+    last_interaction = {}
+    for user_id, username, content, timestamp, topics in events:
+        timestamp_iso = main.format_timestamp(timestamp)
+        if user_id not in user_data:
+            user_data[user_id] = {
+                'username': username,
+                'first_seen': timestamp_iso,
+                'interaction_count': 0,
+                'topics': [],
+                'sentiment': "neutral",
+                'last_message': "",
+            }
+        data = user_data[user_id]
+        data['interaction_count'] += 1
+        data['last_message'] = content
+        data['last_interaction'] = timestamp_iso
+        last_interaction[user_id] = timestamp_iso
+        data['sentiment'] = fresh('positive')
+        data['topics'].extend(topics)
+        data['topics'] = data['topics'][-20:]
+    return user_data, last_interaction
+
+
+def build_compact_profiles(events):
+    """按 UserProfile 维护用户资料"""
+    user_data = {}
+    for user_id, username, content, timestamp, topics in events:
+        profile = user_data.get(user_id)
+        if profile is None:
+            profile = user_data[user_id] = main.UserProfile(
+                username, first_seen=int(timestamp))
+        profile.record_message(username, content, timestamp)
+        profile.sentiment = sys.intern(fresh('positive'))
+        profile.add_topics(topics)
+    return user_data
+
+
+def profile_events(count, messages_per_user):
+    """模拟的消息事件，逐条生成，没被资料引用的字符串会随即释放"""
+    rng = random.Random(args.seed)
+    start = time.time() - 86400
+    for i in range(count * messages_per_user):
+        user = i % count
+        length = rng.choice((20, 40, 80, 400))
+        # 每条事件里的字符串都是新对象，和运行时一样
+        yield (fresh(str(10**17 + user)), fresh(f"user{user}"),
+               fresh('消息' * (length // 2)), start + i * 0.01,
+               [fresh(f"话题{rng.randrange(2000)}")
+                for _ in range(rng.choice((0, 0, 1, 2, 3)))])
+
+
+def measure(build, count, messages_per_user):
+    """构建资料后仍然占用的内存"""
+    tracemalloc.start()
+    result = build(profile_events(count, messages_per_user))
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def profile_benchmark(count, messages_per_user=30):
+    (legacy, last_interaction), legacy_size = measure(build_legacy_profiles,
+                                                      count, messages_per_user)
+    legacy_json = json_size(legacy, last_interaction)
+    del legacy, last_interaction
+
+    compact, compact_size = measure(build_compact_profiles, count,
+                                    messages_per_user)
+    compact_json = json_size(*main.JsonMemoryStore.serialize_users(compact))
+    return {
+        'profiles': count,
+        'messages_per_user': messages_per_user,
+        'legacy_kb': round(legacy_size / 1024, 1),
+        'compact_kb': round(compact_size / 1024, 1),
+        'legacy_json_kb': round(legacy_json / 1024, 1),
+        'compact_json_kb': round(compact_json / 1024, 1)
+    }
+
+
+def json_size(user_data, last_interaction):
+    """memory.json 中用户资料部分的字节数"""
+    text = json.dumps({
+        'user_data': user_data,
+        'last_interaction': last_interaction
+    },
+                      ensure_ascii=False,
+                      indent=2)
+    return len(text.encode('utf-8'))
+
+
+def print_profile_report(result):
+    print(f"用户资料: {result['profiles']} 个，每人 {result['messages_per_user']} 条消息")
+    print(f"内存: 旧版字典 {result['legacy_kb']} KB，"
+          f"UserProfile {result['compact_kb']} KB"
+          f"（{result['compact_kb'] / result['legacy_kb']:.0%}）")
+    print(f"JSON: 旧版 {result['legacy_json_kb']} KB，"
+          f"UserProfile {result['compact_json_kb']} KB"
+          f"（{result['compact_json_kb'] / result['legacy_json_kb']:.0%}）")
+
+
+def print_report(result):
+    latency = result['reply_latency']
+    lag = result['loop_lag']
+    print()
+    print(f"存档目录: {result['workdir']}")
+    print(f"发送消息: {result['sent']} 条（{result['send_rate']} 条/秒）")
+    print(f"入库消息: {result['ingested']} 条（{result['ingest_rate']} 条/秒），"
+          f"丢弃分析 {result['ingest_dropped']} 条")
+    print(f"回复: {result['replies']} 条，LLM请求 {result['llm_requests']} 次"
+          f"（各桩服务器: {result['llm_requests_by_server']}）")
+    print(f"回复延迟: p50 {latency['p50']}s  p95 {latency['p95']}s  "
+          f"p99 {latency['p99']}s  平均 {latency['mean']}s")
+    print(f"事件循环延迟: p50 {lag['p50']}ms  p99 {lag['p99']}ms  "
+          f"最大 {lag['max']}ms")
+    print(f"内存增长: {result['memory_growth_kb']} KB"
+          f"（main.py 分配 {result['memory_main_kb']} KB），"
+          f"存档文件: {result['save_files_kb']} KB")
+
+
+if __name__ == "__main__":
+    if args.profiles:
+        result = profile_benchmark(args.profiles)
+        print_profile_report(result)
+    else:
+        result = asyncio.run(run())
+        main.memory.close()
+        main.llm_cache.close()
+        print_report(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
@@ -3,15 +3,30 @@ from discord.ext import commands, tasks
 import random
 import json
 import os
+import sqlite3
 import asyncio
+import bisect
+import collections.abc
+import contextlib
+import contextvars
 import datetime
+import hashlib
+import heapq
+import io
+import itertools
 import re
 import logging
-import nltk
-import requests
-from nltk.sentiment import SentimentIntensityAnalyzer
-from collections import Counter, defaultdict
-from openai import AsyncOpenAI
+import math
+import numpy as np
+import aiohttp
+from aiohttp import web
+import threading
+import queue
+import time
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import subprocess
 import sys
 import traceback
 from dotenv import load_dotenv
@@ -19,25 +34,268 @@ from dotenv import load_dotenv
 # 加载环境变量
 load_dotenv()
 
-# 下载必要的NLTK数据
-try:
-    nltk.data.find('vader_lexicon')
-except LookupError:
-    nltk.download('vader_lexicon')
-    nltk.download('punkt')
-    nltk.download('punkt_tab')
-
 # 设置日志
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('discord_bot')
 
+
+# 启动耗时统计
+class StartupTimer:
+    """记录启动各阶段的耗时，连接成功并预热完成后输出一次"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []  # [(阶段, 秒)]
+        self.connect_started = None  # setup_hook 结束、开始连接网关的时间
+        self.warm_task = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.mark(name, start)
+
+    def mark(self, name, since):
+        self.phases.append((name, time.perf_counter() - since))
+
+    def report(self):
+        phases = "，".join(f"{name} {seconds:.2f}s"
+                          for name, seconds in self.phases)
+        logger.info(f"启动耗时：{phases}，"
+                    f"总计 {time.perf_counter() - self.started:.2f}s")
+
+
+startup_timer = StartupTimer()
+
+
+# 运行指标
+class Metric:
+
+    def __init__(self, name, help_text, callback=None):
+        self.name = name
+        self.help = help_text
+        self.callback = callback  # 渲染时取值的函数，用于已有的计数属性
+        self.values = {}  # 标签元组 -> 值
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+    @staticmethod
+    def _format_labels(key):
+        if not key:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in key) + '}'
+
+    def samples(self):
+        if self.callback is not None:
+            return [('', (), self.callback())]
+        return [('', key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"
+        ]
+        for suffix, key, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{self._format_labels(key)} {value}")
+        return lines
+
+
+class CounterMetric(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class GaugeMetric(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+
+class HistogramMetric(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help_text, buckets):
+        super().__init__(name, help_text)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # 各桶的计数（非累计）、总和、次数
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', key + (('le', bound), ),
+                                cumulative))
+            samples.append(('_sum', key, round(total, 6)))
+            samples.append(('_count', key, count))
+        return samples
+
+
+class MetricsRegistry:
+    """计数器、仪表和直方图，按Prometheus文本格式输出
+
+    记录只是字典操作，只有抓取时才格式化，不抓取时几乎没有开销。
+    """
+
+    LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+    FAST_BUCKETS = [0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05]
+    TOKEN_BUCKETS = [50, 100, 250, 500, 1000, 2000, 4000, 8000]
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, callback=None):
+        return self._register(CounterMetric(name, help_text, callback))
+
+    def gauge(self, name, help_text, callback=None):
+        return self._register(GaugeMetric(name, help_text, callback))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self._register(HistogramMetric(name, help_text, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+llm_request_seconds = metrics.histogram('bot_llm_request_seconds',
+                                        'ask_llm 从调用到返回的耗时')
+llm_tokens = metrics.histogram('bot_llm_tokens', 'LLM请求的token用量',
+                               MetricsRegistry.TOKEN_BUCKETS)
+search_seconds = metrics.histogram('bot_google_search_seconds',
+                                   'google_search 的耗时')
+interaction_seconds = metrics.histogram('bot_add_user_interaction_seconds',
+                                        'add_user_interaction 的耗时',
+                                        MetricsRegistry.FAST_BUCKETS)
+save_seconds = metrics.histogram('bot_memory_save_seconds', '记忆落盘和整理的耗时')
+loop_lag_seconds = metrics.gauge('bot_event_loop_lag_seconds', '事件循环的调度延迟')
+replies_total = metrics.counter('bot_replies_total', '按处理分支统计的回复数')
+llm_fallbacks_total = metrics.counter('bot_llm_fallbacks_total',
+                                      'LLM没有给出结果、改用备用回复的次数')
+llm_endpoint_requests = metrics.counter('bot_llm_endpoint_requests_total',
+                                        '按接口和结果统计的LLM请求数')
+llm_endpoint_latency = metrics.gauge('bot_llm_endpoint_latency_seconds',
+                                     '各LLM接口的EWMA延迟')
+llm_endpoint_open = metrics.gauge('bot_llm_endpoint_open',
+                                  '各LLM接口是否处于熔断状态')
+llm_hedges_total = metrics.counter('bot_llm_hedges_total',
+                                   '对冲请求的发出次数和胜负')
+answer_stage_seconds = metrics.histogram('bot_answer_stage_seconds',
+                                         'answer_question 各阶段的耗时')
+answer_results_total = metrics.counter('bot_answer_results_total',
+                                       '按采用的结果统计的提问回答数')
+
 # 机器人配置
 TOKEN = os.getenv('DISCORD_TOKEN')
 PREFIX = '!'
 MEMORY_FILE = 'memory.json'
 CONVERSATION_HISTORY_FILE = 'conversation_history.json'
+JOURNAL_FILE = 'memory_journal.jsonl'
+JOURNAL_FLUSH_INTERVAL = float(os.getenv('JOURNAL_FLUSH_INTERVAL', '1'))  # 秒
+MEMORY_BACKEND = os.getenv('MEMORY_BACKEND', 'json')  # json 或 sqlite
+CHANNEL_HISTORY_CAPACITY = int(os.getenv('CHANNEL_HISTORY_CAPACITY',
+                                         '100'))  # 每个频道保留的消息数
+CHANNEL_HISTORY_OVERRIDES = os.getenv('CHANNEL_HISTORY_OVERRIDES',
+                                      '')  # 例如 "频道ID:500,频道ID:50"
+SQLITE_DB_FILE = os.getenv('SQLITE_DB_FILE', 'memory.db')
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT',
+                                      '5'))  # 秒，多进程写入时等待锁的时间
+
+# 分片部署配置（由 --shards 启动器设置，也可以手动指定）
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0')) or None  # 不设置时不分片
+SHARD_IDS = [
+    int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',')
+    if shard_id.strip()
+] or None  # 本进程负责的分片，不设置时负责全部分片
+if SHARD_COUNT and MEMORY_BACKEND != 'sqlite':
+    logger.warning("分片模式下各进程需要共享记忆库，已改用SQLite后端")
+    MEMORY_BACKEND = 'sqlite'
+
+# 消息分析流水线配置
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', '2'))
+ANALYSIS_BATCH_SIZE = int(os.getenv('ANALYSIS_BATCH_SIZE', '32'))
+ANALYSIS_BATCH_WINDOW = float(os.getenv('ANALYSIS_BATCH_WINDOW',
+                                        '0.05'))  # 秒
+ANALYSIS_CACHE_SIZE = int(os.getenv('ANALYSIS_CACHE_SIZE', '1024'))
+
+# 消息入库队列配置
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '1000'))
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '1'))
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '32'))
+INGEST_OVERFLOW = os.getenv('INGEST_OVERFLOW',
+                            'drop_newest')  # drop_newest 或 drop_oldest
+
+# 热门话题索引配置
+TOPIC_INDEX_CAPACITY = int(os.getenv('TOPIC_INDEX_CAPACITY',
+                                     '200'))  # 每个群组最多跟踪的话题数
+TOPIC_HALF_LIFE = float(os.getenv('TOPIC_HALF_LIFE_HOURS',
+                                  '24')) * 3600  # 话题热度半衰期（秒）
+
+# 频道活跃度索引配置
+ACTIVITY_HALF_LIFE = float(os.getenv('ACTIVITY_HALF_LIFE_HOURS',
+                                     '1')) * 3600  # 消息频率的半衰期（秒）
+ACTIVITY_WINDOW = float(os.getenv('ACTIVITY_WINDOW_MINUTES',
+                                  '60')) * 60  # 统计发言人数的时间窗口（秒）
+# 每个分片进程只保存自己负责的群组
+ACTIVITY_STATE_KEY = 'channel_activity' + (':' + '-'.join(
+    map(str, SHARD_IDS)) if SHARD_IDS else '')
+
+# 群组统计配置
+STATS_TOP_K = int(os.getenv('STATS_TOP_K', '10'))  # 每个群组维护的活跃用户排行长度
+STATS_HOURLY_BUCKETS = int(os.getenv('STATS_HOURLY_BUCKETS',
+                                     '48'))  # 保留的小时汇总数
+STATS_DAILY_BUCKETS = int(os.getenv('STATS_DAILY_BUCKETS',
+                                    '30'))  # 保留的日汇总数
+STATS_CACHE_TTL = float(os.getenv('STATS_CACHE_TTL',
+                                  '60'))  # SQLite后端活跃用户排行的缓存时间（秒）
+
+# 历史消息检索索引配置
+RETRIEVAL_INDEX_DIR = os.getenv('RETRIEVAL_INDEX_DIR', 'retrieval_index')
+if SHARD_IDS:
+    # 检索索引是内存映射文件，不能多进程同时追加，每个进程使用自己的目录
+    RETRIEVAL_INDEX_DIR = os.path.join(
+        RETRIEVAL_INDEX_DIR, 'shards-' + '-'.join(map(str, SHARD_IDS)))
+RETRIEVAL_DIM = int(os.getenv('RETRIEVAL_DIM', '512'))  # 哈希特征维度
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', '3'))
+KNOWLEDGE_BASE_FILE = os.getenv('KNOWLEDGE_BASE_FILE',
+                                'knowledge_base.json')  # {"关键词": "内容"}
+RETRIEVAL_MIN_SCORE = float(os.getenv('RETRIEVAL_MIN_SCORE',
+                                      '0.15'))  # 余弦相似度下限
 
 # LLM配置
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")  # 替换为你的API密钥
@@ -45,244 +303,3529 @@ OPENAI_BASE_URL = os.getenv(
     "OPENAI_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
 LLM_MODEL = os.getenv("LLM_MODEL", "deepseek-v3")
 
+# 多接口路由配置
+LLM_ENDPOINTS = os.getenv(
+    "LLM_ENDPOINTS", "")  # 例如 "地址|模型|密钥环境变量名,地址|模型"，不设置时只用上面的接口
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"  # 超过p95延迟时向第二个接口发对冲请求
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY",
+                                      "1"))  # 秒，发出对冲请求前的最短等待
+LLM_LATENCY_ALPHA = float(os.getenv("LLM_LATENCY_ALPHA",
+                                    "0.2"))  # 延迟和错误率EWMA的平滑系数
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES",
+                                     "3"))  # 连续失败多少次后熔断
+LLM_EXPLORE_INTERVAL = float(os.getenv("LLM_EXPLORE_INTERVAL",
+                                       "60"))  # 秒，闲置超过这个时间的接口重新测一次延迟
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN",
+                                       "30"))  # 秒，熔断后多久放行试探请求
+
+# LLM回复缓存配置
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "3600"))  # 秒，0表示关闭缓存
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "512"))
+LLM_CACHE_NEAR_DUPLICATE = os.getenv("LLM_CACHE_NEAR_DUPLICATE",
+                                     "0") == "1"  # 按规范化文本匹配近似重复请求
+LLM_CACHE_FILE = os.getenv("LLM_CACHE_FILE", "llm_cache.db")  # 留空则只用内存缓存
+LLM_CACHE_DISK_ENTRIES = int(os.getenv("LLM_CACHE_DISK_ENTRIES", "10000"))
+
+# LLM调度配置
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "60"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "100000"))
+LLM_EXPECTED_COMPLETION_TOKENS = int(
+    os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", "256"))
+LLM_REPLY_DEADLINE = float(os.getenv("LLM_REPLY_DEADLINE", "30"))  # 秒，超时的回复不再发送
+
+# 上下文构建配置
+LLM_TOKENIZER = os.getenv("LLM_TOKENIZER", "approx")  # approx 或 tiktoken
+LLM_CONTEXT_TOKEN_BUDGET = int(os.getenv("LLM_CONTEXT_TOKEN_BUDGET",
+                                         "1200"))  # 上下文消息的token预算
+LLM_CONTEXT_MESSAGE_TOKENS = int(os.getenv("LLM_CONTEXT_MESSAGE_TOKENS",
+                                           "200"))  # 单条上下文消息的token上限
+LLM_CONTEXT_CANDIDATES = int(os.getenv("LLM_CONTEXT_CANDIDATES",
+                                       "30"))  # 参与挑选的最近消息数
+
+# 运行指标配置
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0 表示不开启HTTP指标端点
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '1'))  # 秒
+
+# 定期互动间隔
+PERIODIC_INTERACTION_HOURS = float(os.getenv('PERIODIC_INTERACTION_HOURS',
+                                             '3'))
+
+# 按群组并发执行定时任务和问候
+FANOUT_CONCURRENCY = int(os.getenv('FANOUT_CONCURRENCY', '10'))
+FANOUT_JITTER = float(os.getenv('FANOUT_JITTER',
+                                '5'))  # 秒，每个群组随机延迟，避免同时发送
+FANOUT_TIMEOUT = float(os.getenv('FANOUT_TIMEOUT', '60'))  # 秒，单个群组的超时
+
+# 频道对话摘要配置
+SUMMARY_EVERY_N = int(os.getenv("SUMMARY_EVERY_N", "20"))  # 每多少条新消息更新一次摘要
+SUMMARY_INTERVAL = float(os.getenv("SUMMARY_INTERVAL", "60"))  # 秒，后台检查间隔
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "200"))
+
+# 流式回复配置
+LLM_STREAMING = os.getenv("LLM_STREAMING", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL",
+                                       "1.2"))  # 秒，两次编辑消息的最小间隔
+DISCORD_MESSAGE_LIMIT = 2000
+
+# 个性化方式：prompt 把用户资料放进首次请求的系统提示；rewrite 为旧的二次改写
+PERSONALIZATION_MODE = os.getenv("PERSONALIZATION_MODE", "prompt")
+
 # Google搜索配置
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GOOGLE_CX = os.getenv("GOOGLE_CX")
+GOOGLE_SEARCH_URL = os.getenv("GOOGLE_SEARCH_URL",
+                              "https://www.googleapis.com/customsearch/v1")
+SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", "8"))  # 秒
+SEARCH_RETRIES = int(os.getenv("SEARCH_RETRIES", "2"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "600"))  # 秒
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256"))
+
+# 需要搜索的问题同时发起搜索回答和不带搜索的直接回答
+ANSWER_SPECULATIVE = os.getenv("ANSWER_SPECULATIVE", "1") == "1"
+ANSWER_SEARCH_GRACE = float(os.getenv("ANSWER_SEARCH_GRACE",
+                                      "1.5"))  # 秒，直接回答完成后继续等待搜索回答的时间
+
+
+class DiscordBot(commands.AutoShardedBot if SHARD_COUNT else commands.Bot):
+
+    metrics_runner = None
+    loop_lag_task = None
+
+    async def setup_hook(self):
+        # 在连接网关之前异步加载记忆和知识库，不阻塞导入
+        with startup_timer.phase("加载记忆"):
+            await memory.load_async()
+        with startup_timer.phase("加载知识库"):
+            await asyncio.to_thread(response_generator.load_knowledge_base)
+        self.loop_lag_task = asyncio.create_task(monitor_loop_lag())
+        if METRICS_PORT:
+            # 分片模式下每个进程使用不同的端口
+            port = METRICS_PORT + (SHARD_IDS[0] if SHARD_IDS else 0)
+            self.metrics_runner = await start_metrics_server(port)
+        startup_timer.connect_started = time.perf_counter()
+
+    async def close(self):
+        await search_client.close()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        await super().close()
+
 
 # 初始化机器人
 intents = discord.Intents.all()
 intents.members = True
 intents.message_content = True
-bot = commands.Bot(command_prefix=PREFIX, intents=intents)
+if SHARD_COUNT:
+    bot = DiscordBot(command_prefix=PREFIX,
+                     intents=intents,
+                     shard_count=SHARD_COUNT,
+                     shard_ids=SHARD_IDS)
+else:
+    bot = DiscordBot(command_prefix=PREFIX, intents=intents)
+
+# 延迟初始化的组件：导入和创建都比较慢，首次使用时（或连接后在后台预热时）再做
+_nltk_tools = None
+_nltk_lock = threading.Lock()
+_llm_client_lock = threading.Lock()
+
+NLTK_RESOURCES = [('sentiment/vader_lexicon.zip', 'vader_lexicon'),
+                  ('tokenizers/punkt', 'punkt'),
+                  ('tokenizers/punkt_tab', 'punkt_tab')]
+
+
+def get_nltk_tools():
+    """返回 (情感分析器, 分词函数)，首次调用时检查并下载缺失的NLTK数据"""
+    global _nltk_tools
+    if _nltk_tools is None:
+        with _nltk_lock:
+            if _nltk_tools is None:
+                with startup_timer.phase("加载NLTK"):
+                    import nltk
+                    from nltk.sentiment import SentimentIntensityAnalyzer
+
+                    # 下载缺失的NLTK数据
+                    for resource, package in NLTK_RESOURCES:
+                        try:
+                            nltk.data.find(resource)
+                        except LookupError:
+                            nltk.download(package)
+                    _nltk_tools = (SentimentIntensityAnalyzer(),
+                                   nltk.word_tokenize)
+    return _nltk_tools
+
+
+# 消息分析
+def analyze_text(text):
+    """情感分析和话题提取（CPU密集，在线程池中运行）"""
+    sia, word_tokenize = get_nltk_tools()
+    sentiment = sia.polarity_scores(text)
+    if sentiment['compound'] > 0.3:
+        sentiment_label = "positive"
+    elif sentiment['compound'] < -0.3:
+        sentiment_label = "negative"
+    else:
+        sentiment_label = "neutral"
 
-# 情感分析器
-sia = SentimentIntensityAnalyzer()
+    # 提取可能的话题
+    words = word_tokenize(text.lower())
+    nouns = [word for word in words if len(word) > 3]  # 简单假设长词可能是话题
 
-# 初始化OpenAI客户端
-a_client = AsyncOpenAI(api_key=OPENAI_API_KEY,
-                       base_url=OPENAI_BASE_URL).chat.completions
+    return {
+        'compound': sentiment['compound'],
+        'sentiment': sentiment_label,
+        'topics': nouns
+    }
 
 
-# 机器人状态和记忆
-class BotMemory:
+def analyze_batch(texts):
+    return [analyze_text(text) for text in texts]
+
+
+class MessageAnalyzer:
+    """消息分析流水线
+
+    消息排队后按批在线程池中分析，结果按消息内容缓存，
+    入库时的分析结果可以被 generate_comment 等后续步骤直接复用。
+    """
+
+    def __init__(self,
+                 workers=ANALYSIS_WORKERS,
+                 batch_size=ANALYSIS_BATCH_SIZE,
+                 batch_window=ANALYSIS_BATCH_WINDOW,
+                 cache_size=ANALYSIS_CACHE_SIZE):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # 消息内容 -> Future
+        self._queue = None
+        self._task = None
+        self._executor = None
+
+    def submit(self, text):
+        """提交一条消息，返回分析结果的Future；没有运行中的事件循环时抛出RuntimeError"""
+        loop = asyncio.get_running_loop()
+        future = self._cache.get(text)
+        if future is not None and not future.cancelled():
+            self._cache.move_to_end(text)
+            return future
+
+        future = loop.create_future()
+        self._cache[text] = future
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        self._queue.put_nowait((text, future))
+        return future
+
+    async def analyze(self, text):
+        """获取消息的分析结果（命中缓存时不重复计算）"""
+        return await asyncio.shield(self.submit(text))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='analysis')
+        while True:
+            batch = [await self._queue.get()]
+            # 在时间窗口内尽量凑满一批
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(
+                        self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
 
-    def __init__(self):
+            texts = [text for text, _ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor,
+                                                     analyze_batch, texts)
+            except Exception as e:
+                logger.error(f"分析消息时出错: {e}")
+                for text, future in batch:
+                    self._cache.pop(text, None)
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+message_analyzer = MessageAnalyzer()
+
+
+def write_file_atomic(path, text):
+    """先写临时文件再替换，避免写到一半崩溃导致文件损坏"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# 追加写日志
+class MemoryJournal:
+    """记忆变更的追加写日志
+
+    变更先进入内存缓冲区，由后台任务批量写入并fsync；定期压缩成快照后清空日志。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.seq = 0
+        self._pending = []
+        self._lock = None
+
+    @property
+    def lock(self):
+        # 延迟创建，确保绑定到机器人运行时的事件循环
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def append(self, record):
+        """追加一条变更记录（只写入缓冲区，不阻塞）"""
+        self.seq += 1
+        record['seq'] = self.seq
+        self._pending.append(json.dumps(record, ensure_ascii=False))
+        return self.seq
+
+    def _write(self, lines):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def flush(self):
+        """将缓冲区中的记录批量落盘"""
+        if not self._pending:
+            return
+        async with self.lock:
+            lines, self._pending = self._pending, []
+            if not lines:
+                return
+            try:
+                await asyncio.to_thread(self._write, lines)
+            except Exception as e:
+                logger.error(f"写入记忆日志时出错: {e}")
+                self._pending[:0] = lines
+
+    def flush_sync(self):
+        """同步落盘，用于退出时"""
+        lines, self._pending = self._pending, []
+        if lines:
+            try:
+                self._write(lines)
+            except Exception as e:
+                logger.error(f"写入记忆日志时出错: {e}")
+
+    async def compact(self, build_snapshot):
+        """把当前状态写成快照并清空日志
+
+        build_snapshot(seq) 在事件循环中调用，只复制一份一致的状态，返回一个函数；
+        该函数在线程中调用，序列化并返回 {文件路径: 文本}，按顺序写入。
+        """
+        async with self.lock:
+            seq = self.seq
+            # 缓冲区中的记录已经反映在快照里
+            discarded, self._pending = self._pending, []
+            try:
+                render = build_snapshot(seq)
+                await asyncio.to_thread(self._write_snapshot, render)
+            except Exception as e:
+                logger.error(f"压缩记忆日志时出错: {e}")
+                self._pending[:0] = discarded
+                return False
+        return True
+
+    def _write_snapshot(self, render):
+        for path, text in render().items():
+            write_file_atomic(path, text)
+        # 快照写入成功后才清空日志；中途崩溃时由 journal_seq 跳过旧记录
+        with open(self.path, 'w', encoding='utf-8'):
+            pass
+
+    def replay(self, after_seq=0):
+        """读取快照之后的日志记录"""
+        records = []
+        if not os.path.exists(self.path):
+            self.seq = max(self.seq, after_seq)
+            return records
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 崩溃时最后一行可能只写了一半
+                    logger.warning("记忆日志末尾有不完整的记录，已忽略")
+                    break
+                if record.get('seq', 0) > after_seq:
+                    records.append(record)
+        self.seq = max(self.seq, after_seq,
+                       records[-1]['seq'] if records else 0)
+        return records
+
+
+# 话题索引
+class DecayingTopicCounter:
+    """固定容量的话题计数：Space-Saving 淘汰 + 指数时间衰减
+
+    使用前向衰减，分数按 e^(λ·(t - landmark)) 累加，
+    衰减不需要逐条更新，分数的相对大小始终等价于衰减后的热度。
+    """
+
+    # 指数过大时重新选取基准时间，避免浮点溢出
+    MAX_EXPONENT = 50
+
+    def __init__(self, capacity, half_life, landmark=None):
+        self.capacity = capacity
+        self.decay = math.log(2) / half_life
+        self.landmark = time.time() if landmark is None else landmark
+        self.scores = {}  # 话题 -> 前向衰减分数
+        self._heap = []  # (分数, 话题) 的惰性小顶堆，用于找淘汰对象
+
+    def _rebuild_heap(self):
+        self._heap = [(score, topic) for topic, score in self.scores.items()]
+        heapq.heapify(self._heap)
+
+    def _rescale(self, timestamp):
+        factor = math.exp(-self.decay * (timestamp - self.landmark))
+        self.scores = {
+            topic: score * factor
+            for topic, score in self.scores.items()
+        }
+        self.landmark = timestamp
+        self._rebuild_heap()
+
+    def _pop_min(self):
+        # 跳过已经过时的堆条目
+        while self._heap:
+            score, topic = heapq.heappop(self._heap)
+            if self.scores.get(topic) == score:
+                del self.scores[topic]
+                return score
+        return 0
+
+    def add(self, topics, timestamp):
+        exponent = self.decay * (timestamp - self.landmark)
+        if exponent > self.MAX_EXPONENT:
+            self._rescale(timestamp)
+            exponent = 0
+        weight = math.exp(exponent)
+
+        for topic in topics:
+            score = self.scores.get(topic)
+            if score is None:
+                # 容量已满时替换分数最小的话题，并继承它的分数（Space-Saving）
+                score = self._pop_min() if len(
+                    self.scores) >= self.capacity else 0
+            score += weight
+            self.scores[topic] = score
+            heapq.heappush(self._heap, (score, topic))
+
+        if len(self._heap) > 4 * self.capacity:
+            self._rebuild_heap()
+
+    def top(self, limit=5):
+        """按衰减后热度返回前 limit 个话题；表大小固定，开销与总量无关"""
+        return [
+            topic for topic, _ in heapq.nlargest(
+                limit, self.scores.items(), key=lambda item: item[1])
+        ]
+
+    def to_dict(self):
+        """复制一份可以交给其他线程序列化的数据"""
+        return {'landmark': self.landmark, 'scores': dict(self.scores)}
+
+    @classmethod
+    def from_dict(cls, data, capacity, half_life):
+        counter = cls(capacity, half_life, data.get('landmark'))
+        scores = data.get('scores', {})
+        for topic in heapq.nlargest(capacity, scores, key=scores.get):
+            counter.scores[topic] = scores[topic]
+        counter._rebuild_heap()
+        return counter
+
+
+class TopicIndex:
+    """按群组（私聊按频道）划分的热门话题索引"""
+
+    def __init__(self,
+                 capacity=TOPIC_INDEX_CAPACITY,
+                 half_life=TOPIC_HALF_LIFE):
+        self.capacity = capacity
+        self.half_life = half_life
+        self.scopes = {}
+
+    def add(self, scope, topics, timestamp):
+        counter = self.scopes.get(scope)
+        if counter is None:
+            counter = self.scopes[scope] = DecayingTopicCounter(
+                self.capacity, self.half_life, timestamp)
+        counter.add(topics, timestamp)
+
+    def top(self, scope=None, limit=5):
+        if scope is not None:
+            counter = self.scopes.get(scope)
+            return counter.top(limit) if counter else []
+
+        # 不指定范围时合并所有群组，换算到同一时间再比较
+        now = time.time()
+        merged = Counter()
+        for counter in self.scopes.values():
+            factor = math.exp(-counter.decay * (now - counter.landmark))
+            for topic in counter.top(limit):
+                merged[topic] += counter.scores[topic] * factor
+        return [topic for topic, _ in merged.most_common(limit)]
+
+    def to_dict(self):
+        return {
+            scope: counter.to_dict()
+            for scope, counter in self.scopes.items()
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls()
+        for scope, counter_data in (data or {}).items():
+            index.scopes[scope] = DecayingTopicCounter.from_dict(
+                counter_data, index.capacity, index.half_life)
+        return index
+
+
+class ChannelActivity:
+    __slots__ = ('scope', 'last_message', 'weight', 'window', 'speakers')
+
+    def __init__(self, scope, last_message=0, weight=0, window=None,
+                 speakers=()):
+        self.scope = scope
+        self.last_message = last_message  # 最后一条消息的时间戳
+        self.weight = weight  # 前向衰减的消息计数
+        self.window = window  # 当前统计窗口编号
+        self.speakers = set(speakers)  # 当前窗口内的发言人
+
+
+class ChannelActivityIndex:
+    """按群组维护的频道活跃度索引
+
+    每条消息在入库时更新频道的最后发言时间、指数衰减的消息频率和当前窗口的发言人数。
+    消息频率同样使用前向衰减，同一群组内权重的大小顺序就是当前频率的顺序，
+    用每个群组一个惰性大顶堆即可在 O(log n) 内找到最活跃的频道。
+    """
+
+    MAX_EXPONENT = 50
+
+    def __init__(self,
+                 half_life=ACTIVITY_HALF_LIFE,
+                 window=ACTIVITY_WINDOW,
+                 landmark=None):
+        self.decay = math.log(2) / half_life
+        self.window = window
+        self.landmark = time.time() if landmark is None else landmark
+        self.channels = {}  # 频道 -> ChannelActivity
+        self._heaps = {}  # 群组 -> [(-权重, 频道)]
+
+    def _rebuild_heaps(self):
+        self._heaps = {}
+        for channel_id, activity in self.channels.items():
+            self._heaps.setdefault(activity.scope, []).append(
+                (-activity.weight, channel_id))
+        for heap in self._heaps.values():
+            heapq.heapify(heap)
+
+    def _rescale(self, timestamp):
+        factor = math.exp(-self.decay * (timestamp - self.landmark))
+        for activity in self.channels.values():
+            activity.weight *= factor
+        self.landmark = timestamp
+        self._rebuild_heaps()
+
+    def record(self, scope, channel_id, user_id, timestamp):
+        exponent = self.decay * (timestamp - self.landmark)
+        if exponent > self.MAX_EXPONENT:
+            self._rescale(timestamp)
+            exponent = 0
+
+        activity = self.channels.get(channel_id)
+        if activity is None:
+            activity = self.channels[channel_id] = ChannelActivity(scope)
+        activity.last_message = max(activity.last_message, timestamp)
+        activity.weight += math.exp(exponent)
+
+        window = int(timestamp // self.window)
+        if activity.window != window:
+            activity.window = window
+            activity.speakers = set()
+        activity.speakers.add(user_id)
+
+        heap = self._heaps.setdefault(scope, [])
+        heapq.heappush(heap, (-activity.weight, channel_id))
+        if len(heap) > 4 * len(self.channels) + 16:
+            self._rebuild_heaps()
+
+    def rate(self, channel_id, now=None):
+        """频道的衰减消息数（约等于最近一个半衰期内的消息数）"""
+        activity = self.channels.get(channel_id)
+        if activity is None:
+            return 0
+        now = time.time() if now is None else now
+        return activity.weight * math.exp(-self.decay * (now - self.landmark))
+
+    def unique_speakers(self, channel_id, now=None):
+        """当前窗口内的发言人数"""
+        activity = self.channels.get(channel_id)
+        now = time.time() if now is None else now
+        if activity is None or activity.window != int(now // self.window):
+            return 0
+        return len(activity.speakers)
+
+    def last_message(self, channel_id):
+        activity = self.channels.get(channel_id)
+        return activity.last_message if activity else 0
+
+    def most_active(self, scope, eligible, limit=3, since=None):
+        """返回群组中最活跃的几个频道（限于eligible中、且在since之后有消息的）"""
+        heap = self._heaps.get(scope)
+        if not heap:
+            return []
+
+        result = []
+        popped = []
+        while heap and len(result) < limit:
+            entry = heapq.heappop(heap)
+            weight, channel_id = entry
+            activity = self.channels[channel_id]
+            # 权重已经变化的是过时条目，直接丢弃
+            if -weight != activity.weight or activity.scope != scope:
+                continue
+            popped.append(entry)
+            if channel_id in eligible and (since is None or
+                                           activity.last_message >= since):
+                result.append(channel_id)
+        for entry in popped:
+            heapq.heappush(heap, entry)
+        return result
+
+    def to_dict(self):
+        return {
+            'landmark': self.landmark,
+            'channels': {
+                channel_id: [
+                    a.scope, a.last_message, a.weight, a.window,
+                    list(a.speakers)
+                ]
+                for channel_id, a in self.channels.items()
+            }
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if not data:
+            return cls()
+        index = cls(landmark=data['landmark'])
+        for channel_id, values in data['channels'].items():
+            index.channels[channel_id] = ChannelActivity(*values)
+        index._rebuild_heaps()
+        return index
+
+
+class GuildStats:
+    __slots__ = ('total', 'counts', 'top', 'hourly', 'daily')
+
+    def __init__(self, total=0, counts=None, hourly=(), daily=()):
+        self.total = total  # 总消息数
+        self.counts = counts or {}  # 用户 -> 消息数
+        self.top = []  # [(-消息数, 用户)]，升序即消息数降序
+        self.hourly = deque(map(list, hourly),
+                            maxlen=STATS_HOURLY_BUCKETS)  # [[小时编号, 消息数]]
+        self.daily = deque(map(list, daily),
+                           maxlen=STATS_DAILY_BUCKETS)  # [[日编号, 消息数]]
+
+
+class GuildStatsIndex:
+    """按群组增量维护的消息统计（JSON后端，随快照保存）
+
+    SQLite后端把同样的计数放在 guild_users、guild_totals 和 guild_buckets 表里。
+    每条消息入库时更新群组的总消息数、用户消息数、小时/日汇总和活跃用户排行。
+    用户消息数只增不减，排行只需保存前k名的有序列表：用户的计数加一后，
+    要么本来就在榜上（二分查找后移动位置），要么超过第k名挤进榜单，
+    查询排行和时间窗口内的消息数都不需要扫描历史。
+    """
+
+    def __init__(self, top_k=STATS_TOP_K):
+        self.top_k = top_k
+        self.guilds = {}  # 群组 -> GuildStats
+        self.names = {}  # 用户 -> 最近使用的用户名
+
+    @staticmethod
+    def _bump(buckets, bucket):
+        # 时间戳基本单调，迟到的消息计入最新的桶
+        if buckets and buckets[-1][0] >= bucket:
+            buckets[-1][1] += 1
+        else:
+            buckets.append([bucket, 1])
+
+    def _rebuild_top(self, stats):
+        stats.top = heapq.nsmallest(
+            self.top_k,
+            ((-count, user_id) for user_id, count in stats.counts.items()))
+
+    def record(self, scope, user_id, username, timestamp):
+        stats = self.guilds.get(scope)
+        if stats is None:
+            stats = self.guilds[scope] = GuildStats()
+        self.names[user_id] = username
+        stats.total += 1
+        self._bump(stats.hourly, int(timestamp // 3600))
+        self._bump(stats.daily, int(timestamp // 86400))
+
+        old = stats.counts.get(user_id, 0)
+        stats.counts[user_id] = old + 1
+        top = stats.top
+        entry = (-old, user_id)
+        i = bisect.bisect_left(top, entry)
+        if i < len(top) and top[i] == entry:
+            del top[i]
+        elif len(top) >= self.top_k and (-old - 1, user_id) > top[-1]:
+            return  # 仍然排不进前k名
+        bisect.insort(top, (-old - 1, user_id))
+        del top[self.top_k:]
+
+    def top_users(self, scope, limit=5):
+        """返回 [(user_id, 用户名, 消息数)]，按消息数降序"""
+        stats = self.guilds.get(scope)
+        if stats is None:
+            return []
+        return [(user_id, self.names.get(user_id, user_id), -count)
+                for count, user_id in stats.top[:limit]]
+
+    def totals(self, scope):
+        """返回 (用户数, 总消息数)"""
+        stats = self.guilds.get(scope)
+        if stats is None:
+            return 0, 0
+        return len(stats.counts), stats.total
+
+    @staticmethod
+    def window(hours):
+        """最近hours小时对应的 (汇总粒度秒数, 桶数)，超出小时汇总的范围时按天统计"""
+        if hours <= STATS_HOURLY_BUCKETS:
+            return 3600, hours
+        return 86400, math.ceil(hours / 24)
+
+    def recent_total(self, scope, hours=24, now=None):
+        """最近hours小时的消息数"""
+        width, count = self.window(hours)
+        if width == 3600:
+            return self.hourly_total(scope, count, now)
+        return self.daily_total(scope, count, now)
+
+    def hourly_total(self, scope, hours=24, now=None):
+        """最近hours个小时（含当前小时）的消息数"""
+        return self._window_total(scope, 'hourly', 3600, hours, now)
+
+    def daily_total(self, scope, days=7, now=None):
+        """最近days天（含当天，按UTC划分）的消息数"""
+        return self._window_total(scope, 'daily', 86400, days, now)
+
+    def _window_total(self, scope, rollup, width, count, now):
+        stats = self.guilds.get(scope)
+        if stats is None:
+            return 0
+        now = time.time() if now is None else now
+        start = int(now // width) - count + 1
+        total = 0
+        for bucket, messages in reversed(getattr(stats, rollup)):
+            if bucket < start:
+                break
+            total += messages
+        return total
+
+    def to_dict(self):
+        """复制一份可以交给其他线程序列化的数据"""
+        return {
+            'names': dict(self.names),
+            'guilds': {
+                scope: [
+                    s.total,
+                    dict(s.counts),
+                    [bucket[:] for bucket in s.hourly],
+                    [bucket[:] for bucket in s.daily]
+                ]
+                for scope, s in self.guilds.items()
+            }
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls()
+        if not data:
+            return index
+        index.names = data['names']
+        for scope, values in data['guilds'].items():
+            stats = index.guilds[scope] = GuildStats(*values)
+            index._rebuild_top(stats)
+        return index
+
+
+# 对话历史
+def parse_timestamp(value):
+    """把ISO字符串或数字时间戳统一成epoch秒"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def format_timestamp(value):
+    """epoch秒转ISO字符串（持久化格式）"""
+    return datetime.datetime.fromtimestamp(value).isoformat()
+
+
+class HistoryMessage:
+    """紧凑的历史消息记录，timestamp 为epoch秒"""
+
+    __slots__ = ('user_id', 'username', 'content', 'timestamp')
+
+    def __init__(self, user_id, username, content, timestamp):
+        self.user_id = user_id
+        self.username = username
+        self.content = content
+        self.timestamp = timestamp
+
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'username': self.username,
+            'content': self.content,
+            'timestamp': format_timestamp(self.timestamp)
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('user_id', ''), data.get('username', 'User'),
+                   data.get('content', ''),
+                   parse_timestamp(data.get('timestamp')))
+
+
+class HistoryView(collections.abc.Sequence):
+    """环形缓冲区上的只读窗口，不复制消息
+
+    按绝对序号定位，之后追加的消息不会让窗口内容错位；
+    只有窗口里的消息被覆盖（追加超过容量）后才会读到更新的消息。
+    """
+
+    __slots__ = ('_history', '_start', '_length')
+
+    def __init__(self, history, start, length):
+        self._history = history
+        self._start = start
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return HistoryView(self._history, self._start + start,
+                               max(stop - start, 0))
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('history view index out of range')
+        return self._history._slot(self._start + index)
+
+    def __iter__(self):
+        for i in range(self._length):
+            yield self._history._slot(self._start + i)
+
+
+class ChannelHistory:
+    """单个频道的固定容量环形缓冲区"""
+
+    __slots__ = ('capacity', '_buffer', '_count')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buffer = [None] * capacity
+        self._count = 0  # 累计追加的消息数（绝对序号）
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def _slot(self, position):
+        return self._buffer[position % self.capacity]
+
+    def append(self, message):
+        self._buffer[self._count % self.capacity] = message
+        self._count += 1
+
+    def last(self):
+        return self._slot(self._count - 1) if self._count else None
+
+    def window(self, limit=None):
+        """最近 limit 条消息的视图"""
+        size = len(self)
+        length = size if limit is None else min(limit, size)
+        return HistoryView(self, self._count - length, length)
+
+    def resize(self, capacity):
+        messages = list(self.window(capacity))
+        self.capacity = capacity
+        self._buffer = [None] * capacity
+        self._count = 0
+        for message in messages:
+            self.append(message)
+
+    def to_list(self):
+        return [message.to_dict() for message in self.window()]
+
+
+def parse_capacity_overrides(value):
+    """解析 "频道ID:容量,频道ID:容量" 形式的配置"""
+    overrides = {}
+    for item in value.split(','):
+        channel_id, _, capacity = item.strip().partition(':')
+        if channel_id and capacity.isdigit():
+            overrides[channel_id] = int(capacity)
+    return overrides
+
+
+class ConversationHistory:
+    """所有频道的对话历史，每个频道一个环形缓冲区，容量可以按频道配置"""
+
+    def __init__(self,
+                 default_capacity=CHANNEL_HISTORY_CAPACITY,
+                 overrides=None):
+        self.default_capacity = default_capacity
+        self.overrides = dict(
+            parse_capacity_overrides(CHANNEL_HISTORY_OVERRIDES)
+            if overrides is None else overrides)
+        self.channels = {}
+
+    def capacity_for(self, channel_id):
+        return self.overrides.get(channel_id, self.default_capacity)
+
+    def set_capacity(self, channel_id, capacity):
+        self.overrides[channel_id] = capacity
+        if channel_id in self.channels:
+            self.channels[channel_id].resize(capacity)
+
+    def channel(self, channel_id):
+        history = self.channels.get(channel_id)
+        if history is None:
+            history = self.channels[channel_id] = ChannelHistory(
+                self.capacity_for(channel_id))
+        return history
+
+    def append(self, channel_id, message):
+        self.channel(channel_id).append(message)
+
+    def window(self, channel_id, limit=10):
+        history = self.channels.get(channel_id)
+        return history.window(limit) if history else HistoryView(None, 0, 0)
+
+    def items(self):
+        return self.channels.items()
+
+    def to_dict(self):
+        return {
+            channel_id: history.to_list()
+            for channel_id, history in self.channels.items()
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        conversation = cls()
+        for channel_id, messages in data.items():
+            history = conversation.channel(channel_id)
+            for message in messages[-history.capacity:]:
+                history.append(HistoryMessage.from_dict(message))
+        return conversation
+
+
+# 用户资料
+class UserProfile:
+    """紧凑的用户资料记录
+
+    时间用epoch整数秒，用户名、情绪和话题字符串经过驻留，所有用户共享同一份；
+    话题是最多 MAX_TOPICS 项的元组（一个空deque就要七百多字节，比整条记录还大，
+    没有话题的用户共享同一个空元组）。序列化成和旧版相同的字典格式。
+    """
+
+    __slots__ = ('username', 'first_seen', 'last_interaction',
+                 'interaction_count', 'topics', 'sentiment', 'last_message')
+
+    MAX_TOPICS = 20  # 保留最近20个话题
+    MAX_MESSAGE_CHARS = 200  # 完整消息在对话历史里，这里只留开头
+
+    def __init__(self,
+                 username,
+                 first_seen=0,
+                 last_interaction=0,
+                 interaction_count=0,
+                 topics=(),
+                 sentiment="neutral",
+                 last_message=""):
+        self.username = sys.intern(username)
+        self.first_seen = first_seen
+        self.last_interaction = last_interaction
+        self.interaction_count = interaction_count
+        self.topics = tuple(map(sys.intern, topics))[-self.MAX_TOPICS:]
+        self.sentiment = sys.intern(sentiment)
+        self.last_message = last_message[:self.MAX_MESSAGE_CHARS]
+
+    def record_message(self, username, content, timestamp):
+        if username != self.username:
+            self.username = sys.intern(username)
+        self.interaction_count += 1
+        self.last_message = content[:self.MAX_MESSAGE_CHARS]
+        self.last_interaction = int(timestamp)
+
+    def copy(self):
+        """浅复制；字段都是不可变对象，副本可以交给其他线程序列化"""
+        profile = UserProfile.__new__(UserProfile)
+        for name in self.__slots__:
+            setattr(profile, name, getattr(self, name))
+        return profile
+
+    def add_topics(self, topics):
+        self.topics = (self.topics +
+                       tuple(map(sys.intern, topics)))[-self.MAX_TOPICS:]
+
+    def to_dict(self):
+        data = {
+            'username': self.username,
+            'first_seen': format_timestamp(self.first_seen),
+            'interaction_count': self.interaction_count,
+            'topics': list(self.topics),
+            'sentiment': self.sentiment,
+            'last_message': self.last_message,
+        }
+        if self.last_interaction:
+            data['last_interaction'] = format_timestamp(self.last_interaction)
+        return data
+
+    @classmethod
+    def from_dict(cls, data, last_interaction=None):
+        """从旧版字典格式读取，last_interaction 是旧版单独保存的最后交互时间"""
+        last_interaction = int(
+            parse_timestamp(data.get('last_interaction', last_interaction)))
+        # 缺少首次出现时间的旧记录用最后交互时间代替
+        first_seen = int(parse_timestamp(
+            data.get('first_seen'))) or last_interaction
+        return cls(data.get('username', ''),
+                   first_seen=first_seen,
+                   last_interaction=last_interaction,
+                   interaction_count=data.get('interaction_count', 0),
+                   topics=data.get('topics', ()),
+                   sentiment=data.get('sentiment') or "neutral",
+                   last_message=data.get('last_message', ''))
+
+
+# 记忆存储后端
+class MemoryStore:
+    """记忆存储后端接口，BotMemory 的所有读写都通过它完成
+
+    后端还要提供 activity（ChannelActivityIndex），随交互记录更新并和其他数据一起持久化。
+    """
+
+    def apply_interaction(self, record):
+        """记录一次用户交互（含对话历史）"""
+        raise NotImplementedError
+
+    def apply_analysis(self, record):
+        """写入消息的情感和话题分析结果"""
+        raise NotImplementedError
+
+    def get_state(self, key, default=None):
+        raise NotImplementedError
+
+    def set_state(self, key, value):
+        raise NotImplementedError
+
+    def get_user(self, user_id):
+        """返回用户资料字典，不存在时返回空字典"""
+        raise NotImplementedError
+
+    def get_channel_messages(self, channel_id, limit=10):
+        """按时间顺序返回频道最近的消息（HistoryMessage 序列）"""
+        raise NotImplementedError
+
+    def get_channel_ids(self):
+        """返回有历史消息的频道ID"""
+        raise NotImplementedError
+
+    def get_top_topics(self, limit=5, scope=None):
+        """返回群组最近的热门话题，scope为None时合并所有群组"""
+        raise NotImplementedError
+
+    def get_guild_top_users(self, scope, limit=5):
+        """返回群组中最活跃的用户 [(user_id, 用户名, 消息数)]，按消息数降序"""
+        raise NotImplementedError
+
+    def get_guild_totals(self, scope):
+        """返回群组的 (用户数, 总消息数)"""
+        raise NotImplementedError
+
+    def get_guild_message_count(self, scope, hours=24):
+        """返回群组最近hours小时的消息数"""
+        raise NotImplementedError
+
+    async def claim(self, key, interval):
+        """领取一个在interval秒内只能执行一次的任务，领取成功返回True
+
+        多个分片进程共享存储时，用来保证定时任务不会重复执行。
+        """
+        now = time.time()
+        if self.get_state(f"claim:{key}", 0) > now - interval:
+            return False
+        self.set_state(f"claim:{key}", now)
+        return True
+
+    async def flush(self):
+        """将尚未持久化的变更落盘"""
+
+    async def compact(self):
+        """定期整理存储"""
+
+    def close(self):
+        """退出前同步落盘"""
+
+
+class JsonMemoryStore(MemoryStore):
+    """内存字典 + JSON快照 + 追加写日志"""
+
+    def __init__(self,
+                 memory_file=MEMORY_FILE,
+                 history_file=CONVERSATION_HISTORY_FILE,
+                 journal_file=JOURNAL_FILE):
+        self.memory_file = memory_file
+        self.history_file = history_file
         self.user_data = {}
-        self.conversation_history = defaultdict(list)
-        self.group_interests = Counter()
+        self.conversation_history = ConversationHistory()
+        self.topic_index = TopicIndex()
+        self.guild_stats = GuildStatsIndex()
+        self.activity = ChannelActivityIndex()
         self.active_topics = {}
         self.bot_mood = "neutral"
-        self.last_interaction = {}
+        self.state = {}  # 其他状态，如频道摘要
+        self.journal = MemoryJournal(journal_file)
+        self.journal_seq = 0
         self.load_memory()
         self.load_conversation_history()
+        self.replay_journal()
 
     def load_memory(self):
-        if os.path.exists(MEMORY_FILE):
+        if os.path.exists(self.memory_file):
             try:
-                with open(MEMORY_FILE, 'r', encoding='utf-8') as f:
+                with open(self.memory_file, 'r', encoding='utf-8') as f:
                     data = json.load(f)
-                    self.user_data = data.get('user_data', {})
-                    self.group_interests = Counter(
-                        data.get('group_interests', {}))
+                    last_interaction = data.get('last_interaction', {})
+                    self.user_data = {
+                        user_id:
+                        UserProfile.from_dict(profile,
+                                              last_interaction.get(user_id))
+                        for user_id, profile in data.get('user_data',
+                                                         {}).items()
+                    }
+                    # 旧版的 group_interests 是全时段累计，不再沿用
+                    self.topic_index = TopicIndex.from_dict(
+                        data.get('topic_index'))
+                    self.guild_stats = GuildStatsIndex.from_dict(
+                        data.get('guild_stats'))
                     self.active_topics = data.get('active_topics', {})
                     self.bot_mood = data.get('bot_mood', "neutral")
-                    self.last_interaction = data.get('last_interaction', {})
+                    self.state = data.get('state', {})
+                    # 旧版把活跃度索引作为状态在整理时保存
+                    self.activity = ChannelActivityIndex.from_dict(
+                        data.get('channel_activity')
+                        or self.state.pop(ACTIVITY_STATE_KEY, None))
+                    self.journal_seq = data.get('journal_seq', 0)
                 logger.info("记忆数据已加载")
             except Exception as e:
                 logger.error(f"加载记忆数据时出错: {e}")
                 self.user_data = {}
-                self.group_interests = Counter()
+                self.topic_index = TopicIndex()
+                self.guild_stats = GuildStatsIndex()
+                self.activity = ChannelActivityIndex()
                 self.active_topics = {}
                 self.bot_mood = "neutral"
-                self.last_interaction = {}
+                self.state = {}
+                self.journal_seq = 0
+
+    @staticmethod
+    def serialize_users(profiles):
+        """把用户资料转成旧版格式，返回 (user_data, last_interaction)"""
+        user_data = {
+            user_id: profile.to_dict()
+            for user_id, profile in profiles.items()
+        }
+        last_interaction = {
+            user_id: data['last_interaction']
+            for user_id, data in user_data.items()
+            if 'last_interaction' in data
+        }
+        return user_data, last_interaction
+
+    def copy_state(self, journal_seq=None):
+        """复制一份一致的内存状态，供其他线程生成快照
+
+        用户资料的字段和历史消息都不可变，这里只复制引用，格式化留给 memory_snapshot。
+        """
+        return {
+            'user_data': {
+                user_id: profile.copy()
+                for user_id, profile in self.user_data.items()
+            },
+            'conversation_history': {
+                channel_id: list(history.window())
+                for channel_id, history in self.conversation_history.items()
+            },
+            'topic_index': self.topic_index.to_dict(),
+            'guild_stats': self.guild_stats.to_dict(),
+            'channel_activity': self.activity.to_dict(),
+            'active_topics': dict(self.active_topics),
+            'bot_mood': self.bot_mood,
+            'state': dict(self.state),
+            'journal_seq':
+            self.journal.seq if journal_seq is None else journal_seq
+        }
+
+    @classmethod
+    def memory_snapshot(cls, state):
+        """由 copy_state 的结果生成 memory.json 的内容"""
+        # 旧版单独保存的 last_interaction 由用户资料生成，继续写出以保持格式兼容
+        user_data, last_interaction = cls.serialize_users(state['user_data'])
+        return {
+            'user_data': user_data,
+            'topic_index': state['topic_index'],
+            'guild_stats': state['guild_stats'],
+            'channel_activity': state['channel_activity'],
+            'active_topics': state['active_topics'],
+            'bot_mood': state['bot_mood'],
+            'last_interaction': last_interaction,
+            'state': state['state'],
+            'journal_seq': state['journal_seq']
+        }
+
+    @staticmethod
+    def history_snapshot(state):
+        """由 copy_state 的结果生成 conversation_history.json 的内容"""
+        return {
+            channel_id: [message.to_dict() for message in messages]
+            for channel_id, messages in state['conversation_history'].items()
+        }
 
     def save_memory(self):
         try:
-            with open(MEMORY_FILE, 'w', encoding='utf-8') as f:
-                json.dump(
-                    {
-                        'user_data': self.user_data,
-                        'group_interests': dict(self.group_interests),
-                        'active_topics': self.active_topics,
-                        'bot_mood': self.bot_mood,
-                        'last_interaction': self.last_interaction
-                    },
-                    f,
-                    ensure_ascii=False,
-                    indent=2)
+            write_file_atomic(
+                self.memory_file,
+                json.dumps(self.memory_snapshot(self.copy_state()),
+                           ensure_ascii=False))
             logger.info("记忆数据已保存")
         except Exception as e:
             logger.error(f"保存记忆数据时出错: {e}")
 
     def load_conversation_history(self):
-        if os.path.exists(CONVERSATION_HISTORY_FILE):
+        if os.path.exists(self.history_file):
             try:
-                with open(CONVERSATION_HISTORY_FILE, 'r',
-                          encoding='utf-8') as f:
-                    self.conversation_history = defaultdict(list, json.load(f))
+                with open(self.history_file, 'r', encoding='utf-8') as f:
+                    self.conversation_history = ConversationHistory.from_dict(
+                        json.load(f))
                 logger.info("对话历史已加载")
             except Exception as e:
                 logger.error(f"加载对话历史时出错: {e}")
-                self.conversation_history = defaultdict(list)
+                self.conversation_history = ConversationHistory()
 
     def save_conversation_history(self):
         try:
-            with open(CONVERSATION_HISTORY_FILE, 'w', encoding='utf-8') as f:
-                json.dump(dict(self.conversation_history),
-                          f,
-                          ensure_ascii=False,
-                          indent=2)
+            write_file_atomic(
+                self.history_file,
+                json.dumps(self.conversation_history.to_dict(),
+                           ensure_ascii=False))
             logger.info("对话历史已保存")
         except Exception as e:
             logger.error(f"保存对话历史时出错: {e}")
 
-    def add_user_interaction(self, user_id, username, message_content,
-                             channel_id):
+    def replay_journal(self):
+        """加载快照后重放日志中尚未压缩的变更"""
+        records = self.journal.replay(self.journal_seq)
+        for record in records:
+            try:
+                self.apply_record(record, replaying=True)
+            except Exception as e:
+                logger.error(f"重放记忆日志时出错: {e}")
+        if records:
+            logger.info(f"已重放 {len(records)} 条记忆日志")
+
+    async def flush(self):
+        await self.journal.flush()
+
+    async def compact(self):
+        """把内存状态压缩成快照并清空日志"""
+
+        def build_snapshot(seq):
+            state = self.copy_state(seq)
+
+            def render():
+                # 先写对话历史，最后写带 journal_seq 的 memory.json
+                return {
+                    self.history_file:
+                    json.dumps(self.history_snapshot(state),
+                               ensure_ascii=False),
+                    self.memory_file:
+                    json.dumps(self.memory_snapshot(state), ensure_ascii=False)
+                }
+
+            return render
+
+        if await self.journal.compact(build_snapshot):
+            logger.info("记忆数据已保存")
+
+    def close(self):
+        self.journal.flush_sync()
+
+    def apply_record(self, record, replaying=False):
+        """将一条日志记录应用到内存状态"""
+        op = record.get('op')
+        if op == 'interaction':
+            self._apply_interaction(record, replaying)
+        elif op == 'analysis':
+            self._apply_analysis(record)
+        elif op == 'state':
+            self._set_state(record['key'], record['value'])
+
+    def apply_interaction(self, record):
+        # 变更先写入日志缓冲区，由后台任务落盘
+        self.journal.append(dict(record, op='interaction'))
+        self._apply_interaction(record)
+
+    def apply_analysis(self, record):
+        self.journal.append(dict(record, op='analysis'))
+        self._apply_analysis(record)
+
+    def get_state(self, key, default=None):
+        if key == 'bot_mood':
+            return self.bot_mood
+        if key == 'active_topics':
+            return self.active_topics
+        return self.state.get(key, default)
+
+    def set_state(self, key, value):
+        self.journal.append({'op': 'state', 'key': key, 'value': value})
+        self._set_state(key, value)
+
+    def _set_state(self, key, value):
+        if key == 'bot_mood':
+            self.bot_mood = value
+        elif key == 'active_topics':
+            self.active_topics = value
+        else:
+            self.state[key] = value
+
+    def _apply_interaction(self, record, replaying=False):
+        user_id = record['user_id']
+        username = record['username']
+        message_content = record['content']
+        timestamp = parse_timestamp(record['timestamp'])
+
         # 确保用户在数据库中
-        if user_id not in self.user_data:
-            self.user_data[user_id] = {
-                'username': username,
-                'first_seen': datetime.datetime.now().isoformat(),
-                'interaction_count': 0,
-                'topics': [],
-                'sentiment': "neutral",
-                'last_message': "",
-            }
+        profile = self.user_data.get(user_id)
+        if profile is None:
+            profile = self.user_data[user_id] = UserProfile(
+                username, first_seen=int(timestamp))
 
         # 更新用户数据
-        self.user_data[user_id]['interaction_count'] += 1
-        self.user_data[user_id]['last_message'] = message_content
-        self.user_data[user_id]['last_interaction'] = datetime.datetime.now(
-        ).isoformat()
-
-        # 分析消息情感
-        sentiment = sia.polarity_scores(message_content)
-        if sentiment['compound'] > 0.3:
-            self.user_data[user_id]['sentiment'] = "positive"
-        elif sentiment['compound'] < -0.3:
-            self.user_data[user_id]['sentiment'] = "negative"
-        else:
-            self.user_data[user_id]['sentiment'] = "neutral"
+        profile.record_message(username, message_content, timestamp)
+        if record.get('scope'):
+            self.guild_stats.record(record['scope'], user_id, username,
+                                    timestamp)
+            self.activity.record(record['scope'], record['channel_id'],
+                                 user_id, timestamp)
+
+        # 更新对话历史（环形缓冲区，超出容量自动覆盖最旧的消息）
+        history = self.conversation_history.channel(record['channel_id'])
+
+        # 快照写到一半崩溃时，对话历史可能已包含这条记录
+        last = history.last()
+        if not (replaying and last and last.timestamp >= timestamp):
+            history.append(
+                HistoryMessage(user_id, username, message_content, timestamp))
+
+    def _apply_analysis(self, record):
+        user_id = record['user_id']
+        nouns = record['topics']
+        profile = self.user_data.get(user_id)
+        if profile is None:
+            return
 
-        # 提取可能的话题
-        words = nltk.word_tokenize(message_content.lower())
-        nouns = [word for word in words if len(word) > 3]  # 简单假设长词可能是话题
+        profile.sentiment = sys.intern(record['sentiment'])
 
         # 更新用户话题
         if nouns:
-            if 'topics' not in self.user_data[user_id]:
-                self.user_data[user_id]['topics'] = []
-            self.user_data[user_id]['topics'].extend(nouns)
-            self.user_data[user_id]['topics'] = self.user_data[user_id][
-                'topics'][-20:]  # 保留最近20个话题
+            profile.add_topics(nouns)
 
             # 更新群组兴趣
-            self.group_interests.update(nouns)
-
-        # 更新对话历史
-        channel_key = str(channel_id)
-        if channel_key not in self.conversation_history:
-            self.conversation_history[channel_key] = []
-
-        self.conversation_history[channel_key].append({
-            'user_id':
-            user_id,
-            'username':
-            username,
-            'content':
-            message_content,
-            'timestamp':
-            datetime.datetime.now().isoformat()
+            self.topic_index.add(record['scope'], nouns, record['timestamp'])
+
+    def get_user(self, user_id):
+        profile = self.user_data.get(user_id)
+        return profile.to_dict() if profile else {}
+
+    def get_channel_messages(self, channel_id, limit=10):
+        return self.conversation_history.window(str(channel_id), limit)
+
+    def get_channel_ids(self):
+        return list(self.conversation_history.channels)
+
+    def get_top_topics(self, limit=5, scope=None):
+        return self.topic_index.top(scope, limit)
+
+    def get_guild_top_users(self, scope, limit=5):
+        return self.guild_stats.top_users(scope, limit)
+
+    def get_guild_totals(self, scope):
+        return self.guild_stats.totals(scope)
+
+    def get_guild_message_count(self, scope, hours=24):
+        return self.guild_stats.recent_total(scope, hours)
+
+
+class SqliteWriter:
+    """SQLite专用写线程
+
+    写操作在队列里排队，commit() 时在一个 BEGIN IMMEDIATE 事务里成批执行并提交，
+    写锁只在批量执行期间持有。每个操作包在 SAVEPOINT 里，单个操作失败只回滚它自己；
+    拿不到写锁时整批保留到下次提交重试。
+    """
+
+    _COMMIT = object()
+    _STOP = object()
+
+    def __init__(self, path, timeout=SQLITE_BUSY_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run,
+                                        name='sqlite-writer',
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args):
+        """排队一个写操作 fn(conn, *args)，返回提交后得到其结果的 Future"""
+        future = Future()
+        self._queue.put((fn, args, future))
+        return future
+
+    def commit(self):
+        """提交之前排队的所有写操作，返回提交完成时完成的 Future"""
+        future = Future()
+        self._queue.put((self._COMMIT, (), future))
+        return future
+
+    def close(self):
+        """提交剩余的写操作并结束写线程"""
+        future = self.commit()
+        self._queue.put((self._STOP, (), None))
+        self._thread.join()
+        future.result()
+
+    def _run(self):
+        conn = sqlite3.connect(self.path,
+                               timeout=self.timeout,
+                               isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        batch = []
+        try:
+            while True:
+                fn, args, future = self._queue.get()
+                if fn is self._STOP:
+                    break
+                if fn is not self._COMMIT:
+                    batch.append((fn, args, future))
+                    continue
+                try:
+                    self._execute(conn, batch)
+                except Exception as e:
+                    _resolve(future, error=e)
+                    continue
+                batch = []
+                _resolve(future)
+        finally:
+            conn.close()
+            for _, _, future in batch:
+                _resolve(future, error=RuntimeError("SQLite写线程已关闭"))
+
+    @staticmethod
+    def _execute(conn, batch):
+        if not batch:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        results = []
+        try:
+            for fn, args, future in batch:
+                conn.execute("SAVEPOINT op")
+                try:
+                    results.append((future, fn(conn, *args), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    logger.error(f"SQLite写入出错: {e}")
+                    results.append((future, None, e))
+                conn.execute("RELEASE op")
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        for future, result, error in results:
+            _resolve(future, result, error)
+
+
+def _resolve(future, result=None, error=None):
+    """设置 concurrent.futures.Future 的结果，等待方已取消时忽略"""
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class SqliteMemoryStore(MemoryStore):
+    """SQLite存储（WAL模式），查询直接走数据库，内存占用不随群组数量增长"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            first_seen TEXT,
+            interaction_count INTEGER NOT NULL DEFAULT 0,
+            topics TEXT NOT NULL DEFAULT '[]',
+            sentiment TEXT NOT NULL DEFAULT 'neutral',
+            last_message TEXT NOT NULL DEFAULT '',
+            last_interaction TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_count
+            ON users (interaction_count);
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        );
+        DROP INDEX IF EXISTS idx_messages_channel;
+        CREATE INDEX IF NOT EXISTS idx_messages_channel_id
+            ON messages (channel_id, id);
+        CREATE INDEX IF NOT EXISTS idx_messages_user
+            ON messages (user_id, timestamp);
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS claims (
+            key TEXT PRIMARY KEY,
+            claimed_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS guild_users (
+            scope TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, user_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_guild_users_count
+            ON guild_users (scope, count);
+        CREATE TABLE IF NOT EXISTS guild_totals (
+            scope TEXT PRIMARY KEY,
+            users INTEGER NOT NULL DEFAULT 0,
+            messages INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS guild_buckets (
+            scope TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, width, bucket)
+        ) WITHOUT ROWID;
+    """
+    IMPORT_STATE_KEY = 'json_imported_at'
+
+    def __init__(self,
+                 path=SQLITE_DB_FILE,
+                 history_limit=CHANNEL_HISTORY_CAPACITY,
+                 shared=SHARD_COUNT is not None):
+        self.path = path
+        self.history_limit = history_limit
+        # 多个分片进程共享同一个数据库，写回话题索引时需要合并其他进程的群组
+        self.shared = shared
+        # 事件循环中的连接只读；写入全部交给写线程，由 flush 定期成批提交
+        self.conn = sqlite3.connect(path,
+                                    timeout=SQLITE_BUSY_TIMEOUT,
+                                    check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+        self.conn.commit()
+        self.writer = SqliteWriter(path)
+        # 已提交给写线程、尚未确认提交的变更，读取时叠加在查询结果上
+        self._seq = 0
+        self._pending_messages = deque()  # (序号, 频道, ISO时间, HistoryMessage)
+        self._pending_state = {}  # key -> (序号, value)
+        self._top_users_cache = {}  # 群组 -> (过期时间, 名次数, 排行)
+        # 话题索引大小固定，常驻内存，有变化时随 flush 写回
+        self.topic_index = TopicIndex.from_dict(self.get_state('topic_index'))
+        self._topic_index_dirty = False
+        # 活跃度索引同样常驻内存，每个分片进程只保存自己负责的群组
+        self.activity = ChannelActivityIndex.from_dict(
+            self.get_state(ACTIVITY_STATE_KEY))
+        self._activity_dirty = False
+        logger.info(f"SQLite记忆库已打开: {path}")
+
+    def apply_interaction(self, record):
+        user_id = record['user_id']
+        timestamp = parse_timestamp(record['timestamp'])
+        iso_timestamp = format_timestamp(timestamp)
+        self._seq += 1
+        self._pending_messages.append(
+            (self._seq, str(record['channel_id']), iso_timestamp,
+             HistoryMessage(user_id, record['username'], record['content'],
+                            timestamp)))
+        self.writer.submit(self._write_interaction, record, iso_timestamp)
+        if record.get('scope'):
+            self.activity.record(record['scope'], str(record['channel_id']),
+                                 user_id, timestamp)
+            self._activity_dirty = True
+
+    @staticmethod
+    def _write_interaction(conn, record, timestamp):
+        user_id = record['user_id']
+        conn.execute(
+            """
+            INSERT INTO users (user_id, username, first_seen,
+                               interaction_count, last_message,
+                               last_interaction)
+            VALUES (?, ?, ?, 1, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                interaction_count = interaction_count + 1,
+                last_message = excluded.last_message,
+                last_interaction = excluded.last_interaction
+            """, (user_id, record['username'], timestamp, record['content'],
+                  timestamp))
+
+        conn.execute(
+            """
+            INSERT INTO messages (channel_id, user_id, username, content,
+                                  timestamp)
+            VALUES (?, ?, ?, ?, ?)
+            """, (record['channel_id'], user_id, record['username'],
+                  record['content'], timestamp))
+
+        if record.get('scope'):
+            SqliteMemoryStore._write_guild_stats(
+                conn, record['scope'], user_id,
+                parse_timestamp(record['timestamp']))
+
+    @staticmethod
+    def _write_guild_stats(conn, scope, user_id, timestamp):
+        # 多个分片进程写同一个群组时计数也不会丢
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO guild_users (scope, user_id) VALUES (?, ?)",
+            (scope, user_id))
+        new_user = cursor.rowcount
+        conn.execute(
+            """
+            UPDATE guild_users SET count = count + 1
+            WHERE scope = ? AND user_id = ?
+            """, (scope, user_id))
+        conn.execute(
+            """
+            INSERT INTO guild_totals (scope, users, messages) VALUES (?, ?, 1)
+            ON CONFLICT (scope) DO UPDATE SET
+                users = users + excluded.users,
+                messages = messages + 1
+            """, (scope, new_user))
+        conn.executemany(
+            """
+            INSERT INTO guild_buckets (scope, width, bucket, count)
+            VALUES (?, ?, ?, 1)
+            ON CONFLICT (scope, width, bucket) DO UPDATE SET count = count + 1
+            """, [(scope, width, int(timestamp // width))
+                  for width in (3600, 86400)])
+
+    def apply_analysis(self, record):
+        if record['topics']:
+            self.topic_index.add(record['scope'], record['topics'],
+                                 record['timestamp'])
+            self._topic_index_dirty = True
+        self.writer.submit(self._write_analysis, record)
+
+    @staticmethod
+    def _write_analysis(conn, record):
+        # 读改写在写线程的 BEGIN IMMEDIATE 事务里完成，多进程并发时不会丢话题
+        user_id = record['user_id']
+        nouns = record['topics']
+
+        row = conn.execute("SELECT topics FROM users WHERE user_id = ?",
+                           (user_id, )).fetchone()
+        if row is None:
+            return
+        topics = json.loads(row['topics'])
+        if nouns:
+            topics = (topics + nouns)[-20:]  # 保留最近20个话题
+
+        conn.execute(
+            "UPDATE users SET sentiment = ?, topics = ? WHERE user_id = ?",
+            (record['sentiment'], json.dumps(topics,
+                                             ensure_ascii=False), user_id))
+
+    def get_state(self, key, default=None):
+        if key in self._pending_state:
+            return self._pending_state[key][1]
+        row = self.conn.execute("SELECT value FROM state WHERE key = ?",
+                                (key, )).fetchone()
+        return json.loads(row['value']) if row else default
+
+    def set_state(self, key, value):
+        self._seq += 1
+        self._pending_state[key] = (self._seq, value)
+        self.writer.submit(self._write_state, key,
+                           json.dumps(value, ensure_ascii=False))
+
+    @staticmethod
+    def _write_state(conn, key, text):
+        conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                     (key, text))
+
+    async def claim(self, key, interval):
+        future = self.writer.submit(self._write_claim, key, time.time(),
+                                    interval)
+        await self.flush()
+        return await asyncio.wrap_future(future)
+
+    @staticmethod
+    def _write_claim(conn, key, now, interval):
+        cursor = conn.execute(
+            """
+            INSERT INTO claims (key, claimed_at) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET claimed_at = excluded.claimed_at
+            WHERE claimed_at <= ?
+            """, (key, now, now - interval))
+        return cursor.rowcount > 0
+
+    def _save_topic_index(self):
+        """写回话题索引；共享模式下只覆盖本进程负责的群组"""
+        # to_dict 在事件循环中复制数据，写线程序列化的是这一刻的状态
+        self._topic_index_dirty = False
+        self.writer.submit(self._write_topic_index, self.topic_index.to_dict(),
+                           self.shared)
+
+    @classmethod
+    def _write_topic_index(cls, conn, data, merge):
+        if merge:
+            row = conn.execute(
+                "SELECT value FROM state WHERE key = 'topic_index'").fetchone()
+            if row:
+                data = {**json.loads(row['value']), **data}
+        cls._write_state(conn, 'topic_index',
+                         json.dumps(data, ensure_ascii=False))
+
+    @staticmethod
+    def _user_from_row(row):
+        data = dict(row)
+        data.pop('user_id', None)
+        data['topics'] = json.loads(data['topics'])
+        return data
+
+    def get_user(self, user_id):
+        row = self.conn.execute("SELECT * FROM users WHERE user_id = ?",
+                                (user_id, )).fetchone()
+        return self._user_from_row(row) if row else {}
+
+    def get_channel_messages(self, channel_id, limit=10):
+        channel_id = str(channel_id)
+        rows = self.conn.execute(
+            """
+            SELECT user_id, username, content, timestamp FROM messages
+            WHERE channel_id = ? ORDER BY id DESC LIMIT ?
+            """, (channel_id, limit)).fetchall()
+        committed = {(row['user_id'], row['timestamp']) for row in rows}
+        messages = [
+            HistoryMessage(row['user_id'], row['username'], row['content'],
+                           parse_timestamp(row['timestamp']))
+            for row in reversed(rows)
+        ]
+        # 写线程还没提交的消息排在最后；提交进行中时按 (用户, 时间) 去重
+        messages.extend(
+            message for _, pending_channel, timestamp, message in
+            self._pending_messages if pending_channel == channel_id
+            and (message.user_id, timestamp) not in committed)
+        return messages[max(len(messages) - limit, 0):]
+
+    def get_channel_ids(self):
+        channel_ids = [
+            row[0] for row in self.conn.execute(
+                "SELECT DISTINCT channel_id FROM messages")
+        ]
+        seen = set(channel_ids)
+        for _, channel_id, _, _ in self._pending_messages:
+            if channel_id not in seen:
+                seen.add(channel_id)
+                channel_ids.append(channel_id)
+        return channel_ids
+
+    def get_top_topics(self, limit=5, scope=None):
+        return self.topic_index.top(scope, limit)
+
+    def count_rows(self):
+        """返回 (用户数, 消息记录数)，用于迁移后的核对"""
+        users = self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        messages = self.conn.execute(
+            "SELECT COUNT(*) FROM messages").fetchone()[0]
+        return users, messages
+
+    def get_guild_top_users(self, scope, limit=5):
+        # 排行榜按索引倒序读取前k名，短时间内的重复查询直接用缓存
+        now = time.monotonic()
+        cached = self._top_users_cache.get(scope)
+        if cached is None or cached[0] < now or limit > cached[1]:
+            size = max(limit, STATS_TOP_K)
+            rows = self.conn.execute(
+                """
+                SELECT g.user_id, COALESCE(u.username, g.user_id), g.count
+                FROM guild_users g LEFT JOIN users u ON u.user_id = g.user_id
+                WHERE g.scope = ? ORDER BY g.count DESC LIMIT ?
+                """, (scope, size)).fetchall()
+            cached = (now + STATS_CACHE_TTL, size, [tuple(row) for row in rows])
+            self._top_users_cache = {
+                key: value
+                for key, value in self._top_users_cache.items()
+                if value[0] >= now
+            }
+            self._top_users_cache[scope] = cached
+        return cached[2][:limit]
+
+    def get_guild_totals(self, scope):
+        row = self.conn.execute(
+            "SELECT users, messages FROM guild_totals WHERE scope = ?",
+            (scope, )).fetchone()
+        return (row[0], row[1]) if row else (0, 0)
+
+    def get_guild_message_count(self, scope, hours=24):
+        width, count = GuildStatsIndex.window(hours)
+        start = int(time.time() // width) - count + 1
+        row = self.conn.execute(
+            """
+            SELECT COALESCE(SUM(count), 0) FROM guild_buckets
+            WHERE scope = ? AND width = ? AND bucket >= ?
+            """, (scope, width, start)).fetchone()
+        return row[0]
+
+    def _save_indexes(self):
+        """把有变化的内存索引排进写线程的下一批"""
+        if self._topic_index_dirty:
+            self._save_topic_index()
+        if self._activity_dirty:
+            self._activity_dirty = False
+            self.set_state(ACTIVITY_STATE_KEY, self.activity.to_dict())
+
+    async def flush(self):
+        self._save_indexes()
+        seq = self._seq
+        try:
+            await asyncio.wrap_future(self.writer.commit())
+        except Exception as e:
+            logger.error(f"提交SQLite事务时出错: {e}")
+            return
+        # 序号不大于 seq 的变更都已提交，数据库里已经能读到
+        while self._pending_messages and self._pending_messages[0][0] <= seq:
+            self._pending_messages.popleft()
+        for key in [
+                key for key, (key_seq, _) in self._pending_state.items()
+                if key_seq <= seq
+        ]:
+            del self._pending_state[key]
+
+    async def compact(self):
+        """裁剪每个频道超出上限的历史消息，并做一次WAL检查点"""
+        try:
+            self.writer.submit(self._trim_messages, self.history_limit)
+            now = time.time()
+            self.writer.submit(self._trim_guild_buckets,
+                               int(now // 3600) - STATS_HOURLY_BUCKETS,
+                               int(now // 86400) - STATS_DAILY_BUCKETS)
+            await self.flush()
+            await asyncio.to_thread(self._checkpoint)
+            logger.info("记忆数据已保存")
+        except Exception as e:
+            logger.error(f"整理SQLite记忆库时出错: {e}")
+
+    @staticmethod
+    def _trim_messages(conn, history_limit):
+        conn.execute(
+            """
+            DELETE FROM messages WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (
+                        PARTITION BY channel_id ORDER BY id DESC
+                    ) AS rn FROM messages
+                ) WHERE rn > ?
+            )
+            """, (history_limit, ))
+
+    @staticmethod
+    def _trim_guild_buckets(conn, hourly_start, daily_start):
+        conn.execute(
+            """
+            DELETE FROM guild_buckets
+            WHERE (width = 3600 AND bucket < ?) OR (width = 86400 AND bucket < ?)
+            """, (hourly_start, daily_start))
+
+    def _checkpoint(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        finally:
+            conn.close()
+
+    def close(self):
+        try:
+            self._save_indexes()
+            self.writer.close()
+            self.conn.close()
+        except Exception as e:
+            logger.error(f"关闭SQLite记忆库时出错: {e}")
+
+    def import_json_store(self, json_store):
+        """从JSON存储一次性导入全部数据，已导入过或库中已有数据时返回False"""
+        if (self.get_state(self.IMPORT_STATE_KEY)
+                or self.conn.execute("SELECT 1 FROM users LIMIT 1").fetchone()):
+            return False
+        users, _ = json_store.serialize_users(json_store.user_data)
+        self.topic_index = TopicIndex.from_dict(
+            json_store.topic_index.to_dict())
+        state = {
+            'topic_index': self.topic_index.to_dict(),
+            'bot_mood': json_store.bot_mood,
+            'active_topics': json_store.active_topics,
+            **json_store.state, self.IMPORT_STATE_KEY:
+            format_timestamp(time.time())
+        }
+        self.writer.submit(
+            self._write_import,
+            [(user_id, data['username'], data['first_seen'],
+              data['interaction_count'],
+              json.dumps(data['topics'], ensure_ascii=False),
+              data['sentiment'], data['last_message'],
+              data.get('last_interaction'))
+             for user_id, data in users.items()],
+            [(channel_id, msg.user_id, msg.username, msg.content,
+              format_timestamp(msg.timestamp)) for channel_id, history in
+             json_store.conversation_history.items()
+             for msg in history.window()], json_store.guild_stats.to_dict(),
+            state)
+        self.writer.commit().result()
+        return True
+
+    @classmethod
+    def _write_import(cls, conn, users, messages, guild_stats, state):
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO users (user_id, username, first_seen,
+                                          interaction_count, topics,
+                                          sentiment, last_message,
+                                          last_interaction)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, users)
+        conn.executemany(
+            """
+            INSERT INTO messages (channel_id, user_id, username, content,
+                                  timestamp)
+            VALUES (?, ?, ?, ?, ?)
+            """, messages)
+        for scope, (total, counts, hourly,
+                    daily) in guild_stats['guilds'].items():
+            conn.executemany(
+                "INSERT INTO guild_users (scope, user_id, count) "
+                "VALUES (?, ?, ?)",
+                [(scope, user_id, count) for user_id, count in counts.items()])
+            conn.execute("INSERT INTO guild_totals VALUES (?, ?, ?)",
+                         (scope, len(counts), total))
+            conn.executemany(
+                "INSERT INTO guild_buckets VALUES (?, ?, ?, ?)",
+                [(scope, 3600, bucket, count) for bucket, count in hourly] +
+                [(scope, 86400, bucket, count) for bucket, count in daily])
+        for key, value in state.items():
+            cls._write_state(conn, key, json.dumps(value, ensure_ascii=False))
+
+
+def migrate_json_to_sqlite(db_path=SQLITE_DB_FILE):
+    """一次性把 memory.json / conversation_history.json 迁移到SQLite"""
+    json_store = JsonMemoryStore()
+    sqlite_store = SqliteMemoryStore(db_path)
+    try:
+        if not sqlite_store.import_json_store(json_store):
+            logger.warning(f"{db_path} 中已有数据，跳过迁移")
+            return
+        users, messages = sqlite_store.count_rows()
+        logger.info(f"迁移完成: {users} 个用户, {messages} 条消息记录")
+    finally:
+        sqlite_store.close()
+
+
+def create_memory_store():
+    """根据配置创建存储后端"""
+    if MEMORY_BACKEND == 'sqlite':
+        return SqliteMemoryStore(SQLITE_DB_FILE)
+    return JsonMemoryStore()
+
+
+# 本地检索索引
+class HashingVectorizer:
+    """哈希TF特征：英文按单词，中文按单字和相邻两字，无需词表和模型"""
+
+    TOKEN_PATTERN = re.compile(r'[a-z0-9_]+|[\u4e00-\u9fff]+')
+
+    def __init__(self, dim=RETRIEVAL_DIM):
+        self.dim = dim
+
+    def features(self, text):
+        for run in self.TOKEN_PATTERN.findall(text.lower()):
+            if run[0] < '\u4e00':
+                yield run
+                continue
+            yield from run
+            for i in range(len(run) - 1):
+                yield run[i:i + 2]
+
+    def transform(self, text):
+        """返回单位长度的float32向量，没有可用特征时返回None"""
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self.features(text):
+            h = zlib.crc32(feature.encode('utf-8'))
+            # 低位选桶，最高位决定符号，减少哈希冲突带来的偏差
+            vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        vector = np.sign(vector) * np.log1p(np.abs(vector))
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return None
+        return vector / norm
+
+
+class RetrievalIndex:
+    """历史消息的哈希TF-IDF检索索引
+
+    向量、频道和时间戳分别存放在内存映射文件里，追加写入、重启后直接映射，
+    不需要重建；消息文本等元数据放在同目录的SQLite中。查询是一次矩阵向量乘法加top-k。
+    IDF在查询时按当前文档频率加权，所以插入时不需要回写旧向量。
+    """
+
+    INITIAL_CAPACITY = 4096
+
+    def __init__(self, path=RETRIEVAL_INDEX_DIR, dim=RETRIEVAL_DIM):
+        self.path = path
+        self.vectorizer = HashingVectorizer(dim)
+        # 只保护计数、文档频率和待写入行的交换，flush 的磁盘IO在锁外进行
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # 同一时间只有一个 flush
+        self._pending = {}  # 行号 -> 元数据，还没交给 flush 的新消息
+        self._writing = {}  # 正在由 flush 写入SQLite的行
+        os.makedirs(path, exist_ok=True)
+
+        # 查询在事件循环中用 self.conn，写入在 flush 的线程中用 self._write_conn
+        self.conn = sqlite3.connect(os.path.join(path, 'messages.db'),
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                row INTEGER PRIMARY KEY,
+                channel_id TEXT,
+                username TEXT,
+                content TEXT,
+                timestamp REAL
+            )""")
+        self.conn.commit()
+        self._write_conn = sqlite3.connect(os.path.join(path, 'messages.db'),
+                                           check_same_thread=False)
+        self.count = self.conn.execute(
+            "SELECT COALESCE(MAX(row) + 1, 0) FROM messages").fetchone()[0]
+
+        df_file = os.path.join(path, 'df.npy')
+        if os.path.exists(df_file):
+            self.df = np.load(df_file)
+        else:
+            self.df = np.zeros(dim, dtype=np.int64)
+
+        capacity = self.INITIAL_CAPACITY
+        while capacity < self.count:
+            capacity *= 2
+        self._map(capacity)
+
+    def _open_array(self, name, dtype, shape):
+        filename = os.path.join(self.path, name)
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if not os.path.exists(filename):
+            open(filename, 'wb').close()
+        if os.path.getsize(filename) < size:
+            with open(filename, 'r+b') as f:
+                f.truncate(size)
+        return np.memmap(filename, dtype=dtype, mode='r+', shape=shape)
+
+    def _map(self, capacity):
+        self.capacity = capacity
+        self.vectors = self._open_array('vectors.f32', np.float32,
+                                        (capacity, self.vectorizer.dim))
+        self.channels = self._open_array('channels.i64', np.int64,
+                                         (capacity, ))
+        self.timestamps = self._open_array('timestamps.f64', np.float64,
+                                           (capacity, ))
+
+    def add(self, channel_id, username, content, timestamp):
+        """追加一条消息"""
+        vector = self.vectorizer.transform(content)
+        if vector is None:
+            return
+
+        with self._lock:
+            if self.count >= self.capacity:
+                # 扩容很少发生；新旧映射共享同一文件的页缓存，已写入的行由下次 flush 落盘
+                self._map(self.capacity * 2)
+
+            row = self.count
+            self.vectors[row] = vector
+            self.channels[row] = int(channel_id)
+            self.timestamps[row] = timestamp
+            self.df[vector != 0] += 1
+            # 元数据由 flush 成批写入SQLite，之前的查询从这里读
+            self._pending[row] = (str(channel_id), username, content,
+                                  timestamp)
+            self.count += 1
+
+    def search(self, query, k=RETRIEVAL_TOP_K, channel_id=None, before=None):
+        """返回与query最相似的k条消息，可限定频道和时间（早于before）"""
+        vector = self.vectorizer.transform(query)
+        if vector is None or not self.count:
+            return []
+
+        n = self.count
+        idf = np.log((n + 1) / (self.df + 1)).astype(np.float32) + 1
+        weighted = vector * idf
+        weighted /= np.linalg.norm(weighted)
+
+        # 先按频道和时间筛出候选行，只对候选行做乘法
+        mask = None
+        if channel_id is not None:
+            mask = self.channels[:n] == int(channel_id)
+        if before is not None:
+            earlier = self.timestamps[:n] < before
+            mask = earlier if mask is None else mask & earlier
+        if mask is None:
+            rows = np.arange(n)
+            scores = self.vectors[:n] @ weighted
+        else:
+            rows = np.flatnonzero(mask)
+            scores = self.vectors[rows] @ weighted
+        if not len(rows):
+            return []
+
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        hits = {
+            int(rows[i]): float(scores[i])
+            for i in top if scores[i] >= RETRIEVAL_MIN_SCORE
+        }
+        if not hits:
+            return []
+
+        rows = self.conn.execute(
+            f"""SELECT row, username, content, timestamp FROM messages
+                WHERE row IN ({','.join('?' * len(hits))})""",
+            list(hits)).fetchall()
+        found = {row[0] for row in rows}
+        for row in hits:
+            if row not in found:
+                pending = self._pending.get(row) or self._writing.get(row)
+                if pending is not None:
+                    rows.append((row, *pending[1:]))
+        results = [{
+            'username': username,
+            'content': content,
+            'timestamp': timestamp,
+            'score': hits[row]
+        } for row, username, content, timestamp in rows]
+        results.sort(key=lambda r: r['score'], reverse=True)
+        return results
+
+    @property
+    def dirty(self):
+        """上次落盘后是否有新消息"""
+        return bool(self._pending)
+
+    def flush(self):
+        """落盘映射文件、文档频率和元数据，上次落盘后没有新消息时直接返回
+
+        可以在线程中调用：锁内只交换待写入的行并复制文档频率，
+        msync、np.save 和SQLite提交都在锁外进行，不阻塞事件循环中的 add。
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._writing, self._pending = self._pending, {}
+                df = self.df.copy()
+                arrays = (self.vectors, self.channels, self.timestamps)
+            for array in arrays:
+                array.flush()
+            np.save(os.path.join(self.path, 'df.npy'), df)
+            self._write_conn.executemany(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)",
+                [(row, *values) for row, values in self._writing.items()])
+            self._write_conn.commit()
+            self._writing = {}
+
+    def close(self):
+        self.flush()
+        self._write_conn.close()
+        self.conn.close()
+
+
+# 消息入库队列
+class IngestItem:
+    __slots__ = ('user_id', 'username', 'content', 'channel_id', 'scope',
+                 'timestamp', 'enqueued')
+
+    def __init__(self, user_id, username, content, channel_id, scope,
+                 timestamp):
+        self.user_id = user_id
+        self.username = username
+        self.content = content
+        self.channel_id = channel_id
+        self.scope = scope
+        self.timestamp = timestamp
+        self.enqueued = time.monotonic()
+
+
+class IngestQueue:
+    """有界的入库队列
+
+    消息历史在 on_message 中同步写入，不会丢；情感、话题、检索索引等分析类更新
+    放进这个队列，由后台任务成批处理。队列满时按 INGEST_OVERFLOW 丢弃最新或最旧的
+    分析任务，保证网关事件处理的耗时不随分析开销增长。
+    """
+
+    def __init__(self,
+                 apply_batch,
+                 maxsize=INGEST_QUEUE_SIZE,
+                 workers=INGEST_WORKERS,
+                 batch_size=INGEST_BATCH_SIZE,
+                 overflow=INGEST_OVERFLOW):
+        self.apply_batch = apply_batch  # async (items) -> None
+        self.maxsize = maxsize
+        self.workers = workers
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self._queue = None
+        self._tasks = []
+        self._interrupted = []  # 处理到一半被取消的批次
+        self.dropped = 0
+        self.applied = 0
+        self.lag = 0.0  # 最近一批从入队到处理完成的秒数
+
+    def put(self, item):
+        """入队，返回是否被接受；没有运行中的事件循环时抛出RuntimeError"""
+        loop = asyncio.get_running_loop()
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.maxsize)
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(loop.create_task(self._consume()))
+
+        if self._queue.full():
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning(f"入库队列已满，已丢弃 {self.dropped} 条分析任务")
+            if self.overflow != 'drop_oldest':
+                return False
+            self._queue.get_nowait()
+            self._queue.task_done()
+        self._queue.put_nowait(item)
+        return True
+
+    @property
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'lag': self.lag,
+            'dropped': self.dropped,
+            'applied': self.applied
+        }
+
+    async def _consume(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self.apply_batch(batch)
+                self.applied += len(batch)
+            except asyncio.CancelledError:
+                self._interrupted.extend(batch)
+                raise
+            except Exception as e:
+                logger.error(f"处理入库队列时出错: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            self.lag = time.monotonic() - batch[0].enqueued
+
+    async def join(self):
+        """等待队列中已有的任务处理完"""
+        if self._queue is not None:
+            await self._queue.join()
+
+    def drain(self):
+        """取出尚未处理的任务（关闭时同步处理）"""
+        items, self._interrupted = self._interrupted, []
+        while self._queue is not None and not self._queue.empty():
+            items.append(self._queue.get_nowait())
+            self._queue.task_done()
+        return items
+
+
+# 机器人状态和记忆
+class BotMemory:
+
+    def __init__(self, store=None, index=None, load=True):
+        self.store = store
+        self.index = index
+        self.activity = None
+        self.ingest = IngestQueue(self._apply_batch)
+        self.unsummarized = Counter()  # 频道 -> 上次摘要后的新消息数
+        if load:
+            self.load()
+
+    def load(self):
+        """打开存储后端和检索索引，加载活跃度索引"""
+        if self.store is None:
+            self.store = create_memory_store()
+        if self.index is None:
+            self.index = RetrievalIndex()
+        self.unsummarized = self._count_unsummarized()
+        # 活跃度索引由存储后端随交互记录更新和持久化
+        self.activity = self.store.activity
+
+    def _count_unsummarized(self):
+        """统计每个频道在摘要覆盖的最后一条消息之后的消息数，重启后接着摘要"""
+        counts = Counter()
+        for channel_id in self.store.get_channel_ids():
+            summary = self.store.get_state(f"summary:{channel_id}", {})
+            # 旧版摘要没有记录覆盖到哪条消息，按更新时间估计
+            through = summary.get('through', summary.get('updated', 0))
+            count = sum(1 for message in self.store.get_channel_messages(
+                channel_id, CHANNEL_HISTORY_CAPACITY)
+                        if message.timestamp > through)
+            if count:
+                counts[channel_id] = count
+        return counts
+
+    async def load_async(self):
+        """在线程中加载，不阻塞事件循环"""
+        await asyncio.to_thread(self.load)
+
+    @property
+    def loaded(self):
+        return self.activity is not None
+
+    @property
+    def bot_mood(self):
+        return self.store.get_state('bot_mood', "neutral")
+
+    def set_mood(self, mood):
+        """设置机器人心情"""
+        self.store.set_state('bot_mood', mood)
+
+    async def flush(self):
+        """将尚未持久化的变更落盘"""
+        with save_seconds.time(operation='flush'):
+            await self.store.flush()
+            if self.index.dirty:
+                # msync、np.save 和提交都可能等磁盘，放到线程中执行
+                await asyncio.to_thread(self.index.flush)
+
+    async def compact(self):
+        """定期整理存储（JSON后端会压缩成快照）"""
+        with save_seconds.time(operation='compact'):
+            await self.store.compact()
+
+    def close(self):
+        if not self.loaded:
+            return
+        for item in self.ingest.drain():
+            self._apply_item(item, analyze_text(item.content))
+        self.store.close()
+        self.index.close()
+
+    def add_user_interaction(self,
+                             user_id,
+                             username,
+                             message_content,
+                             channel_id,
+                             guild_id=None):
+        with interaction_seconds.time():
+            self._add_user_interaction(user_id, username, message_content,
+                                       channel_id, guild_id)
+
+    def _add_user_interaction(self, user_id, username, message_content,
+                              channel_id, guild_id):
+        # 话题按群组统计，私聊按频道统计
+        scope = str(guild_id) if guild_id else str(channel_id)
+        self.unsummarized[str(channel_id)] += 1
+        timestamp = time.time()
+        self.store.apply_interaction({
+            'user_id': user_id,
+            'username': username,
+            'content': message_content,
+            'channel_id': str(channel_id),
+            'scope': scope,
+            'timestamp': timestamp
+        })
+
+        # 检索索引和情感、话题分析交给入库队列，成批写入
+        item = IngestItem(user_id, username, message_content, str(channel_id),
+                          scope, timestamp)
+        try:
+            self.ingest.put(item)
+        except RuntimeError:
+            # 没有运行中的事件循环（如迁移脚本），直接同步处理
+            self._apply_item(item, analyze_text(message_content))
+
+    async def _apply_batch(self, items):
+        futures = [message_analyzer.submit(item.content) for item in items]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for item, analysis in zip(items, results):
+            if isinstance(analysis, BaseException):
+                analysis = None
+            self._apply_item(item, analysis)
+
+    def _apply_item(self, item, analysis):
+        self.index.add(item.channel_id, item.username, item.content,
+                       item.timestamp)
+        if analysis is None:
+            return
+        self.store.apply_analysis({
+            'user_id': item.user_id,
+            'scope': item.scope,
+            'timestamp': item.timestamp,
+            'sentiment': analysis['sentiment'],
+            'topics': analysis['topics']
         })
 
-        # 保持对话历史在合理大小
-        if len(self.conversation_history[channel_key]) > 100:
-            self.conversation_history[channel_key] = self.conversation_history[
-                channel_key][-100:]
+    def get_active_channels(self, scope, eligible, limit=3, since=None):
+        """群组中最活跃的频道ID，见 ChannelActivityIndex.most_active"""
+        return self.activity.most_active(scope, eligible, limit, since)
 
-        # 更新最后交互时间
-        self.last_interaction[user_id] = datetime.datetime.now().isoformat()
+    async def claim(self, key, interval):
+        """领取定时任务，见 MemoryStore.claim"""
+        return await self.store.claim(key, interval)
 
-        # 保存更新
-        self.save_memory()
-        self.save_conversation_history()
+    def get_channel_summary(self, channel_id):
+        """获取频道的对话摘要"""
+        return self.store.get_state(f"summary:{channel_id}", {}).get('summary')
 
-    def get_recent_topics(self, limit=5):
-        """获取最近的热门话题"""
-        return [
-            topic for topic, count in self.group_interests.most_common(limit)
-        ]
+    def set_channel_summary(self, channel_id, summary, through):
+        """保存频道摘要，through 是摘要覆盖到的最后一条消息的时间戳"""
+        self.store.set_state(f"summary:{channel_id}", {
+            'summary': summary,
+            'updated': time.time(),
+            'through': through
+        })
+
+    def search_history(self, query, channel_id, before=None):
+        """在频道的历史消息中检索与query相关的内容"""
+        start = time.perf_counter()
+        results = self.index.search(query,
+                                    channel_id=channel_id,
+                                    before=before)
+        logger.debug(f"历史检索耗时 {(time.perf_counter() - start) * 1000:.2f}ms, "
+                     f"命中 {len(results)} 条")
+        return results
+
+    def get_recent_topics(self, limit=5, scope=None):
+        """获取最近的热门话题（scope为群组ID，私聊为频道ID）"""
+        return self.store.get_top_topics(limit, scope)
 
     def get_user_info(self, user_id):
         """获取用户信息"""
-        return self.user_data.get(user_id, {})
+        return self.store.get_user(user_id)
 
     def get_channel_context(self, channel_id, limit=10):
         """获取频道最近的对话上下文"""
-        channel_key = str(channel_id)
-        if channel_key in self.conversation_history:
-            return self.conversation_history[channel_key][-limit:]
-        return []
+        return self.store.get_channel_messages(channel_id, limit)
+
+    def get_top_users(self, scope, limit=5):
+        """获取群组中最活跃的用户 [(user_id, 用户名, 消息数)]"""
+        return self.store.get_guild_top_users(scope, limit)
+
+    def get_totals(self, scope):
+        """获取群组的 (用户数, 总消息数)"""
+        return self.store.get_guild_totals(scope)
+
+    def get_recent_message_count(self, scope, hours=24):
+        """群组最近hours小时内的消息数"""
+        return self.store.get_guild_message_count(scope, hours)
 
 
 # 初始化机器人记忆
-memory = BotMemory()
+memory = BotMemory(load=False)  # 在 DiscordBot.setup_hook 中异步加载
+metrics.gauge('bot_ingest_queue_depth',
+              '入库队列中等待处理的消息数',
+              callback=lambda: memory.ingest.depth)
+metrics.gauge('bot_ingest_lag_seconds',
+              '最近一批消息从入队到处理完成的耗时',
+              callback=lambda: round(memory.ingest.lag, 6))
+metrics.counter('bot_ingest_dropped_total',
+                '入库队列满时丢弃的分析任务数',
+                callback=lambda: memory.ingest.dropped)
+metrics.counter('bot_ingest_applied_total',
+                '入库队列已处理的消息数',
+                callback=lambda: memory.ingest.applied)
+
+
+# LLM回复缓存
+class LLMResponseCache:
+    """LLM回复缓存：内存LRU + 磁盘（SQLite）两级，按 (模型, 消息) 的哈希命中"""
+
+    def __init__(self,
+                 ttl=LLM_CACHE_TTL,
+                 max_entries=LLM_CACHE_SIZE,
+                 near_duplicate=LLM_CACHE_NEAR_DUPLICATE,
+                 disk_path=LLM_CACHE_FILE,
+                 max_disk_entries=LLM_CACHE_DISK_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.near_duplicate = near_duplicate
+        self.disk_path = disk_path
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # 键 -> (过期时间, 回复)
+        self._conn = None
+        self._disk_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    @staticmethod
+    def normalize(text):
+        """去掉大小写、空白和标点差异"""
+        return re.sub(r'[\W_]+', '', text.lower())
+
+    def make_key(self, model, messages):
+        if self.near_duplicate:
+            messages = [{
+                'role': message['role'],
+                'content': self.normalize(message['content'])
+            } for message in messages]
+        return llm_request_key(model, messages)
+
+    def _open_disk(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.disk_path,
+                                         check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_llm_cache_expires "
+                "ON llm_cache (expires_at)")
+            self._conn.execute("DELETE FROM llm_cache WHERE expires_at < ?",
+                               (time.time(), ))
+            self._conn.commit()
+        return self._conn
+
+    def _disk_get(self, key):
+        with self._disk_lock:
+            row = self._open_disk().execute(
+                "SELECT response, expires_at FROM llm_cache WHERE key = ?",
+                (key, )).fetchone()
+        return row
+
+    def _disk_put(self, key, response, expires_at):
+        with self._disk_lock:
+            conn = self._open_disk()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response, expires_at) "
+                "VALUES (?, ?, ?)", (key, response, expires_at))
+            # 超出上限时淘汰最早过期的条目
+            conn.execute(
+                """
+                DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache ORDER BY expires_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+                """, (self.max_disk_entries, ))
+            conn.commit()
+
+    def _remember(self, key, response, expires_at):
+        self._entries[key] = (expires_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, model, messages):
+        """查询缓存，未命中时返回None"""
+        if not self.enabled:
+            return None
+        key = self.make_key(model, messages)
+        now = time.time()
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, response = entry
+            if expires_at >= now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return response
+            del self._entries[key]
+
+        if self.disk_path:
+            try:
+                row = await asyncio.to_thread(self._disk_get, key)
+            except Exception as e:
+                logger.error(f"读取LLM缓存时出错: {e}")
+                row = None
+            if row and row[1] >= now:
+                self._remember(key, row[0], row[1])
+                self.hits += 1
+                return row[0]
+
+        self.misses += 1
+        return None
+
+    async def put(self, model, messages, response):
+        if not self.enabled or not response:
+            return
+        key = self.make_key(model, messages)
+        expires_at = time.time() + self.ttl
+        self._remember(key, response, expires_at)
+        if self.disk_path:
+            try:
+                await asyncio.to_thread(self._disk_put, key, response,
+                                        expires_at)
+            except Exception as e:
+                logger.error(f"写入LLM缓存时出错: {e}")
+
+    def close(self):
+        with self._disk_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+llm_cache = LLMResponseCache()
+metrics.counter('bot_llm_cache_hits_total',
+                'LLM回复缓存命中次数',
+                callback=lambda: llm_cache.hits)
+metrics.counter('bot_llm_cache_misses_total',
+                'LLM回复缓存未命中次数',
+                callback=lambda: llm_cache.misses)
+
+
+def llm_request_key(model, messages):
+    """请求内容的哈希，用于缓存和合并相同请求"""
+    payload = json.dumps([model, messages], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# 分词计数
+class ApproxTokenizer:
+    """离线的近似token计数：中日韩文字每字约1个token，其他单词每4个字符约1个token"""
+
+    PIECE_PATTERN = re.compile(
+        r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]'
+        r'|[A-Za-z0-9_]+|[^\sA-Za-z0-9_]')
+
+    def _pieces(self, text):
+        for match in self.PIECE_PATTERN.finditer(text):
+            piece = match.group()
+            yield match.start(), max(1, (len(piece) + 3) // 4)
+
+    def count(self, text):
+        return sum(tokens for _, tokens in self._pieces(text))
+
+    def truncate(self, text, max_tokens):
+        total = 0
+        for start, tokens in self._pieces(text):
+            if total + tokens > max_tokens:
+                # 长单词按字符截断
+                return text[:start + (max_tokens - total) * 4]
+            total += tokens
+        return text
+
+
+class TiktokenTokenizer:
+    """基于tiktoken的精确计数（需要安装tiktoken）"""
+
+    def __init__(self, encoding_name="cl100k_base"):
+        import tiktoken
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+    def count(self, text):
+        return len(self.encoding.encode(text))
+
+    def truncate(self, text, max_tokens):
+        tokens = self.encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return self.encoding.decode(tokens[:max_tokens])
+
+
+def create_tokenizer(name=LLM_TOKENIZER):
+    if name == "tiktoken":
+        try:
+            return TiktokenTokenizer()
+        except Exception as e:
+            logger.warning(f"无法加载tiktoken，改用近似计数: {e}")
+    return ApproxTokenizer()
+
+
+tokenizer = create_tokenizer()
+
+
+def estimate_tokens(messages):
+    """估计请求的token数"""
+    return sum(tokenizer.count(message['content']) + 4 for message in messages)
+
+
+class ContextBuilder:
+    """在token预算内挑选最相关的近期消息作为LLM上下文
+
+    最新一条消息总会保留；其余按时间远近和与问题的词语重合度打分，
+    按分数依次放入预算，超长的消息会被截断，最后恢复时间顺序。
+    """
+
+    TRUNCATED_MARK = "…（已截断）"
+
+    def __init__(self,
+                 budget=LLM_CONTEXT_TOKEN_BUDGET,
+                 max_message_tokens=LLM_CONTEXT_MESSAGE_TOKENS):
+        self.budget = budget
+        self.max_message_tokens = max_message_tokens
+
+    @staticmethod
+    def _terms(text):
+        text = text.lower()
+        terms = set(re.findall(r'[a-z0-9_]{2,}', text))
+        # 中文按相邻两字切分
+        for run in re.findall(r'[\u4e00-\u9fff]+', text):
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+        return terms
+
+    def _format(self, message):
+        content = message.content
+        if tokenizer.count(content) > self.max_message_tokens:
+            content = tokenizer.truncate(
+                content, self.max_message_tokens) + self.TRUNCATED_MARK
+        return {
+            'role': 'user' if message.user_id != 'bot' else 'assistant',
+            'content': f"{message.username}: {content}"
+        }
+
+    def select(self, query, context):
+        """返回挑选出的上下文消息（已格式化，按时间顺序）"""
+        if not context:
+            return []
+
+        candidates = list(context)
+        query_terms = self._terms(query)
+        newest = len(candidates) - 1
+
+        def score(index):
+            recency = (index + 1) / len(candidates)
+            if not query_terms:
+                return recency
+            overlap = len(query_terms
+                          & self._terms(candidates[index].content)) / len(
+                              query_terms)
+            return recency + overlap
+
+        order = [newest] + sorted(range(newest), key=score, reverse=True)
+        chosen = {}
+        used = 0
+        for index in order:
+            formatted = self._format(candidates[index])
+            tokens = tokenizer.count(formatted['content']) + 4
+            if used + tokens > self.budget:
+                continue
+            chosen[index] = formatted
+            used += tokens
+
+        return [chosen[index] for index in sorted(chosen)]
+
+    def build(self, query, context=None, system_prompt=None):
+        messages = []
+
+        # 添加系统提示
+        if system_prompt:
+            messages.append({'role': 'system', 'content': system_prompt})
+
+        # 添加上下文
+        messages.extend(self.select(query, context))
+
+        # 添加当前问题
+        messages.append({'role': 'user', 'content': query})
+        return messages
+
+
+context_builder = ContextBuilder()
+
+
+# LLM请求调度
+PRIORITY_MENTION = 0  # 被@时的回复
+PRIORITY_NORMAL = 1  # 普通回复和命令
+PRIORITY_BACKGROUND = 2  # 定时互动等后台请求
+
+# 当前任务发起LLM请求时使用的 (优先级, 截止时间)
+llm_request_options = contextvars.ContextVar('llm_request_options',
+                                             default=(PRIORITY_NORMAL, None))
+
+
+def set_llm_request_options(priority, timeout=None):
+    """设置当前任务后续LLM请求的优先级和超时，返回截止时间"""
+    deadline = None
+    if timeout:
+        deadline = asyncio.get_running_loop().time() + timeout
+    llm_request_options.set((priority, deadline))
+    return deadline
+
+
+class TokenBucket:
+    """令牌桶限流，rate 为每分钟补充的令牌数"""
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount):
+        """还需要等待多少秒才有足够令牌"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        # 允许透支，实际用量超出预估时由后续请求等待补齐
+        self._refill()
+        self.tokens -= amount
+
+
+class LLMRequestExpired(Exception):
+    """请求在截止时间前没能完成"""
+
+
+class LLMScheduler:
+    """全局LLM请求调度：并发上限、请求数/令牌数限流、优先级、合并相同请求、截止时间"""
+
+    def __init__(self,
+                 max_concurrency=LLM_MAX_CONCURRENCY,
+                 requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=LLM_TOKENS_PER_MINUTE):
+        self.max_concurrency = max_concurrency
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self._queue = None
+        self._workers = []
+        self._inflight = {}  # 请求键 -> Future
+        self._waiters = Counter()  # Future -> 等待结果的调用方数
+        self._counter = itertools.count()
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._workers = [task for task in self._workers if not task.done()]
+        while len(self._workers) < self.max_concurrency:
+            self._workers.append(asyncio.create_task(self._worker()))
+
+    async def submit(self,
+                     key,
+                     call,
+                     priority=PRIORITY_NORMAL,
+                     deadline=None,
+                     tokens=0,
+                     interruptible=True):
+        """排队执行 call()，相同 key 的进行中请求会共享结果
+
+        call 是返回 (结果, 实际token数或None) 的协程函数。
+        超过截止时间时抛出 LLMRequestExpired；interruptible 为False时
+        截止时间只约束排队，开始执行后不再中断。所有调用方都被取消时，
+        排队中的请求直接丢弃，可中断的执行中请求也会被取消。
+        """
+        future = self._inflight.get(key)
+        if future is None:
+            self._ensure_workers()
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[key] = future
+            self._queue.put_nowait(
+                (priority, next(self._counter), deadline, tokens, call,
+                 future, key, interruptible))
+        self._waiters[future] += 1
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if self._waiters[future] == 1 and not future.done():
+                future.cancel()
+            raise
+        finally:
+            self._waiters[future] -= 1
+            if not self._waiters[future]:
+                del self._waiters[future]
+
+    async def _wait_for_capacity(self, tokens, deadline):
+        loop = asyncio.get_running_loop()
+        while True:
+            wait = max(self.request_bucket.delay(1),
+                       self.token_bucket.delay(tokens))
+            if wait <= 0:
+                break
+            if deadline is not None and loop.time() + wait > deadline:
+                raise LLMRequestExpired()
+            await asyncio.sleep(wait)
+        self.request_bucket.consume(1)
+        self.token_bucket.consume(tokens)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            _, _, deadline, tokens, call, future, key, interruptible = item
+            try:
+                if future.done():
+                    continue  # 调用方都已取消
+                if deadline is not None and loop.time() >= deadline:
+                    raise LLMRequestExpired()
+                await self._wait_for_capacity(tokens, deadline)
+                if future.done():
+                    continue
+
+                if not interruptible:
+                    result, used = await call()
+                else:
+                    task = asyncio.ensure_future(call())
+                    future.add_done_callback(
+                        lambda f, task=task: f.cancelled() and task.cancel())
+                    timeout = (None if deadline is None else
+                               deadline - loop.time())
+                    try:
+                        result, used = await asyncio.wait_for(task, timeout)
+                    except asyncio.TimeoutError:
+                        raise LLMRequestExpired()
+
+                # 用实际用量修正预估
+                if used:
+                    self.token_bucket.consume(used - tokens)
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # 工作协程本身被取消
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                    # 没有人等待时避免 "exception was never retrieved"
+                    future.exception()
+            finally:
+                if self._inflight.get(key) is future:
+                    del self._inflight[key]
+
+
+llm_scheduler = LLMScheduler()
+
+
+class LLMEndpointsUnavailable(Exception):
+    """所有LLM接口都在熔断中"""
+
+
+class LLMEndpoint:
+    """一个OpenAI兼容接口：客户端（首次使用时创建）和健康状态"""
+
+    LATENCY_SAMPLES = 100  # 用来估计p95的最近延迟样本数
+    MIN_SAMPLES = 10
+
+    def __init__(self,
+                 base_url,
+                 model,
+                 api_key,
+                 max_retries=2,
+                 alpha=LLM_LATENCY_ALPHA):
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.alpha = alpha
+        self.latency = None  # EWMA延迟（秒）
+        self.error_rate = 0.0  # EWMA错误率
+        self.samples = deque(maxlen=self.LATENCY_SAMPLES)
+        self.failures = 0  # 连续失败次数
+        self.open_until = 0  # 熔断到期时间（monotonic），0表示没有熔断
+        self.probing = False  # 熔断到期后是否已放行试探请求
+        self.last_attempt = 0  # 最近一次请求的时间（monotonic）
+        self._client = None
+
+    @property
+    def name(self):
+        return f"{self.model}@{self.base_url}"
+
+    @property
+    def client(self):
+        """AsyncOpenAI 的 chat.completions，首次使用时创建"""
+        if self._client is None:
+            with _llm_client_lock:
+                if self._client is None:
+                    with startup_timer.phase("创建LLM客户端"):
+                        from openai import AsyncOpenAI
+                        self._client = AsyncOpenAI(
+                            api_key=self.api_key,
+                            base_url=self.base_url,
+                            max_retries=self.max_retries).chat.completions
+        return self._client
+
+    def available(self, now):
+        """没有熔断，或熔断已到期且还没有试探请求"""
+        return now >= self.open_until and not self.probing
+
+    def expected_latency(self, now, explore_interval=LLM_EXPLORE_INTERVAL):
+        """排序用的预期延迟：失败的请求要重试，按错误率放大
+
+        没有样本或闲置太久的接口排最前，用一个请求重新测量，
+        避免一次偶然的慢请求让接口再也选不上。
+        """
+        if self.latency is None or now - self.last_attempt > explore_interval:
+            return 0.0
+        return self.latency / max(1 - self.error_rate, 0.05)
+
+    def p95(self):
+        if len(self.samples) < self.MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def record_latency(self, latency):
+        self.samples.append(latency)
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.alpha * (latency - self.latency)
+        llm_endpoint_latency.set(round(self.latency, 6), endpoint=self.name)
+
+    def record_censored(self, elapsed):
+        """请求被取消时只知道延迟不低于elapsed
+
+        只在它超过当前估计时把EWMA往上调，不加入p95样本，免得低估延迟。
+        """
+        if self.latency is not None and elapsed > self.latency:
+            self.latency += self.alpha * (elapsed - self.latency)
+            llm_endpoint_latency.set(round(self.latency, 6),
+                                     endpoint=self.name)
+
+    def record_success(self, latency=None):
+        if latency is not None:
+            self.record_latency(latency)
+        self.error_rate *= 1 - self.alpha
+        self.failures = 0
+        self.probing = False
+        if self.open_until:
+            self.open_until = 0
+            llm_endpoint_open.set(0, endpoint=self.name)
+            logger.info(f"LLM接口 {self.name} 已恢复")
+
+    def record_failure(self,
+                       failures=LLM_BREAKER_FAILURES,
+                       cooldown=LLM_BREAKER_COOLDOWN):
+        self.error_rate += self.alpha * (1 - self.error_rate)
+        self.failures += 1
+        self.probing = False
+        if self.failures >= failures:
+            self.open_until = time.monotonic() + cooldown
+            llm_endpoint_open.set(1, endpoint=self.name)
+            logger.warning(f"LLM接口 {self.name} 连续失败 {self.failures} 次，"
+                           f"熔断 {cooldown:.0f} 秒")
+
+
+def parse_llm_endpoints(value):
+    """解析 "地址|模型|密钥环境变量名,..." 形式的配置，模型和密钥可省略"""
+    entries = [entry.strip() for entry in value.split(',') if entry.strip()]
+    # 有多个接口时由路由器换接口重试，客户端自己不再重试
+    max_retries = 0 if len(entries) > 1 else 2
+    endpoints = []
+    for entry in entries:
+        base_url, model, key_name = (entry.split('|') + ['', ''])[:3]
+        endpoints.append(
+            LLMEndpoint(base_url.strip(),
+                        model.strip() or LLM_MODEL,
+                        os.getenv(key_name.strip()) if key_name.strip() else
+                        OPENAI_API_KEY,
+                        max_retries=max_retries))
+    return endpoints or [
+        LLMEndpoint(OPENAI_BASE_URL, LLM_MODEL, OPENAI_API_KEY)
+    ]
+
+
+class LLMRouter:
+    """在多个OpenAI兼容接口之间路由LLM请求
+
+    每个请求发给预期延迟最低的可用接口；超过该接口的p95延迟还没返回时，
+    向下一个接口发一个对冲请求，先成功的生效，另一个取消。请求失败时换下一个接口，
+    连续失败的接口熔断一段时间，到期后放行一个试探请求，成功才恢复。
+    """
+
+    def __init__(self,
+                 endpoints,
+                 hedge=LLM_HEDGE,
+                 hedge_min_delay=LLM_HEDGE_MIN_DELAY):
+        self.endpoints = endpoints
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        # 回复缓存和合并请求的键：请求可能由任意一个接口回答，键里包含所有接口的模型；
+        # 只有一个接口时就是它的模型名，与之前的缓存兼容
+        self.cache_model = '|'.join(sorted({e.model for e in endpoints}))
+
+    def warm_up(self):
+        for endpoint in self.endpoints:
+            endpoint.client
+
+    def ranked(self):
+        """按预期延迟排序的可用接口，全部熔断时为空"""
+        now = time.monotonic()
+        available = [e for e in self.endpoints if e.available(now)]
+        return sorted(available, key=lambda e: e.expected_latency(now))
+
+    async def _attempt(self, endpoint, messages, stream):
+        if endpoint.open_until:
+            endpoint.probing = True
+        endpoint.last_attempt = time.monotonic()
+        start = time.perf_counter()
+        try:
+            result = await endpoint.client.create(model=endpoint.model,
+                                                  messages=messages,
+                                                  stream=stream)
+        except asyncio.CancelledError:
+            # 被对冲请求抢先：已等待的时间只是这次延迟的下限
+            endpoint.probing = False
+            if not stream:
+                endpoint.record_censored(time.perf_counter() - start)
+            llm_endpoint_requests.inc(endpoint=endpoint.name,
+                                      result='cancelled')
+            raise
+        except Exception:
+            endpoint.record_failure()
+            llm_endpoint_requests.inc(endpoint=endpoint.name, result='error')
+            raise
+        # 流式请求返回时只收到了响应头，延迟没有可比性
+        endpoint.record_success(None if stream else time.perf_counter() -
+                                start)
+        llm_endpoint_requests.inc(endpoint=endpoint.name, result='ok')
+        return result
+
+    async def _hedged(self, primary, backup, messages, tried):
+        """先请求primary，超过其p95延迟还没返回时再请求backup"""
+        tasks = [
+            asyncio.create_task(self._attempt(primary, messages, False))
+        ]
+        try:
+            await asyncio.wait(tasks,
+                               timeout=max(self.hedge_min_delay,
+                                           primary.p95()))
+            if not tasks[0].done():
+                llm_hedges_total.inc(result='sent')
+                tried.add(backup)
+                tasks.append(
+                    asyncio.create_task(self._attempt(backup, messages,
+                                                      False)))
+            error = None
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if len(tasks) > 1:
+                            llm_hedges_total.inc(
+                                result='won' if task is tasks[1] else 'lost')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def create(self, messages, stream=False):
+        """发送 chat.completions 请求，所有接口都失败时抛出最后一个错误
+
+        所有接口都在熔断中时不发请求，直接抛出 LLMEndpointsUnavailable。
+        """
+        candidates = self.ranked()
+        if not candidates:
+            raise LLMEndpointsUnavailable("所有LLM接口都在熔断中")
+        tried = set()  # 已经请求过的接口（包括对冲请求），失败后不再重试
+        error = None
+        for i, endpoint in enumerate(candidates):
+            if endpoint in tried:
+                continue
+            tried.add(endpoint)
+            backup = next((e for e in candidates[i + 1:] if e not in tried),
+                          None)
+            try:
+                if (stream or not self.hedge or backup is None
+                        or endpoint.p95() is None):
+                    return await self._attempt(endpoint, messages, stream)
+                return await self._hedged(endpoint, backup, messages, tried)
+            except Exception as e:
+                error = e
+                logger.warning(f"LLM接口 {endpoint.name} 请求失败: {e}")
+        raise error
+
+
+llm_router = LLMRouter(parse_llm_endpoints(LLM_ENDPOINTS))
 
 
 # LLM集成
-async def ask_llm(query, context=None, system_prompt=None):
-    """使用LLM生成回复"""
-    messages = []
+def build_llm_messages(query, context=None, system_prompt=None):
+    """组装发送给LLM的消息列表，上下文按token预算挑选"""
+    return context_builder.build(query, context, system_prompt)
 
-    # 添加系统提示
-    if system_prompt:
-        messages.append({'role': 'system', 'content': system_prompt})
 
-    # 添加上下文
-    if context:
-        for message in context:
-            messages.append({
-                'role':
-                'user' if message.get('user_id') != 'bot' else 'assistant',
-                'content':
-                f"{message.get('username', 'User')}: {message.get('content', '')}"
-            })
+async def ask_llm(query, context=None, system_prompt=None, use_cache=True):
+    """使用LLM生成回复"""
+    start = time.perf_counter()
+    messages = build_llm_messages(query, context, system_prompt)
 
-    # 添加当前问题
-    messages.append({'role': 'user', 'content': query})
+    if use_cache:
+        cached = await llm_cache.get(llm_router.cache_model, messages)
+        if cached is not None:
+            llm_request_seconds.observe(time.perf_counter() - start,
+                                        result='cached')
+            return cached
 
-    try:
+    prompt_tokens = estimate_tokens(messages)
+
+    async def call():
         # 创建LLM请求
-        completion = await a_client.create(model=LLM_MODEL, messages=messages)
-        return completion.choices[0].message.content
+        completion = await llm_router.create(messages)
+        reply = completion.choices[0].message.content
+        if use_cache:
+            await llm_cache.put(llm_router.cache_model, messages, reply)
+        usage = getattr(completion, 'usage', None)
+        if usage is not None:
+            llm_tokens.observe(usage.prompt_tokens, kind='prompt')
+            llm_tokens.observe(usage.completion_tokens, kind='completion')
+        logger.info(
+            f"LLM请求用量: 提示 {getattr(usage, 'prompt_tokens', '?')} tokens"
+            f"（估计 {prompt_tokens}，上下文 {len(messages) - 1} 条），"
+            f"生成 {getattr(usage, 'completion_tokens', '?')} tokens")
+        return reply, getattr(usage, 'total_tokens', None)
+
+    priority, deadline = llm_request_options.get()
+    result = 'ok'
+    try:
+        return await llm_scheduler.submit(
+            llm_request_key(llm_router.cache_model, messages),
+            call,
+            priority=priority,
+            deadline=deadline,
+            tokens=prompt_tokens + LLM_EXPECTED_COMPLETION_TOKENS)
+    except asyncio.CancelledError:
+        result = 'cancelled'
+        raise
+    except LLMRequestExpired:
+        result = 'expired'
+        logger.warning("LLM请求已超过截止时间，已取消")
+        return None
     except Exception as e:
+        result = 'error'
         logger.error(f"LLM请求错误: {e}")
         return None
+    finally:
+        llm_request_seconds.observe(time.perf_counter() - start,
+                                    result=result)
+
+
+class StreamingReply:
+    """把流式生成的文本逐步发到Discord
+
+    首段立即回复，之后按 STREAM_EDIT_INTERVAL 的节奏编辑同一条消息，
+    超过Discord单条消息长度时另起一条。
+    """
+
+    def __init__(self, message, edit_interval=STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.text = ""
+        self.sent_messages = []
+        self._current = None  # 正在编辑的消息
+        self._shown = ""  # 当前消息已显示的内容
+        self._committed = 0  # 已经定稿到之前消息里的字符数
+        self._last_edit = 0
+
+    async def append(self, delta):
+        self.text += delta
+        await self._render(final=False)
+
+    async def finish(self):
+        await self._render(final=True)
+
+    @staticmethod
+    def _split_point(text):
+        # 尽量在换行处拆分
+        cut = text.rfind('\n', 0, DISCORD_MESSAGE_LIMIT)
+        return cut if cut > DISCORD_MESSAGE_LIMIT // 2 else DISCORD_MESSAGE_LIMIT
+
+    async def _render(self, final):
+        now = time.monotonic()
+        if (self._current is not None and not final
+                and now - self._last_edit < self.edit_interval):
+            return
 
+        pending = self.text[self._committed:]
+        while len(pending) > DISCORD_MESSAGE_LIMIT:
+            cut = self._split_point(pending)
+            await self._show(pending[:cut])
+            self._current = None
+            self._committed += cut
+            pending = pending[cut:]
+
+        if pending.strip():
+            await self._show(pending)
+        self._last_edit = now
+
+    async def _show(self, content):
+        if self._current is None:
+            if self.sent_messages:
+                self._current = await self.message.channel.send(content)
+            else:
+                self._current = await self.message.reply(content)
+            self.sent_messages.append(self._current)
+        elif content != self._shown:
+            await self._current.edit(content=content)
+        self._shown = content
 
-# Google搜索集成
-def google_search(query, api_key=GOOGLE_API_KEY, cx=GOOGLE_CX, num=5):
-    """使用Google自定义搜索API进行搜索"""
-    try:
-        if not api_key or not cx:
-            logger.error("Google API设置不完整")
-            return None
 
-        url = "https://www.googleapis.com/customsearch/v1"
-        params = {"key": api_key, "cx": cx, "q": query, "num": num}
+async def stream_llm_reply(message, query, context=None, system_prompt=None):
+    """流式生成并边生成边发送回复
 
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        results = response.json()
+    返回完整回复；接口不支持流式或还没发出任何内容就失败时返回None，
+    由调用方回退到非流式路径。
+    """
+    messages = build_llm_messages(query, context, system_prompt)
 
-        if "items" in results:
-            return results["items"]
+    async def call():
+        stream = await llm_router.create(messages, stream=True)
+        reply = StreamingReply(message)
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    await reply.append(delta)
+        except Exception as e:
+            if not reply.sent_messages:
+                raise
+            logger.error(f"流式回复中断: {e}")
+        await reply.finish()
+        if not reply.sent_messages:
+            return None, None
+        await llm_cache.put(llm_router.cache_model, messages, reply.text)
+        return reply.text, None
+
+    priority, deadline = llm_request_options.get()
+    try:
+        return await llm_scheduler.submit(
+            f"stream:{message.id}",
+            call,
+            priority=priority,
+            deadline=deadline,
+            tokens=estimate_tokens(messages) + LLM_EXPECTED_COMPLETION_TOKENS,
+            interruptible=False)
+    except LLMRequestExpired:
+        logger.warning("LLM请求已超过截止时间，已取消")
         return None
     except Exception as e:
-        logger.error(f"Google搜索错误: {e}")
+        logger.warning(f"流式请求失败，改用普通请求: {e}")
         return None
 
 
+# Google搜索集成
+class GoogleSearchClient:
+    """异步Google自定义搜索客户端：共享连接池、超时重试，并带TTL+LRU缓存"""
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self,
+                 api_key=GOOGLE_API_KEY,
+                 cx=GOOGLE_CX,
+                 url=GOOGLE_SEARCH_URL,
+                 timeout=SEARCH_TIMEOUT,
+                 retries=SEARCH_RETRIES,
+                 backoff=0.5,
+                 cache_ttl=SEARCH_CACHE_TTL,
+                 cache_size=SEARCH_CACHE_SIZE):
+        self.api_key = api_key
+        self.cx = cx
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = OrderedDict()  # (规范化查询, 数量) -> (过期时间, 结果)
+        self._session = None
+
+    @staticmethod
+    def normalize_query(query):
+        """规范化查询文本作为缓存键"""
+        return ' '.join(query.lower().split()).strip('?？!！。.，, ')
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=20),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    def _cache_get(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires_at, items = entry
+        if expires_at < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return items
+
+    def _cache_put(self, key, items):
+        self._cache[key] = (time.monotonic() + self.cache_ttl, items)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def cache_stats(self):
+        """缓存命中统计"""
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'size': len(self._cache)
+        }
+
+    async def search(self, query, num=5):
+        """搜索并返回结果列表，失败时返回None"""
+        if not self.api_key or not self.cx:
+            logger.error("Google API设置不完整")
+            return None
+
+        key = (self.normalize_query(query), num)
+        items = self._cache_get(key)
+        if items is not None:
+            self.cache_hits += 1
+            return items
+        self.cache_misses += 1
+
+        params = {"key": self.api_key, "cx": self.cx, "q": query, "num": num}
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._get_session().get(self.url,
+                                                   params=params) as response:
+                    if (response.status in self.RETRY_STATUSES
+                            and attempt < self.retries):
+                        raise aiohttp.ClientResponseError(
+                            response.request_info,
+                            response.history,
+                            status=response.status)
+                    if response.status >= 400:
+                        logger.error(f"Google搜索错误: HTTP {response.status}")
+                        return None
+                    results = await response.json(content_type=None)
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.retries:
+                    logger.error(f"Google搜索错误: {e!r}")
+                    return None
+                # 指数退避加随机抖动
+                await asyncio.sleep(self.backoff * (2**attempt) *
+                                    (1 + random.random()))
+            except Exception as e:
+                logger.error(f"Google搜索错误: {e}")
+                return None
+
+        items = results.get("items") or None
+        if items:
+            self._cache_put(key, items)
+        return items
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+search_client = GoogleSearchClient()
+metrics.counter('bot_search_cache_hits_total',
+                '搜索结果缓存命中次数',
+                callback=lambda: search_client.cache_hits)
+metrics.counter('bot_search_cache_misses_total',
+                '搜索结果缓存未命中次数',
+                callback=lambda: search_client.cache_misses)
+
+
+async def google_search(query, num=5):
+    """使用Google自定义搜索API进行搜索"""
+    with search_seconds.time():
+        return await search_client.search(query, num=num)
+
+
 def display_search_results(results, max_results=3):
     """格式化搜索结果"""
     if not results:
@@ -305,6 +3848,119 @@ def display_search_results(results, max_results=3):
 
 
 # 机器人响应生成
+# 消息分类
+class AhoCorasick:
+    """多模式匹配自动机，一次扫描找出文本中出现的所有模式（子串语义）"""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for pattern, value in patterns:
+            if not pattern:
+                continue
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                node = nxt
+            self.output[node].append(value)
+
+        # 按层建立失败指针，并把后缀节点的输出合并进来
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.output[nxt] = self.output[nxt] + self.output[
+                    self.fail[nxt]]
+
+    def search(self, text):
+        """返回text中出现的所有模式对应的值（可能重复）"""
+        goto, fail, output = self.goto, self.fail, self.output
+        node = 0
+        found = []
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if output[node]:
+                found.extend(output[node])
+        return found
+
+
+class MessageRoute:
+    """一条消息的分类结果，供 on_message 和 process_message 决定怎么处理"""
+
+    __slots__ = ('mentioned', 'question', 'needs_search', 'greeting',
+                 'knowledge', 'content')
+
+    def __init__(self, content, mentioned=False):
+        self.mentioned = mentioned
+        self.question = False
+        self.needs_search = False
+        self.greeting = False
+        self.knowledge = []  # 命中的知识库关键词，按知识库顺序
+        self.content = content  # 去掉@机器人之后的内容
+
+
+class TriggerMatcher:
+    """把问号、时效词、问候语和知识库关键词编译进一个自动机，一次扫描完成分类"""
+
+    QUESTION_MARKS = ['?', '？']
+    SEARCH_WORDS = ['最新', '最近', '新闻', '现在', '今天', '昨天', '本周', '本月', '当前']
+    GREETINGS = ['hello', 'hi', '你好', '嗨']
+
+    def __init__(self, knowledge_keys=()):
+        self.mention_pattern = None
+        self.build(knowledge_keys)
+
+    def build(self, knowledge_keys):
+        """知识库变化后重新构建"""
+        patterns = [(mark, ('question', None)) for mark in self.QUESTION_MARKS]
+        patterns += [(word, ('search', None)) for word in self.SEARCH_WORDS]
+        patterns += [(word, ('greeting', None)) for word in self.GREETINGS]
+        patterns += [(keyword.lower(), ('knowledge', i))
+                     for i, keyword in enumerate(knowledge_keys)]
+        self.knowledge_keys = list(knowledge_keys)
+        self.automaton = AhoCorasick(patterns)
+
+    def set_bot_user(self, user_id):
+        """登录后预编译@机器人的正则"""
+        self.mention_pattern = re.compile(f'<@!?{user_id}>')
+
+    def classify(self, content, mentioned=False):
+        route = MessageRoute(content, mentioned)
+        hits = set()
+        for kind, value in self.automaton.search(content.lower()):
+            if kind == 'question':
+                route.question = True
+            elif kind == 'search':
+                route.needs_search = True
+            elif kind == 'greeting':
+                route.greeting = True
+            else:
+                hits.add(value)
+        route.knowledge = [self.knowledge_keys[i] for i in sorted(hits)]
+
+        if mentioned and self.mention_pattern is not None:
+            route.content = self.mention_pattern.sub('', content).strip()
+        return route
+
+    def route(self, message, bot_user):
+        """分类一条Discord消息；是否被提及沿用 mentioned_in（包括@everyone）"""
+        return self.classify(message.content, bot_user.mentioned_in(message))
+
+
 class ResponseGenerator:
 
     def __init__(self, memory):
@@ -334,6 +3990,73 @@ class ResponseGenerator:
             "人工智能": "人工智能是计算机科学的一个分支，旨在创造能够模拟人类智能的系统。",
             "机器学习": "机器学习是人工智能的一个子领域，专注于开发能够从数据中学习的算法。"
         }
+        self.vectorizer = HashingVectorizer()
+        self.matcher = TriggerMatcher()
+        self.build_knowledge_index()
+
+    def load_knowledge_base(self, path=KNOWLEDGE_BASE_FILE):
+        """从JSON文件加载知识库条目，与内置条目合并"""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except Exception as e:
+            logger.error(f"加载知识库出错: {e}")
+            return
+        self.update_knowledge_base(entries)
+        logger.info(f"已从 {path} 加载 {len(entries)} 条知识")
+
+    def update_knowledge_base(self, entries):
+        """更新知识库并重建索引"""
+        self.knowledge_base.update(entries)
+        self.build_knowledge_index()
+
+    def build_knowledge_index(self):
+        """把知识库条目向量化成矩阵并重建关键词匹配器，知识库变化后需要重新调用"""
+        self.knowledge_keys = list(self.knowledge_base)
+        self.matcher.build(self.knowledge_keys)
+        matrix = np.zeros((len(self.knowledge_keys), self.vectorizer.dim),
+                          dtype=np.float32)
+        for i, keyword in enumerate(self.knowledge_keys):
+            vector = self.vectorizer.transform(
+                f"{keyword} {self.knowledge_base[keyword]}")
+            if vector is not None:
+                matrix[i] = vector
+        self.knowledge_matrix = matrix
+
+    def search_knowledge(self, query, k=RETRIEVAL_TOP_K):
+        """返回与query最相关的知识库条目"""
+        vector = self.vectorizer.transform(query)
+        if vector is None or not self.knowledge_keys:
+            return []
+        scores = self.knowledge_matrix @ vector
+        top = np.argsort(-scores)[:k]
+        return [
+            self.knowledge_base[self.knowledge_keys[i]] for i in top
+            if scores[i] >= RETRIEVAL_MIN_SCORE
+        ]
+
+    def retrieve_background(self, question, channel_id, context=None):
+        """检索相关的知识库条目和更早的频道消息，拼成附加到提示里的文本"""
+        sections = []
+        knowledge = self.search_knowledge(question)
+        if knowledge:
+            sections.append("相关知识：\n" +
+                            "\n".join(f"- {entry}" for entry in knowledge))
+
+        # 最近的上下文已经单独提供，只检索更早的消息
+        before = context[0].timestamp if context else None
+        history = self.memory.search_history(question, channel_id, before)
+        if history:
+            sections.append("频道里相关的历史消息：\n" + "\n".join(
+                f"- {hit['username']}: "
+                f"{tokenizer.truncate(hit['content'], LLM_CONTEXT_MESSAGE_TOKENS)}"
+                for hit in history))
+
+        if not sections:
+            return ""
+        return "\n\n" + "\n\n".join(sections)
 
     def generate_greeting(self):
         """生成问候语"""
@@ -343,9 +4066,9 @@ class ResponseGenerator:
         """生成表情反应"""
         return random.choice(self.reactions)
 
-    def generate_topic(self):
+    def generate_topic(self, scope=None):
         """生成新话题"""
-        topics = self.memory.get_recent_topics()
+        topics = self.memory.get_recent_topics(scope=scope)
         if not topics:
             topics = list(self.knowledge_base.keys())
 
@@ -356,94 +4079,212 @@ class ResponseGenerator:
         """生成问题"""
         return random.choice(self.questions)
 
-    async def answer_question(self, question, channel_id):
-        """回答问题 - 使用LLM和搜索引擎"""
-        # 先检查本地知识库
-        for keyword, answer in self.knowledge_base.items():
-            if keyword.lower() in question.lower():
-                # 知识库中有答案，用LLM扩展一下
-                try:
-                    enhanced_answer = await ask_llm(
-                        f"基于以下信息回答问题。信息: {answer}，问题: {question}")
-                    if enhanced_answer:
-                        return enhanced_answer
-                    return answer
-                except:
-                    return answer
-
-        # 尝试使用搜索引擎查找答案
-        search_results = None
-        llm_answer = None
-        final_answer = None
-
-        # 判断问题是否需要搜索最新信息
-        needs_search = any(
-            word in question.lower()
-            for word in ['最新', '最近', '新闻', '现在', '今天', '昨天', '本周', '本月', '当前'])
+    def build_system_prompt(self, base_prompt, user_id=None, channel_id=None):
+        """补充系统提示：频道的对话摘要，以及熟悉用户的资料（让个性化在一次生成中完成）"""
+        prompt = base_prompt
+        if channel_id is not None:
+            summary = self.memory.get_channel_summary(str(channel_id))
+            if summary:
+                prompt += f"\n\n这个频道之前的对话摘要：{summary}"
 
-        if needs_search:
-            # 获取搜索结果
-            search_results = google_search(question)
+        profile = self._profile_prompt(user_id)
+        if profile:
+            prompt += f"\n\n{profile}"
+        return prompt
 
-            if search_results:
-                formatted_results = display_search_results(search_results)
+    def _profile_prompt(self, user_id):
+        if PERSONALIZATION_MODE != 'prompt' or not user_id:
+            return None
 
-                # 将搜索结果提供给LLM进行总结
-                context_for_llm = self.memory.get_channel_context(channel_id,
-                                                                  limit=5)
+        user_info = self.memory.get_user_info(user_id)
+        if not user_info or user_info.get('interaction_count', 0) <= 10:
+            return None
 
-                try:
-                    llm_answer = await ask_llm(
-                        f"根据以下搜索结果和上下文信息，回答用户问题。问题: {question}\n\n搜索结果:\n{formatted_results}",
-                        context=context_for_llm,
-                        system_prompt=
-                        "你是一个友好的Discord群友，正在参与群聊。你需要根据提供的搜索结果回答问题，回答要简洁自然，像普通群友一样说话。"
-                    )
-                    final_answer = llm_answer
-                except Exception as e:
-                    logger.error(f"使用LLM处理搜索结果时出错: {e}")
-                    final_answer = f"这是我找到的一些资料：\n\n{formatted_results}"
+        sentiments = {"positive": "积极", "negative": "低落", "neutral": "平和"}
+        facts = [
+            f"你正在和熟悉的群友{user_info.get('username', '')}聊天",
+            f"你们已经聊过{user_info['interaction_count']}条消息",
+            f"对方最近的情绪{sentiments.get(user_info.get('sentiment'), '平和')}"
+        ]
+        # 去重后取最近的几个话题
+        topics = list(dict.fromkeys(reversed(user_info.get('topics', []))))[:5]
+        if topics:
+            facts.append(f"对方感兴趣的话题：{'、'.join(topics)}")
+
+        return (f"{'，'.join(facts)}。"
+                "如果自然的话，可以顺带提一下对方的兴趣，但不要生硬。")
+
+    async def answer_question(self,
+                              question,
+                              channel_id,
+                              user_id=None,
+                              route=None):
+        """回答问题 - 使用LLM和搜索引擎"""
+        start = time.perf_counter()
+        if route is None:
+            route = self.matcher.classify(question)
 
-        # 如果不需要搜索或搜索失败，直接使用LLM回答
-        if not final_answer:
-            context_for_llm = self.memory.get_channel_context(channel_id,
-                                                              limit=5)
+        # 先检查本地知识库
+        if route.knowledge:
+            answer = self.knowledge_base[route.knowledge[0]]
+            # 知识库中有答案，用LLM扩展一下
             try:
-                llm_answer = await ask_llm(
-                    question,
-                    context=context_for_llm,
-                    system_prompt=
-                    "你是一个友好的Discord群友，正在参与群聊。回答要简洁自然，像普通群友一样说话。不要使用太正式或机器人式的语言。如果不确定答案，就坦率地说不知道，可以适当加入表情符号增加亲和力。"
-                )
-                final_answer = llm_answer
-            except Exception as e:
-                logger.error(f"使用LLM回答问题时出错: {e}")
-                final_answer = "这是个好问题！我不太确定答案，但我们可以一起讨论一下。"
-
-        # 如果所有方法都失败，返回默认回复
-        if not final_answer:
-            return "这是个好问题！我不太确定答案，但我们可以一起讨论一下。"
+                enhanced_answer = await ask_llm(
+                    f"基于以下信息回答问题。信息: {answer}，问题: {question}")
+                if enhanced_answer:
+                    return self._finish_answer(enhanced_answer, 'knowledge',
+                                               start)
+                llm_fallbacks_total.inc(site='knowledge')
+                return self._finish_answer(answer, 'knowledge_raw', start)
+            except:
+                return self._finish_answer(answer, 'knowledge_raw', start)
+
+        context_for_llm = self.memory.get_channel_context(
+            channel_id, limit=LLM_CONTEXT_CANDIDATES)
+        stage_start = time.perf_counter()
+        background = self.retrieve_background(question, channel_id,
+                                              context_for_llm)
+        answer_stage_seconds.observe(time.perf_counter() - stage_start,
+                                     stage='retrieve')
+        args = (question, context_for_llm, background, user_id, channel_id)
 
-        return final_answer
+        # 判断问题是否需要搜索最新信息
+        if not route.needs_search:
+            answer, source = await self._answer_directly(*args), 'direct'
+        elif ANSWER_SPECULATIVE:
+            answer, source = await self._answer_speculatively(*args)
+        else:
+            answer, source = await self._answer_sequentially(*args)
 
-    async def generate_comment(self, message_content, context=None):
+        # 如果所有方法都失败，返回默认回复
+        if not answer:
+            llm_fallbacks_total.inc(site='answer')
+            return self._finish_answer(
+                "这是个好问题！我不太确定答案，但我们可以一起讨论一下。", 'default', start)
+        return self._finish_answer(answer, source, start)
+
+    @staticmethod
+    def _finish_answer(answer, source, start):
+        answer_stage_seconds.observe(time.perf_counter() - start,
+                                     stage='total')
+        answer_results_total.inc(source=source)
+        return answer
+
+    async def _answer_with_search(self, question, context, background,
+                                  user_id, channel_id):
+        """搜索后让LLM总结，返回 (回答, 格式化的搜索结果)，没有搜索结果时都为None"""
+        stage_start = time.perf_counter()
+        search_results = await google_search(question)
+        answer_stage_seconds.observe(time.perf_counter() - stage_start,
+                                     stage='search')
+        if not search_results:
+            return None, None
+
+        formatted_results = display_search_results(search_results)
+
+        # 将搜索结果提供给LLM进行总结
+        stage_start = time.perf_counter()
+        answer = await ask_llm(
+            f"根据以下搜索结果和上下文信息，回答用户问题。问题: {question}\n\n搜索结果:\n{formatted_results}{background}",
+            context=context,
+            system_prompt=self.build_system_prompt(
+                "你是一个友好的Discord群友，正在参与群聊。你需要根据提供的搜索结果回答问题，回答要简洁自然，像普通群友一样说话。",
+                user_id, channel_id))
+        answer_stage_seconds.observe(time.perf_counter() - stage_start,
+                                     stage='search_llm')
+        if not answer:
+            llm_fallbacks_total.inc(site='search')
+        return answer, formatted_results
+
+    async def _answer_directly(self, question, context, background, user_id,
+                               channel_id):
+        """不搜索，直接用LLM回答"""
+        stage_start = time.perf_counter()
+        answer = await ask_llm(
+            question + background,
+            context=context,
+            system_prompt=self.build_system_prompt(
+                "你是一个友好的Discord群友，正在参与群聊。回答要简洁自然，像普通群友一样说话。不要使用太正式或机器人式的语言。如果不确定答案，就坦率地说不知道，可以适当加入表情符号增加亲和力。",
+                user_id, channel_id))
+        answer_stage_seconds.observe(time.perf_counter() - stage_start,
+                                     stage='direct_llm')
+        return answer
+
+    async def _answer_sequentially(self, *args):
+        """先搜索再总结，没有结果时再直接回答，返回 (回答, 来源)"""
+        answer, formatted_results = await self._answer_with_search(*args)
+        if answer:
+            return answer, 'search'
+        answer = await self._answer_directly(*args)
+        if answer:
+            return answer, 'direct'
+        if formatted_results:
+            return f"这是我找到的一些资料：\n\n{formatted_results}", 'search_results'
+        return None, None
+
+    async def _answer_speculatively(self, *args):
+        """同时发起搜索回答和直接回答，返回 (回答, 来源)
+
+        搜索回答更可靠，优先采用：直接回答先完成时再等搜索回答
+        ANSWER_SEARCH_GRACE 秒；搜索没有结果或LLM失败时立即改用直接回答，
+        不再串行地补一次请求。返回前取消还没完成的一方。
+        """
+        search_task = asyncio.create_task(self._answer_with_search(*args))
+        direct_task = asyncio.create_task(self._answer_directly(*args))
+        try:
+            await asyncio.wait((search_task, direct_task),
+                               return_when=asyncio.FIRST_COMPLETED)
+            if not search_task.done():
+                if direct_task.result():
+                    await asyncio.wait((search_task, ),
+                                       timeout=ANSWER_SEARCH_GRACE)
+                else:
+                    await search_task
+
+            formatted_results = None
+            if search_task.done():
+                answer, formatted_results = search_task.result()
+                if answer:
+                    return answer, 'search'
+
+            answer = await direct_task
+            if answer:
+                return answer, 'direct'
+            if formatted_results:
+                return f"这是我找到的一些资料：\n\n{formatted_results}", 'search_results'
+            return None, None
+        finally:
+            search_task.cancel()
+            direct_task.cancel()
+
+    async def generate_comment(self,
+                               message_content,
+                               context=None,
+                               user_id=None,
+                               channel_id=None):
         """根据消息内容生成评论 - 使用LLM增强"""
-        sentiment = sia.polarity_scores(message_content)
+        # 复用入库时的分析结果
+        try:
+            sentiment = await message_analyzer.analyze(message_content)
+        except Exception as e:
+            logger.error(f"分析消息情感时出错: {e}")
+            sentiment = {'compound': 0}
 
         # 尝试使用LLM生成更自然的评论
         try:
             comment = await ask_llm(
                 f"对以下消息提供一个简短、自然的回复，像普通朋友一样说话：\n{message_content}",
                 context=context,
-                system_prompt=
-                "你是一个友好的Discord群友。你的回复应该简短（不超过30个字），自然，像普通朋友一样说话。不要显得太正式或机器人式。"
-            )
+                system_prompt=self.build_system_prompt(
+                    "你是一个友好的Discord群友。你的回复应该简短（不超过30个字），自然，像普通朋友一样说话。不要显得太正式或机器人式。",
+                    user_id, channel_id))
             if comment:
                 return comment
         except Exception as e:
             logger.error(f"使用LLM生成评论时出错: {e}")
 
         # 如果LLM失败，使用基于情感的模板回复
+        llm_fallbacks_total.inc(site='comment')
         if sentiment['compound'] > 0.5:
             return random.choice(
                 ["我完全同意你的观点！", "说得太好了！", "这个想法真棒！", "我也是这么想的！", "你的观点很有见地！"])
@@ -456,8 +4297,14 @@ class ResponseGenerator:
             return random.choice(
                 ["有意思的观点。", "我明白你的意思了。", "这让我想到了...", "谢谢分享！", "继续说下去？"])
 
-    async def personalize_response(self, user_id, base_response):
-        """根据用户信息个性化响应"""
+    async def personalize_response(self,
+                                   user_id,
+                                   base_response,
+                                   use_llm=True):
+        """根据用户信息个性化响应（use_llm为False时只用模板）
+
+        用户话题按当前资料读取，可能还不包含正在回复的这条消息。
+        """
         user_info = self.memory.get_user_info(user_id)
 
         if not user_info:
@@ -469,16 +4316,17 @@ class ResponseGenerator:
             if user_topics:
                 recent_topic = random.choice(user_topics)
                 # 尝试使用LLM生成更自然的个性化回复
-                try:
-                    personalized = await ask_llm(
-                        f"请基于以下基础回复和用户兴趣创建一个个性化回复。基础回复：{base_response}，用户兴趣：{recent_topic}",
-                        system_prompt=
-                        "你是一个友好的Discord群友，正在与熟悉的朋友聊天。请保持回复简短自然，类似于普通用户的聊天方式，不要显得太正式。可以适当提及用户的兴趣爱好。"
-                    )
-                    if personalized:
-                        return personalized
-                except:
-                    pass
+                if use_llm:
+                    try:
+                        personalized = await ask_llm(
+                            f"请基于以下基础回复和用户兴趣创建一个个性化回复。基础回复：{base_response}，用户兴趣：{recent_topic}",
+                            system_prompt=
+                            "你是一个友好的Discord群友，正在与熟悉的朋友聊天。请保持回复简短自然，类似于普通用户的聊天方式，不要显得太正式。可以适当提及用户的兴趣爱好。"
+                        )
+                        if personalized:
+                            return personalized
+                    except:
+                        pass
 
                 # 如果LLM失败，使用模板
                 personalized_responses = [
@@ -490,72 +4338,219 @@ class ResponseGenerator:
 
         return base_response
 
-    async def generate_followup(self, context, channel_id=None):
+    async def generate_followup(self, context, channel_id=None, scope=None):
         """根据上下文生成后续回复"""
         if not context:
-            return self.generate_topic()
+            return self.generate_topic(scope)
 
         # 分析最近的对话
-        last_message = context[-1]['content']
+        last_message = context[-1].content
 
         # 检测是否是问题
-        if '?' in last_message or '？' in last_message:
-            return await self.answer_question(last_message, channel_id)
+        route = self.matcher.classify(last_message)
+        if route.question:
+            return await self.answer_question(last_message,
+                                              channel_id,
+                                              route=route)
 
         # 使用LLM生成更自然的跟进
         try:
             followup = await ask_llm(
                 "请根据上述对话生成一个自然的跟进回复",
                 context=context,
-                system_prompt=
-                "你是Discord群组中的一个普通成员。基于上下文提供简短、自然的跟进，像普通群友一样说话。不要使用太正式或机器人式的语言。"
-            )
+                system_prompt=self.build_system_prompt(
+                    "你是Discord群组中的一个普通成员。基于上下文提供简短、自然的跟进，像普通群友一样说话。不要使用太正式或机器人式的语言。",
+                    channel_id=channel_id))
             if followup:
                 return followup
         except Exception as e:
             logger.error(f"使用LLM生成跟进回复时出错: {e}")
 
         # 如果LLM失败，使用简单评论
-        return await self.generate_comment(last_message)
+        llm_fallbacks_total.inc(site='followup')
+        return await self.generate_comment(last_message, channel_id=channel_id)
 
 
 # 初始化响应生成器
 response_generator = ResponseGenerator(memory)
 
 
+# 频道对话摘要
+class ConversationSummarizer:
+    """后台增量维护每个频道的滚动摘要
+
+    每个频道累计 SUMMARY_EVERY_N 条新消息后，把旧摘要和这些新消息交给LLM合并成新摘要，
+    回复时作为长程上下文放进系统提示，token开销固定。
+    """
+
+    def __init__(self,
+                 memory,
+                 every_n=SUMMARY_EVERY_N,
+                 max_chars=SUMMARY_MAX_CHARS):
+        self.memory = memory
+        self.every_n = every_n
+        self.max_chars = max_chars
+
+    async def update(self):
+        """并发更新所有积累了足够新消息的频道摘要（LLM并发由调度器限制）"""
+        channels = [(channel_id, pending) for channel_id, pending in
+                    self.memory.unsummarized.items()
+                    if pending >= self.every_n]
+        results = await asyncio.gather(*(
+            self.summarize_channel(channel_id, pending)
+            for channel_id, pending in channels),
+                                       return_exceptions=True)
+        for (channel_id, _), result in zip(channels, results):
+            if isinstance(result, Exception):
+                logger.error(f"更新频道 {channel_id} 的摘要时出错: {result}")
+
+    async def summarize_channel(self, channel_id, pending):
+        messages = self.memory.get_channel_context(channel_id, limit=pending)
+        if not messages:
+            self.memory.unsummarized.pop(channel_id, None)
+            return
+
+        lines = "\n".join(
+            f"{msg.username}: "
+            f"{tokenizer.truncate(msg.content, LLM_CONTEXT_MESSAGE_TOKENS)}"
+            for msg in messages)
+        previous = self.memory.get_channel_summary(channel_id) or "（暂无）"
+
+        summary = await ask_llm(
+            f"之前的摘要：\n{previous}\n\n新的消息：\n{lines}\n\n"
+            f"请把新的消息合并进摘要，输出更新后的摘要，不超过{self.max_chars}字。",
+            system_prompt=
+            "你负责为Discord频道维护一份简短的对话摘要，记录主要话题、重要结论和谁说了什么。只输出摘要本身。",
+            use_cache=False)
+        if not summary:
+            return
+
+        self.memory.set_channel_summary(channel_id,
+                                        summary.strip()[:self.max_chars],
+                                        messages[-1].timestamp)
+        # 摘要期间到达的新消息留到下一次
+        self.memory.unsummarized[channel_id] -= pending
+        if self.memory.unsummarized[channel_id] <= 0:
+            del self.memory.unsummarized[channel_id]
+        logger.info(f"已更新频道 {channel_id} 的对话摘要")
+
+
+conversation_summarizer = ConversationSummarizer(memory)
+
+
 # 机器人事件处理
 @bot.event
 async def on_ready():
     logger.info(f'{bot.user.name} 已连接到Discord!')
+    if startup_timer.connect_started is not None:
+        startup_timer.mark("连接Discord", startup_timer.connect_started)
+        startup_timer.connect_started = None
+        # 保存任务引用，避免被垃圾回收
+        startup_timer.warm_task = asyncio.create_task(warm_up())
+    response_generator.matcher.set_bot_user(bot.user.id)
     change_activity.start()
     periodic_interaction.start()
     save_data.start()
+    flush_journal.start()
+    update_summaries.start()
     await bot.change_presence(activity=discord.Game(name="初次见面，请多指教！"))
 
     # 向所有可见频道发送问候
-    for guild in bot.guilds:
-        # 寻找合适的文本频道
-        general_channels = [
-            ch for ch in guild.text_channels if "general" in ch.name.lower()
+    await fan_out(bot.guilds, greet_guild, "发送问候")
+
+
+async def monitor_loop_lag(interval=LOOP_LAG_INTERVAL):
+    """定期睡眠，用实际醒来时间比预期晚了多少估计事件循环延迟"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag_seconds.set(round(max(0.0, loop.time() - start - interval), 6))
+
+
+async def start_metrics_server(port, host=METRICS_HOST):
+    """在本地HTTP端口上提供Prometheus格式的 /metrics"""
+
+    async def handle(request):
+        return web.Response(text=metrics.render(),
+                            content_type='text/plain',
+                            charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"指标端点已启动: http://{host}:{port}/metrics")
+    return runner
+
+
+async def warm_up():
+    """连接成功后在后台预热延迟初始化的组件，然后输出启动耗时"""
+    try:
+        await asyncio.to_thread(get_nltk_tools)
+        await asyncio.to_thread(llm_router.warm_up)
+    except Exception as e:
+        logger.error(f"预热组件时出错: {e}")
+    startup_timer.report()
+
+
+async def greet_guild(guild):
+    """在群组中发送问候，没有合适的频道时返回False"""
+    # 寻找合适的文本频道
+    general_channels = [
+        ch for ch in guild.text_channels if "general" in ch.name.lower()
+    ]
+    if general_channels:
+        channel = general_channels[0]
+    else:
+        # 如果没有general频道，选择第一个文本频道
+        text_channels = [
+            ch for ch in guild.text_channels
+            if ch.permissions_for(guild.me).send_messages
         ]
-        if general_channels:
-            channel = general_channels[0]
+        if text_channels:
+            channel = text_channels[0]
         else:
-            # 如果没有general频道，选择第一个文本频道
-            text_channels = [
-                ch for ch in guild.text_channels
-                if ch.permissions_for(guild.me).send_messages
-            ]
-            if text_channels:
-                channel = text_channels[0]
-            else:
-                continue
+            return False
+
+    await channel.send(
+        "大家好！我是新加入的虚拟群友，可以和我聊天，问我问题，或者用`!help`查看我的功能。期待和大家成为好朋友！😊")
+    return True
 
-        try:
-            await channel.send(
-                "大家好！我是新加入的虚拟群友，可以和我聊天，问我问题，或者用`!help`查看我的功能。期待和大家成为好朋友！😊")
-        except Exception as e:
-            logger.error(f"发送问候消息时出错: {e}")
+
+async def fan_out(guilds,
+                  handler,
+                  name,
+                  concurrency=FANOUT_CONCURRENCY,
+                  jitter=FANOUT_JITTER,
+                  timeout=FANOUT_TIMEOUT):
+    """对每个群组并发执行handler，限制并发数，加随机延迟和超时
+
+    handler 返回False表示跳过。返回 {'completed', 'failed', 'skipped'} 计数。
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    counts = Counter(completed=0, failed=0, skipped=0)
+
+    async def run(guild):
+        await asyncio.sleep(random.uniform(0, jitter))
+        async with semaphore:
+            try:
+                done = await asyncio.wait_for(handler(guild), timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"{name}: 群组 {guild.name} 超时")
+                counts['failed'] += 1
+                return
+            except Exception as e:
+                logger.error(f"{name}: 群组 {guild.name} 出错: {e}")
+                counts['failed'] += 1
+                return
+        counts['completed' if done is not False else 'skipped'] += 1
+
+    await asyncio.gather(*(run(guild) for guild in guilds))
+    logger.info(f"{name}: 完成 {counts['completed']}，失败 {counts['failed']}，"
+                f"跳过 {counts['skipped']}")
+    return dict(counts)
 
 
 @bot.event
@@ -565,22 +4560,27 @@ async def on_message(message):
         return
 
     # 记录用户交互
-    memory.add_user_interaction(str(message.author.id), message.author.name,
-                                message.content, str(message.channel.id))
+    memory.add_user_interaction(
+        str(message.author.id), message.author.name, message.content,
+        str(message.channel.id),
+        str(message.guild.id) if message.guild else None)
 
     # 如果消息以命令前缀开头，处理命令
     if message.content.startswith(PREFIX):
         await bot.process_commands(message)
         return
 
+    # 一次扫描完成消息分类
+    route = response_generator.matcher.route(message, bot.user)
+
     # 决定是否回复
     should_reply = False
 
     # 如果被提及，100%回复
-    if bot.user.mentioned_in(message):
+    if route.mentioned:
         should_reply = True
     # 如果是问题，70%概率回复
-    elif '?' in message.content or '？' in message.content:
+    elif route.question:
         should_reply = random.random() < 0.7
     # 如果是常规消息，30%概率回复
     else:
@@ -589,7 +4589,7 @@ async def on_message(message):
     # 如果决定回复，处理消息
     if should_reply:
         async with message.channel.typing():  # 显示"正在输入"状态
-            await process_message(message)
+            await process_message(message, route)
 
     # 独立于回复决策的表情反应，20%概率
     if random.random() < 0.2:
@@ -599,85 +4599,129 @@ async def on_message(message):
             pass
 
 
-async def process_message(message):
+async def process_message(message, route=None):
     """处理消息并生成回复"""
     try:
+        if route is None:
+            route = response_generator.matcher.route(message, bot.user)
+
+        # 被@的回复优先处理；超过截止时间的回复直接丢弃
+        deadline = set_llm_request_options(
+            PRIORITY_MENTION if route.mentioned else PRIORITY_NORMAL,
+            LLM_REPLY_DEADLINE)
+
         # 获取频道上下文
-        context = memory.get_channel_context(str(message.channel.id))
+        context = memory.get_channel_context(str(message.channel.id),
+                                             limit=LLM_CONTEXT_CANDIDATES)
+        # 用户资料按当前状态读取，当前消息的分析结果在后台入库，不阻塞回复
+        user_id = str(message.author.id)
 
         # 准备回复
         reply = None
         typing_delay = 1  # 默认输入延迟
+        personalized = False  # 回复是否已经在生成时带上用户资料
 
         # 如果被提及，直接回复
-        if bot.user.mentioned_in(message):
+        if route.mentioned:
+            replies_total.inc(branch='mention')
             # 处理消息中提到机器人的情况
-            content = re.sub(f'<@!?{bot.user.id}>', '',
-                             message.content).strip()
+            content = route.content
             if not content:  # 如果只是提到了机器人，没有实际内容
                 content = "你好"
 
             # 使用LLM生成回复
             context_for_llm = get_context_for_llm(context)
             typing_delay = min(2 + len(content) * 0.01, 4)  # 根据内容长度调整"输入"时间
+            system_prompt = response_generator.build_system_prompt(
+                "你是Discord群组中的一个友好成员。你应该提供简短、自然的回复，就像普通群友一样说话。不要使用太正式或机器人式的语言。如果被问到问题，尽量提供有帮助的回答，但保持对话风格轻松自然。",
+                user_id, message.channel.id)
+            personalized = True
+
+            # 流式模式下边生成边发送，不再等待完整回复和模拟输入时间
+            if LLM_STREAMING:
+                streamed = await stream_llm_reply(message,
+                                                  content,
+                                                  context=context_for_llm,
+                                                  system_prompt=system_prompt)
+                if streamed:
+                    return
 
             try:
-                reply = await ask_llm(
-                    content,
-                    context=context_for_llm,
-                    system_prompt=
-                    "你是Discord群组中的一个友好成员。你应该提供简短、自然的回复，就像普通群友一样说话。不要使用太正式或机器人式的语言。如果被问到问题，尽量提供有帮助的回答，但保持对话风格轻松自然。"
-                )
+                reply = await ask_llm(content,
+                                      context=context_for_llm,
+                                      system_prompt=system_prompt)
             except Exception as e:
                 logger.error(f"使用LLM生成回复出错: {e}")
                 reply = await response_generator.generate_followup(
-                    context, message.channel.id)
+                    context, message.channel.id,
+                    topic_scope(message.guild, message.channel))
 
         # 如果是问题，使用问题处理逻辑
-        elif '?' in message.content or '？' in message.content:
+        elif route.question:
+            replies_total.inc(branch='question')
             typing_delay = min(2 + len(message.content) * 0.01,
                                5)  # 问题可能需要更长的"思考"时间
             reply = await response_generator.answer_question(
-                message.content, message.channel.id)
+                message.content, message.channel.id, user_id, route)
+            personalized = True
 
         # 长消息，生成评论
         elif len(message.content) > 50:
+            replies_total.inc(branch='comment')
             typing_delay = min(1.5 + len(message.content) * 0.005,
                                3)  # 评论不需要太长的思考时间
             context_for_llm = get_context_for_llm(context)
             reply = await response_generator.generate_comment(
-                message.content, context_for_llm)
+                message.content, context_for_llm, user_id, message.channel.id)
+            personalized = True
 
         # 短消息处理
         else:
             typing_delay = 1  # 短消息快速回复
             # 是否是问候
-            if any(greeting in message.content.lower()
-                   for greeting in ['hello', 'hi', '你好', '嗨']):
+            if route.greeting:
+                replies_total.inc(branch='greeting')
                 reply = response_generator.generate_greeting()
             else:
                 # 50%概率生成评论，50%概率提出新话题
                 if random.random() < 0.5:
+                    replies_total.inc(branch='comment')
                     context_for_llm = get_context_for_llm(context)
                     reply = await response_generator.generate_comment(
-                        message.content, context_for_llm)
+                        message.content, context_for_llm, user_id,
+                        message.channel.id)
+                    personalized = True
                 else:
-                    reply = response_generator.generate_topic()
+                    replies_total.inc(branch='topic')
+                    reply = response_generator.generate_topic(
+                        topic_scope(message.guild, message.channel))
 
         # 如果所有方法都失败，使用一个安全的默认回复
         if not reply:
+            llm_fallbacks_total.inc(site='reply')
             reply = "嗯，有意思。你们继续，我先看看。"
 
         # 个性化响应（对熟悉的用户）
         if random.random() < 0.7:  # 70%的概率进行个性化
-            reply = await response_generator.personalize_response(
-                str(message.author.id), reply)
+            if PERSONALIZATION_MODE == 'rewrite':
+                # 旧方式：把回复再发给LLM改写一次
+                reply = await response_generator.personalize_response(
+                    user_id, reply)
+            elif not personalized:
+                # 模板回复没有经过LLM，只用模板个性化
+                reply = await response_generator.personalize_response(
+                    user_id, reply, use_llm=False)
 
         # 模拟输入时间
         await asyncio.sleep(typing_delay)
 
+        if deadline is not None and asyncio.get_running_loop().time(
+        ) > deadline:
+            logger.info("回复已过期，不再发送")
+            return
+
         # 发送回复（有50%概率使用reply，50%概率使用普通消息）
-        if bot.user.mentioned_in(message) or random.random() < 0.5:
+        if route.mentioned or random.random() < 0.5:
             await message.reply(reply)
         else:
             await message.channel.send(reply)
@@ -690,20 +4734,16 @@ async def process_message(message):
             pass
 
 
-def get_context_for_llm(context, limit=5):
-    """将上下文转换为LLM可用的格式"""
-    if not context:
-        return []
+def topic_scope(guild, channel):
+    """话题统计范围：群组ID，私聊时为频道ID"""
+    return str(guild.id) if guild else str(channel.id)
 
-    formatted_context = []
-    for msg in context[-limit:]:
-        formatted_context.append({
-            'user_id': msg.get('user_id', ''),
-            'username': msg.get('username', 'User'),
-            'content': msg.get('content', '')
-        })
 
-    return formatted_context
+def get_context_for_llm(context, limit=LLM_CONTEXT_CANDIDATES):
+    """取最近的候选上下文给LLM（返回视图，不复制消息），由 ContextBuilder 按预算挑选"""
+    if not context:
+        return []
+    return context[-limit:]
 
 
 # 定时任务
@@ -723,67 +4763,90 @@ async def change_activity():
     logger.info(f"已更改活动状态为: {activity.name}")
 
 
-@tasks.loop(hours=3)
+@tasks.loop(hours=PERIODIC_INTERACTION_HOURS)
 async def periodic_interaction():
     """定期在活跃频道发起互动"""
-    # 获取所有文本频道
-    for guild in bot.guilds:
-        text_channels = [
-            channel for channel in guild.channels
-            if isinstance(channel, discord.TextChannel)
-            and channel.permissions_for(guild.me).send_messages
-        ]
+    set_llm_request_options(PRIORITY_BACKGROUND)
 
-        if not text_channels:
-            continue
+    await fan_out(bot.guilds, interact_in_guild, "定期互动")
 
-        # 选择一个随机频道
-        channel = random.choice(text_channels)
 
-        # 获取频道上下文
-        context = memory.get_channel_context(str(channel.id))
+async def interact_in_guild(guild):
+    """在群组的一个活跃频道发起互动，没有发言时返回False"""
+    # 多个分片进程（或重启前后）共享记忆库时，每个群组每个周期只互动一次
+    if not await memory.claim(f"periodic_interaction:{guild.id}",
+                              PERIODIC_INTERACTION_HOURS * 3600 * 0.9):
+        return False
 
-        # 如果该频道24小时内有活跃对话，有更高概率互动
-        recent_activity = any(
-            datetime.datetime.fromisoformat(msg['timestamp']) >
-            datetime.datetime.now() - datetime.timedelta(hours=24)
-            for msg in context) if context else False
+    # 获取所有可以发言的文本频道
+    text_channels = {
+        str(channel.id): channel
+        for channel in guild.channels
+        if isinstance(channel, discord.TextChannel)
+        and channel.permissions_for(guild.me).send_messages
+    }
 
-        if recent_activity and random.random() < 0.7:
-            # 生成一个新话题或跟进现有对话
-            try:
-                async with channel.typing():
-                    if random.random() < 0.6:
-                        # 提出新话题
-                        topic_starter = response_generator.generate_topic()
-                        # 使用LLM扩展话题以增加深度
-                        enhanced_topic = await ask_llm(
-                            f"请基于这个话题启动语'{topic_starter}'创建一个更自然、有深度的话题启动消息，要简洁自然，像普通群友发起的话题一样。"
-                        )
-                        message = enhanced_topic if enhanced_topic else topic_starter
-
-                        # 添加问题以促进互动
-                        if random.random() < 0.7:
-                            message += " " + response_generator.generate_question(
-                            )
-                    else:
-                        # 跟进最近的对话
-                        message = await response_generator.generate_followup(
-                            context, channel.id)
-
-                    # 等待模拟打字时间
-                    await asyncio.sleep(min(len(message) * 0.05, 3))
-                    await channel.send(message)
-                    logger.info(f"在频道 {channel.name} 发起了互动")
-            except Exception as e:
-                logger.error(f"在频道 {channel.name} 发送消息时出错: {e}")
+    # 只考虑24小时内有活跃对话的频道，从最活跃的几个中按活跃度挑选
+    candidates = memory.get_active_channels(str(guild.id),
+                                            text_channels,
+                                            since=time.time() - 24 * 3600)
+    if not candidates or random.random() >= 0.7:
+        return False
+
+    channel_id = random.choices(
+        candidates,
+        weights=[memory.activity.rate(c) for c in candidates])[0]
+    channel = text_channels[channel_id]
+
+    # 获取频道上下文
+    context = memory.get_channel_context(channel_id)
+
+    # 生成一个新话题或跟进现有对话
+    async with channel.typing():
+        if random.random() < 0.6:
+            # 提出新话题
+            topic_starter = response_generator.generate_topic(str(guild.id))
+            # 使用LLM扩展话题以增加深度
+            enhanced_topic = await ask_llm(
+                f"请基于这个话题启动语'{topic_starter}'创建一个更自然、有深度的话题启动消息，要简洁自然，像普通群友发起的话题一样。"
+            )
+            message = enhanced_topic if enhanced_topic else topic_starter
+
+            # 添加问题以促进互动
+            if random.random() < 0.7:
+                message += " " + response_generator.generate_question()
+        else:
+            # 跟进最近的对话
+            message = await response_generator.generate_followup(
+                context, channel.id, str(guild.id))
+
+        # 等待模拟打字时间
+        await asyncio.sleep(min(len(message) * 0.05, 3))
+        await channel.send(message)
+        logger.info(f"在频道 {channel.name} 发起了互动")
+    return True
+
+
+@tasks.loop(seconds=JOURNAL_FLUSH_INTERVAL)
+async def flush_journal():
+    """批量落盘记忆变更，崩溃时最多丢失一个间隔的数据"""
+    await memory.flush()
+
+
+@tasks.loop(seconds=SUMMARY_INTERVAL)
+async def update_summaries():
+    """增量更新频道对话摘要"""
+    set_llm_request_options(PRIORITY_BACKGROUND)
+    try:
+        await conversation_summarizer.update()
+    except Exception as e:
+        logger.error(f"更新对话摘要时出错: {e}")
 
 
 @tasks.loop(minutes=15)
 async def save_data():
-    """定期保存数据"""
-    memory.save_memory()
-    memory.save_conversation_history()
+    """定期整理记忆存储"""
+    await memory.compact()
 
 
 # 命令处理
@@ -820,7 +4883,8 @@ async def help_command(ctx):
 @bot.command(name='topic', help='提出一个新话题')
 async def topic_command(ctx):
     async with ctx.typing():
-        topic = response_generator.generate_topic()
+        topic = response_generator.generate_topic(
+            topic_scope(ctx.guild, ctx.channel))
 
         # 使用LLM增强话题
         try:
@@ -849,7 +4913,7 @@ async def mood_command(ctx):
 
     # 随机选择一个心情
     current_mood = random.choice(list(moods.keys()))
-    memory.bot_mood = current_mood
+    memory.set_mood(current_mood)
 
     # 使用LLM生成更自然的心情描述
     try:
@@ -872,8 +4936,10 @@ async def stats_command(ctx):
                           description="以下是我收集的一些群组数据：",
                           color=discord.Color.green())
 
+    scope = topic_scope(ctx.guild, ctx.channel)
+
     # 热门话题
-    hot_topics = memory.get_recent_topics(5)
+    hot_topics = memory.get_recent_topics(5, scope)
     if hot_topics:
         embed.add_field(name="热门话题",
                         value="\n".join([f"• {topic}"
@@ -881,26 +4947,23 @@ async def stats_command(ctx):
                         inline=False)
 
     # 活跃用户
-    active_users = sorted([(user_id, data)
-                           for user_id, data in memory.user_data.items()],
-                          key=lambda x: x[1].get('interaction_count', 0),
-                          reverse=True)[:5]
+    active_users = memory.get_top_users(scope, 5)
 
     if active_users:
-        embed.add_field(
-            name="活跃用户",
-            value="\n".join([
-                f"• {data['username']} ({data.get('interaction_count', 0)}条消息)"
-                for user_id, data in active_users
-            ]),
-            inline=False)
+        embed.add_field(name="活跃用户",
+                        value="\n".join([
+                            f"• {username} ({count}条消息)"
+                            for user_id, username, count in active_users
+                        ]),
+                        inline=False)
 
     # 总体统计
-    total_messages = sum(
-        data.get('interaction_count', 0) for data in memory.user_data.values())
+    user_count, total_messages = memory.get_totals(scope)
     embed.add_field(
         name="总体统计",
-        value=f"• 记录用户数: {len(memory.user_data)}\n• 总消息数: {total_messages}",
+        value=f"• 记录用户数: {user_count}\n• 总消息数: {total_messages}\n"
+        f"• 最近24小时: {memory.get_recent_message_count(scope, 24)}条\n"
+        f"• 最近7天: {memory.get_recent_message_count(scope, 24 * 7)}条",
         inline=False)
 
     await ctx.send(embed=embed)
@@ -929,7 +4992,7 @@ async def search_command(ctx, *, query):
         await asyncio.sleep(2)
 
         # 使用Google搜索
-        results = google_search(query)
+        results = await google_search(query)
 
         if not results:
             await ctx.reply("抱歉，我搜索不到相关信息。你可以尝试换个关键词。")
@@ -953,19 +5016,81 @@ async def search_command(ctx, *, query):
         await ctx.reply(formatted_results)
 
 
+@bot.command(name='metrics', help='查看运行指标（仅限机器人主人）')
+@commands.is_owner()
+async def metrics_command(ctx):
+    text = metrics.render()
+    if len(text) + 8 <= DISCORD_MESSAGE_LIMIT:
+        await ctx.send(f"```\n{text}```")
+    else:
+        await ctx.send(file=discord.File(io.BytesIO(text.encode('utf-8')),
+                                         filename='metrics.txt'))
+
+
 # 错误处理
 @bot.event
 async def on_command_error(ctx, error):
     if isinstance(error, commands.CommandNotFound):
         await ctx.send("抱歉，我不认识这个命令。输入 `!help` 查看可用命令。")
+    elif isinstance(error, commands.NotOwner):
+        await ctx.send("这个命令只有机器人的主人可以使用。")
     else:
         logger.error(f"命令错误: {traceback.format_exc()}")
         await ctx.send(f"执行命令时出错，请稍后再试。")
 
 
 # 启动机器人
+def cli_option(name, default=None):
+    """读取 --name value 形式的命令行参数"""
+    if name in sys.argv:
+        index = sys.argv.index(name)
+        if index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+    return default
+
+
+def launch_shards(shard_count, processes):
+    """启动多个机器人进程，每个进程负责一部分分片，共享同一个SQLite记忆库"""
+    processes = max(1, min(processes, shard_count))
+    children = []
+    for i in range(processes):
+        shard_ids = list(range(i, shard_count, processes))
+        env = dict(os.environ,
+                   SHARD_COUNT=str(shard_count),
+                   SHARD_IDS=','.join(map(str, shard_ids)),
+                   MEMORY_BACKEND='sqlite')
+        children.append(
+            subprocess.Popen([sys.executable,
+                              os.path.abspath(__file__)],
+                             env=env))
+        logger.info(f"已启动进程 {children[-1].pid}，负责分片 {shard_ids}")
+
+    try:
+        return max(child.wait() for child in children)
+    except KeyboardInterrupt:
+        for child in children:
+            child.terminate()
+        for child in children:
+            child.wait()
+        return 0
+
+
+startup_timer.mark("初始化模块", startup_timer.started)
+
 if __name__ == "__main__":
+    if '--migrate-sqlite' in sys.argv:
+        migrate_json_to_sqlite()
+        sys.exit(0)
+    if '--shards' in sys.argv:
+        llm_cache.close()
+        shard_count = int(cli_option('--shards'))
+        sys.exit(
+            launch_shards(shard_count,
+                          int(cli_option('--processes', shard_count))))
     try:
         bot.run(TOKEN)
     except Exception as e:
         logger.critical(f"启动机器人时出错: {traceback.format_exc()}")
+    finally:
+        memory.close()
+        llm_cache.close()
@@ -0,0 +1,6 @@
+"""测试公共设置：main 在导入时读取配置，这里只补上必需的环境变量"""
+import os
+import sys
+
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,196 @@
+"""LLMRouter 的对冲、故障转移和熔断测试，两个接口由本地 aiohttp 桩服务器模拟"""
+import asyncio
+import time
+
+import pytest
+from aiohttp import web
+
+import main
+
+
+class StubLLMServer:
+    """OpenAI兼容的 /v1/chat/completions，回复内容是服务器名"""
+
+    def __init__(self, name, latency=0.0, fail=False):
+        self.name = name
+        self.latency = latency
+        self.fail = fail
+        self.requests = 0
+        self.url = None
+        self._runner = None
+
+    async def handle(self, request):
+        body = await request.json()
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        if self.fail:
+            return web.json_response(
+                {'error': {
+                    'message': 'stub error',
+                    'type': 'server_error'
+                }},
+                status=500)
+        return web.json_response({
+            'id': self.name,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body['model'],
+            'choices': [{
+                'index': 0,
+                'message': {
+                    'role': 'assistant',
+                    'content': self.name
+                },
+                'finish_reason': 'stop'
+            }]
+        })
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f'http://{host}:{port}/v1'
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+MESSAGES = [{'role': 'user', 'content': '你好'}]
+
+
+def run(scenario, *servers, hedge=True):
+    """启动桩服务器，按顺序为每个服务器建一个接口，运行 scenario(router)"""
+
+    async def go():
+        for server in servers:
+            await server.start()
+        endpoints = [
+            main.LLMEndpoint(server.url,
+                             f'stub-{server.name}',
+                             'key',
+                             max_retries=0) for server in servers
+        ]
+        # 都刚测量过，排序只看预期延迟，不触发重新测量
+        for endpoint in endpoints:
+            endpoint.last_attempt = time.monotonic()
+        router = main.LLMRouter(endpoints, hedge=hedge, hedge_min_delay=0.05)
+        try:
+            return await scenario(router)
+        finally:
+            for endpoint in endpoints:
+                if endpoint._client is not None:
+                    await endpoint._client._client.close()
+            for server in servers:
+                await server.stop()
+
+    return asyncio.run(go())
+
+
+def reply_text(completion):
+    return completion.choices[0].message.content
+
+
+def test_hedge_request_wins_when_primary_is_slow():
+    slow, fast = StubLLMServer('a', latency=1.0), StubLLMServer('b')
+
+    async def scenario(router):
+        primary, backup = router.endpoints
+        for _ in range(primary.MIN_SAMPLES):
+            primary.record_latency(0.05)
+        backup.record_latency(0.1)
+        completion = await router.create(MESSAGES)
+        return completion, primary, backup
+
+    completion, primary, backup = run(scenario, slow, fast)
+    assert reply_text(completion) == 'b'
+    assert (slow.requests, fast.requests) == (1, 1)
+    # 被取消的请求只知道延迟的下限：不加入样本，EWMA只往上调
+    assert len(primary.samples) == primary.MIN_SAMPLES
+    assert primary.latency >= 0.05
+    assert primary.failures == 0
+
+
+def test_no_hedge_when_primary_answers_within_p95():
+    fast, backup = StubLLMServer('a'), StubLLMServer('b')
+
+    async def scenario(router):
+        primary = router.endpoints[0]
+        for _ in range(primary.MIN_SAMPLES):
+            primary.record_latency(0.5)
+        router.endpoints[1].record_latency(1.0)
+        return await router.create(MESSAGES)
+
+    assert reply_text(run(scenario, fast, backup)) == 'a'
+    assert (fast.requests, backup.requests) == (1, 0)
+
+
+def test_fails_over_to_next_endpoint():
+    broken, healthy = StubLLMServer('a', fail=True), StubLLMServer('b')
+
+    async def scenario(router):
+        completion = await router.create(MESSAGES)
+        return completion, router.endpoints[0]
+
+    completion, primary = run(scenario, broken, healthy, hedge=False)
+    assert reply_text(completion) == 'b'
+    assert (broken.requests, healthy.requests) == (1, 1)
+    assert primary.failures == 1
+    assert primary.error_rate > 0
+
+
+def test_breaker_opens_probes_and_closes():
+    server = StubLLMServer('a', fail=True)
+
+    async def scenario(router):
+        endpoint = router.endpoints[0]
+        for _ in range(main.LLM_BREAKER_FAILURES):
+            with pytest.raises(Exception):
+                await router.create(MESSAGES)
+        assert endpoint.open_until > time.monotonic()
+
+        # 熔断期间直接失败，不发请求
+        with pytest.raises(main.LLMEndpointsUnavailable):
+            await router.create(MESSAGES)
+        assert server.requests == main.LLM_BREAKER_FAILURES
+
+        # 冷却结束后只放行一个试探请求
+        endpoint.open_until = time.monotonic() - 1
+        server.fail = False
+        server.latency = 0.2
+        probe = asyncio.create_task(router.create(MESSAGES))
+        await asyncio.sleep(0.05)
+        assert endpoint.probing
+        with pytest.raises(main.LLMEndpointsUnavailable):
+            await router.create(MESSAGES)
+
+        # 试探成功后恢复
+        completion = await probe
+        assert reply_text(completion) == 'a'
+        assert endpoint.open_until == 0
+        assert endpoint.failures == 0
+        assert not endpoint.probing
+        assert reply_text(await router.create(MESSAGES)) == 'a'
+        return server.requests
+
+    assert run(scenario, server) == main.LLM_BREAKER_FAILURES + 2
+
+
+def test_failed_probe_reopens_breaker():
+    server = StubLLMServer('a', fail=True)
+
+    async def scenario(router):
+        endpoint = router.endpoints[0]
+        for _ in range(main.LLM_BREAKER_FAILURES):
+            with pytest.raises(Exception):
+                await router.create(MESSAGES)
+        endpoint.open_until = time.monotonic() - 1
+        with pytest.raises(Exception):
+            await router.create(MESSAGES)
+        assert endpoint.open_until > time.monotonic()
+        assert not endpoint.probing
+
+    run(scenario, server)
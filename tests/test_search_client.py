@@ -0,0 +1,150 @@
+"""GoogleSearchClient 的重试、超时和缓存测试，搜索接口由本地 aiohttp 桩服务器模拟"""
+import asyncio
+
+from aiohttp import web
+
+import main
+
+
+class StubSearchServer:
+    """按顺序返回预设状态码的桩搜索接口，之后一律返回200"""
+
+    def __init__(self, statuses=(), delay=0):
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.queries = []
+        self.url = None
+        self._runner = None
+
+    async def handle(self, request):
+        self.queries.append(request.query['q'])
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status != 200:
+            return web.Response(status=status)
+        return web.json_response({
+            'items': [{
+                'title': request.query['q'],
+                'link': 'https://example.com/',
+                'snippet': request.query['q']
+            }]
+        })
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/search', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f'http://{host}:{port}/search'
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+def run(server, scenario, **options):
+    """启动桩服务器，用指向它的客户端运行 scenario(client) 并返回其结果"""
+
+    async def go():
+        await server.start()
+        client = main.GoogleSearchClient(api_key='key',
+                                         cx='cx',
+                                         url=server.url,
+                                         backoff=0.01,
+                                         **options)
+        try:
+            return await scenario(client)
+        finally:
+            await client.close()
+            await server.stop()
+
+    return asyncio.run(go())
+
+
+def test_retries_server_errors_and_rate_limits():
+    server = StubSearchServer(statuses=[503, 429])
+
+    async def scenario(client):
+        return await client.search('python')
+
+    items = run(server, scenario, retries=2)
+    assert items[0]['title'] == 'python'
+    assert server.queries == ['python'] * 3
+
+
+def test_gives_up_after_last_retry_without_caching():
+    server = StubSearchServer(statuses=[500, 502, 504, 500])
+
+    async def scenario(client):
+        first = await client.search('python')
+        second = await client.search('python')
+        return first, second
+
+    first, second = run(server, scenario, retries=2)
+    assert first is None
+    assert second[0]['title'] == 'python'
+    assert len(server.queries) == 5
+
+
+def test_client_errors_are_not_retried():
+    server = StubSearchServer(statuses=[403])
+
+    async def scenario(client):
+        return await client.search('python')
+
+    assert run(server, scenario, retries=2) is None
+    assert len(server.queries) == 1
+
+
+def test_timeout_is_retried_then_gives_up():
+    server = StubSearchServer(delay=0.5)
+
+    async def scenario(client):
+        return await client.search('python')
+
+    assert run(server, scenario, timeout=0.1, retries=1) is None
+    assert len(server.queries) == 2
+
+
+def test_cache_hits_use_normalized_query():
+    server = StubSearchServer()
+
+    async def scenario(client):
+        await client.search('Hello  World?')
+        items = await client.search('hello world')
+        return items, client.cache_stats()
+
+    items, stats = run(server, scenario)
+    assert items[0]['title'] == 'Hello  World?'
+    assert server.queries == ['Hello  World?']
+    assert stats == {'hits': 1, 'misses': 1, 'size': 1}
+
+
+def test_cache_entries_expire_after_ttl():
+    server = StubSearchServer()
+
+    async def scenario(client):
+        await client.search('python')
+        await client.search('python')
+        await asyncio.sleep(0.1)
+        await client.search('python')
+
+    run(server, scenario, cache_ttl=0.05)
+    assert server.queries == ['python', 'python']
+
+
+def test_cache_evicts_least_recently_used():
+    server = StubSearchServer()
+
+    async def scenario(client):
+        for query in ['a', 'b', 'a', 'c', 'a', 'b']:
+            await client.search(query)
+        return client.cache_stats()
+
+    stats = run(server, scenario, cache_size=2)
+    # 'a' 被再次访问后成为最近使用的，插入 'c' 时淘汰的是 'b'
+    assert server.queries == ['a', 'b', 'c', 'b']
+    assert stats['size'] == 2